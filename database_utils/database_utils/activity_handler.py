@@ -1,19 +1,47 @@
 """This module provides the StravaActivity dataclass and the StravaActivityHandler.
 
 StravaActivity defines how an activity we receive from strava is modeled on our side.
+ActivityRows holds a whole page of activities as rows, it is parsed and written without an object per activity.
 StravaActivityHandler wraps basic data interactions regarding activities.
+Leaderboards and user statistics are cached in process and recomputed once their data version moved.
 """
 import logging
-from dataclasses import dataclass
-from datetime import datetime, timezone
-from typing import Dict
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, timezone
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Type, TypeVar, Union
+
+import orjson
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import Insert
 
 from database_utils import DatabaseConnector
+from database_utils.cache import VersionedCache
+from database_utils.leaderboard import (
+    LeaderboardEntry,
+    delete_user_totals,
+    read_leaderboard,
+    refresh_challenge_totals,
+)
 from database_utils.schema import Activity
+from database_utils.user_stats import UserStats, read_user_stats
+from database_utils.versions import (
+    USERS_VERSION,
+    UnsupportedDialectError,
+    bump_versions,
+    challenge_version,
+    read_versions,
+    user_version,
+)
 
 logger = logging.getLogger(__name__)
 logger.info(__name__)
 
+T = TypeVar("T")
+
 
 @dataclass
 class StravaActivity:
@@ -31,6 +59,32 @@ class StravaActivity:
     start_date: datetime
 
 
+def parse_timestamp(timestamp: str) -> datetime:
+    """Parse a timestamp in utc as sent by strava, e.g. "2023-02-18T09:30:00Z".
+
+    datetime.fromisoformat is implemented in C and an order of magnitude faster than datetime.strptime.
+
+    Args:
+        timestamp: ISO 8601 timestamp with trailing "Z"
+
+    Returns:
+        naive datetime in utc
+    """
+    return datetime.fromisoformat(timestamp.rstrip("Z"))
+
+
+def decode_json(content: Union[bytes, str]) -> Union[Dict, List]:
+    """Decode a json response body with orjson, which is several times faster than the json module.
+
+    Args:
+        content: raw json
+
+    Returns:
+        decoded object
+    """
+    return orjson.loads(content)
+
+
 def parse_activity(activity: Dict) -> StravaActivity:
     """Parse activity object received from strava api to StravaActivity object.
 
@@ -50,13 +104,205 @@ def parse_activity(activity: Dict) -> StravaActivity:
         total_elevation_gain=activity.get("total_elevation_gain"),
         sport_type=activity["sport_type"],
         # the timezone we get from strava for this key is always utc
-        start_date=datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc),
+        start_date=parse_timestamp(activity["start_date"]).replace(tzinfo=timezone.utc),
+    )
+
+
+@dataclass
+class ActivityRows:
+    """Dataclass holding activities as column values of the activity table, one dict per activity.
+
+    start_date holds naive datetimes in utc, as they are stored.
+    """
+
+    rows: List[Dict]
+
+    @classmethod
+    def from_api(cls: Type["ActivityRows"], activities: List[Dict]) -> "ActivityRows":
+        """Parse activity objects received from strava api, e.g. a page of getLoggedInAthleteActivities.
+
+        Every activity is converted in a single pass straight into the row that is written.
+
+        Args:
+            activities: list of activity objects from strava api
+
+        Returns:
+            ActivityRows
+        """
+        return cls(
+            rows=[
+                {
+                    "id": str(activity["id"]),
+                    "user_id": str(activity["athlete"]["id"]),
+                    "name": activity["name"],
+                    "distance": activity.get("distance"),
+                    "moving_time": activity.get("moving_time") or None,
+                    "elapsed_time": activity.get("elapsed_time") or None,
+                    "total_elevation_gain": activity.get("total_elevation_gain"),
+                    "sport_type": activity["sport_type"],
+                    # the timezone we get from strava for this key is always utc
+                    "start_date": parse_timestamp(activity["start_date"]),
+                }
+                for activity in activities
+            ],
+        )
+
+    def __len__(self) -> int:
+        """Number of activities.
+
+        Returns:
+            int
+        """
+        return len(self.rows)
+
+    def latest_start_date(self) -> Optional[datetime]:
+        """Get the start of the latest activity.
+
+        Returns:
+            naive datetime in utc, None if there are no activities
+        """
+        return max((row["start_date"] for row in self.rows), default=None)
+
+
+def _to_row(activity: StravaActivity) -> Dict:
+    """Convert a StravaActivity to column values of the activity table.
+
+    start_date is stored as naive datetime in utc.
+
+    Args:
+        activity: StravaActivity
+
+    Returns:
+        dict of column name -> value
+    """
+    row = asdict(activity)
+    if activity.start_date and activity.start_date.tzinfo:
+        row["start_date"] = activity.start_date.astimezone(timezone.utc).replace(tzinfo=None)
+    return row
+
+
+def _from_row(activity: Activity) -> StravaActivity:
+    """Convert a row of the activity table to a StravaActivity.
+
+    Args:
+        activity: Activity
+
+    Returns:
+        StravaActivity with timezone aware start_date in utc
+    """
+    return StravaActivity(
+        id=activity.id,
+        user_id=activity.user_id,
+        name=activity.name,
+        distance=activity.distance,
+        moving_time=activity.moving_time,
+        elapsed_time=activity.elapsed_time,
+        total_elevation_gain=activity.total_elevation_gain,
+        sport_type=activity.sport_type,
+        start_date=activity.start_date.replace(tzinfo=timezone.utc) if activity.start_date else None,
     )
 
 
+def _chunked(items: Iterable[T], chunk_size: int) -> Iterator[List[T]]:
+    """Split an iterable into lists of at most chunk_size elements.
+
+    Args:
+        items: iterable, e.g. of rows or activity ids
+        chunk_size: maximum length of a chunk
+
+    Yields:
+        list of elements of items
+    """
+    iterator = iter(items)
+    while chunk := list(islice(iterator, chunk_size)):
+        yield chunk
+
+
+def _upsert_statement(session: Session, rows: List[Dict]) -> Insert:
+    """Build a multi-row insert for the activity table that updates rows with an existing id.
+
+    Args:
+        session: session the statement will be executed in, used to pick the sql dialect
+        rows: list of column -> value dicts
+
+    Returns:
+        Insert statement
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect in ("mysql", "mariadb"):
+        # INSERT ... ON DUPLICATE KEY UPDATE
+        statement = mysql_insert(Activity).values(rows)
+        return statement.on_duplicate_key_update(
+            {column.name: statement.inserted[column.name] for column in Activity.__table__.columns},
+        )
+    if dialect == "sqlite":
+        # INSERT ... ON CONFLICT (id) DO UPDATE
+        statement = sqlite_insert(Activity).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=[Activity.id],
+            set_={column.name: statement.excluded[column.name] for column in Activity.__table__.columns},
+        )
+    raise UnsupportedDialectError(dialect)
+
+
+def _refresh_user_data(session: Session, user_ids: Iterable[Optional[str]], refresh_totals: bool = True) -> None:
+    """Recompute the challenge totals of users whose activities changed and bump the versions of their activities.
+
+    Args:
+        session: session changing the activities
+        user_ids: ids of the users on strava, None entries are ignored
+        refresh_totals: recompute the challenge totals, False if the caller refreshes them later
+
+    Returns:
+        None
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if refresh_totals:
+        refresh_challenge_totals(session, user_ids)
+    bump_versions(session, [user_version(user_id) for user_id in user_ids])
+
+
 class StravaActivityHandler(DatabaseConnector):
     """StravaActivityHandler wraps basic data interactions regarding activities pulled from strava in our data."""
 
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        user: str = None,
+        password: str = None,
+        host: str = None,
+        port: str = None,
+        database: str = None,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_recycle: int = 3600,
+    ) -> None:
+        """Init of StravaActivityHandler.
+
+        Args:
+            user: username to connect to the data service
+            password: ...
+            host: host url
+            port: service port
+            database: name of the target data.
+            pool_size: number of connections kept open in the shared pool
+            max_overflow: number of connections allowed on top of pool_size under load
+            pool_recycle: seconds after which a pooled connection is replaced
+        """
+        super().__init__(
+            user=user,
+            password=password,
+            host=host,
+            port=port,
+            database=database,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_recycle=pool_recycle,
+        )
+        # leaderboards by challenge and limit, shared by all sessions of the app using this handler
+        self._leaderboards: VersionedCache[Tuple[LeaderboardEntry, ...]] = VersionedCache()
+        # statistics by user, kept until the activities of the user change or the day ends
+        self._user_stats: VersionedCache[UserStats] = VersionedCache()
+
     def __getitem__(self, key: str) -> StravaActivity:
         """Get activity by key from data.
 
@@ -85,19 +331,10 @@ class StravaActivityHandler(DatabaseConnector):
             StravaActivity or None when activity with given id is not available
         """
         logger.info("Get activity: %s", activity_id)
-        activity = self.session.query(Activity).filter(Activity.id == activity_id).first()
-        if activity:
-            return StravaActivity(
-                id=activity.id,
-                user_id=activity.user_id,
-                name=activity.name,
-                distance=activity.distance,
-                moving_time=activity.moving_time,
-                elapsed_time=activity.elapsed_time,
-                total_elevation_gain=activity.total_elevation_gain,
-                sport_type=activity.sport_type,
-                start_date=activity.start_date,
-            )
+        with self.session_scope() as session:
+            activity = session.query(Activity).filter(Activity.id == activity_id).first()
+            if activity:
+                return _from_row(activity)
         logger.info("Unknown Activity: %s", activity_id)
         return None
 
@@ -111,18 +348,52 @@ class StravaActivityHandler(DatabaseConnector):
             None
         """
         logger.info("Add activity: %s", activity.id)
-        new_activity = Activity(
-            id=activity.id,
-            user_id=activity.user_id,
-            name=activity.name,
-            distance=activity.distance,
-            moving_time=activity.moving_time,
-            elapsed_time=activity.elapsed_time,
-            total_elevation_gain=activity.total_elevation_gain,
-            sport_type=activity.sport_type,
-            start_date=activity.start_date,
-        )
-        self.insert(new_activity)
+        with self.session_scope() as session:
+            session.add(Activity(**_to_row(activity)))
+            _refresh_user_data(session, [activity.user_id])
+
+    def upsert(self, activity: StravaActivity) -> None:
+        """Add StravaActivity to data or update it if it already exists.
+
+        Args:
+            activity: StravaActivity
+
+        Returns:
+            None
+        """
+        self.bulk_upsert([activity])
+
+    def bulk_upsert(
+        self,
+        activities: Union[ActivityRows, Iterable[StravaActivity]],
+        chunk_size: int = 200,
+        refresh_totals: bool = True,
+    ) -> int:
+        """Add or update many activities in one transaction.
+
+        Activities are written in multi-row insert statements of chunk_size rows,
+        so the number of round trips depends on the number of chunks instead of the number of activities.
+
+        Args:
+            activities: ActivityRows or iterable of StravaActivity
+            chunk_size: number of activities written per statement
+            refresh_totals: recompute the challenge totals of the affected users, callers writing many batches
+                of one user, e.g. ingestion jobs, pass False and refresh the totals once they are done
+
+        Returns:
+            number of activities written
+        """
+        rows = activities.rows if isinstance(activities, ActivityRows) else map(_to_row, activities)
+        count = 0
+        user_ids = set()
+        with self.session_scope() as session:
+            for chunk in _chunked(rows, chunk_size):
+                session.execute(_upsert_statement(session, chunk))
+                user_ids.update(row["user_id"] for row in chunk)
+                count += len(chunk)
+            _refresh_user_data(session, user_ids, refresh_totals=refresh_totals)
+        logger.info("Upserted %s activities", count)
+        return count
 
     def update(self, activity: StravaActivity) -> None:
         """Update existing StravaActivity in data.
@@ -134,20 +405,10 @@ class StravaActivityHandler(DatabaseConnector):
             None
         """
         logger.info("Update activity: %s", activity.id)
-        self.session.query(Activity).filter(Activity.id == activity.id).update(
-            {
-                Activity.id: activity.id,
-                Activity.user_id: activity.user_id,
-                Activity.name: activity.name,
-                Activity.distance: activity.distance,
-                Activity.moving_time: activity.moving_time,
-                Activity.elapsed_time: activity.elapsed_time,
-                Activity.total_elevation_gain: activity.total_elevation_gain,
-                Activity.sport_type: activity.sport_type,
-                Activity.start_date: activity.start_date,
-            },
-        )
-        self.session.commit()
+        with self.session_scope() as session:
+            previous_user_id = session.scalar(sa.select(Activity.user_id).where(Activity.id == activity.id))
+            session.query(Activity).filter(Activity.id == activity.id).update(_to_row(activity))
+            _refresh_user_data(session, [activity.user_id, previous_user_id])
 
     def delete(self, activity_id: str) -> None:
         """Delete existing StravaActivity from data.
@@ -159,21 +420,147 @@ class StravaActivityHandler(DatabaseConnector):
             None
         """
         logger.info("Delete activity: %s", activity_id)
-        activity = self.session.query(Activity).filter(Activity.id == activity_id).first()
-        self.session.delete(activity)
-        self.session.commit()
+        with self.session_scope() as session:
+            user_id = session.scalar(sa.select(Activity.user_id).where(Activity.id == activity_id))
+            if user_id is None:
+                logger.info("Unknown Activity: %s", activity_id)
+                return
+            session.execute(sa.delete(Activity).where(Activity.id == activity_id))
+            _refresh_user_data(session, [user_id])
+
+    def delete_many(self, activity_ids: Iterable[str], chunk_size: int = 200) -> int:
+        """Delete many StravaActivity objects in one transaction.
+
+        Unknown ids are ignored. Challenge totals of all affected users are recomputed once at the end.
 
-    def delete_user_activities(self, user_id: str) -> None:
+        Args:
+            activity_ids: iterable of activity ids on strava
+            chunk_size: number of activities deleted per statement
+
+        Returns:
+            number of deleted activities
+        """
+        deleted = 0
+        user_ids = set()
+        with self.session_scope() as session:
+            for chunk in _chunked(activity_ids, chunk_size):
+                user_ids.update(session.scalars(sa.select(Activity.user_id).where(Activity.id.in_(chunk)).distinct()))
+                deleted += session.execute(sa.delete(Activity).where(Activity.id.in_(chunk))).rowcount
+            _refresh_user_data(session, user_ids)
+        logger.info("Deleted %s activities", deleted)
+        return deleted
+
+    def delete_user_activities(self, user_id: str, chunk_size: Optional[int] = None) -> int:
         """Delete all existing StravaActivity for a given user_id from data.
 
+        Without chunk_size this is a single DELETE statement. The challenge totals of the user are deleted as well.
+        With chunk_size activities are deleted in batches of chunk_size ids to keep single statements small
+        for users with huge histories. Either way everything happens in one transaction,
+        which joins the transaction of an enclosing session_scope.
+
         Args:
             user_id: id of the user on strava
+            chunk_size: optional number of activities deleted per statement
 
         Returns:
-            None
+            number of deleted activities
         """
         logger.info("Delete all activities for user: %s", user_id)
-        activity_id_list = self.session.query(Activity.id).filter(Activity.user_id == user_id).all()
+        with self.session_scope() as session:
+            if not chunk_size:
+                deleted = session.execute(sa.delete(Activity).where(Activity.user_id == user_id)).rowcount
+            else:
+                deleted = 0
+                id_query = sa.select(Activity.id).where(Activity.user_id == user_id).limit(chunk_size)
+                while activity_ids := session.scalars(id_query).all():
+                    session.execute(sa.delete(Activity).where(Activity.id.in_(activity_ids)))
+                    deleted += len(activity_ids)
+            # percentiles are rescored without the deleted activities
+            delete_user_totals(session, user_id)
+            bump_versions(session, [user_version(user_id)])
+            return deleted
+
+    def get_leaderboard(self, challenge: str, limit: Optional[int] = None) -> List[LeaderboardEntry]:
+        """Get the precomputed leaderboard of a challenge ordered by distance.
+
+        The leaderboard is served from the cache as long as the versions of the challenge and the user names did
+        not move. Concurrent callers asking for a stale leaderboard wait for one of them to read it.
+
+        Args:
+            challenge: name of the challenge
+            limit: maximum number of entries, all if None
+
+        Returns:
+            list of LeaderboardEntry
+        """
+        with self.session_scope() as session:
+            version = read_versions(session, [challenge_version(challenge), USERS_VERSION])
+        leaderboard = self._leaderboards.get_or_compute(
+            (challenge, limit),
+            version,
+            lambda: self._read_leaderboard(challenge, limit),
+        )
+        return list(leaderboard)
+
+    def _read_leaderboard(self, challenge: str, limit: Optional[int]) -> Tuple[LeaderboardEntry, ...]:
+        """Read the leaderboard of a challenge from the database.
+
+        Args:
+            challenge: name of the challenge
+            limit: maximum number of entries, all if None
+
+        Returns:
+            tuple of LeaderboardEntry
+        """
+        logger.info("Read leaderboard: %s", challenge)
+        with self.session_scope() as session:
+            return tuple(read_leaderboard(session, challenge, limit=limit))
+
+    def get_user_stats(self, user_id: str, weeks: int = 12, months: int = 12) -> UserStats:
+        """Get totals per week and month, personal bests and streaks of a user.
+
+        The statistics are served from the cache until the activities of the user change.
+        Streaks depend on the current day, so they are recomputed once per day as well.
+
+        Args:
+            user_id: id of the user on strava
+            weeks: number of weeks with weekly totals, including the current week
+            months: number of months with monthly totals, including the current month
 
-        for activity_id in activity_id_list:
-            self.delete(activity_id)
+        Returns:
+            UserStats, do not modify as it is shared
+        """
+        today = datetime.now(tz=timezone.utc).date()
+        with self.session_scope() as session:
+            version = (*read_versions(session, [user_version(user_id)]), today)
+        return self._user_stats.get_or_compute(
+            (user_id, weeks, months),
+            version,
+            lambda: self._read_user_stats(user_id, today, weeks, months),
+        )
+
+    def _read_user_stats(self, user_id: str, today: date, weeks: int, months: int) -> UserStats:
+        """Compute the statistics of a user from the database.
+
+        Args:
+            user_id: id of the user on strava
+            today: current day in utc
+            weeks: number of weeks with weekly totals
+            months: number of months with monthly totals
+
+        Returns:
+            UserStats
+        """
+        logger.info("Read stats of user: %s", user_id)
+        with self.session_scope() as session:
+            return read_user_stats(session, user_id, today, weeks=weeks, months=months)
+
+    def rebuild_challenge_totals(self) -> None:
+        """Recompute the challenge totals of all users from scratch.
+
+        Returns:
+            None
+        """
+        logger.info("Rebuild challenge totals")
+        with self.session_scope() as session:
+            refresh_challenge_totals(session)
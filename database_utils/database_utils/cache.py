@@ -0,0 +1,180 @@
+"""This module provides thread safe in-process caches.
+
+Handlers use them to serve repeated reads without a database round trip.
+TTLCache expires entries after a fixed time, so entries written by other processes become visible once
+the cached entry expired, writes through the handler itself invalidate the affected entries right away.
+VersionedCache keeps entries until the version of their inputs moves, see database_utils.versions.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """Thread safe mapping whose entries expire after ttl seconds, evicting the least recently used beyond maxsize."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0) -> None:
+        """Thread safe mapping whose entries expire after ttl seconds.
+
+        Args:
+            maxsize: maximum number of entries, the least recently used entry is evicted beyond
+            ttl: seconds an entry is served, 0 disables the cache
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expiry, value), ordered from least to most recently used
+        self._entries: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether entries are cached at all.
+
+        Returns:
+            bool
+        """
+        return self.ttl > 0 and self.maxsize > 0
+
+    def get(self, key: Hashable, default: Optional[V] = None) -> Optional[V]:
+        """Get the value cached for key if it has not expired.
+
+        Args:
+            key: cache key
+            default: returned if key is not cached or expired
+
+        Returns:
+            cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expiry, value = entry
+            if expiry < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: V) -> None:  # noqa: A003
+        """Cache value for key.
+
+        Args:
+            key: cache key
+            value: value to cache
+
+        Returns:
+            None
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys: Hashable) -> None:
+        """Drop the entries of keys.
+
+        Args:
+            *keys: cache keys
+
+        Returns:
+            None
+        """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop all entries.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class VersionedCache(Generic[V]):
+    """Thread safe mapping of values computed for a version of their inputs.
+
+    A value is computed once per key and version: concurrent callers asking for the same stale key wait for the
+    first one instead of computing it again. Every key keeps its latest value only,
+    the least recently used key is evicted beyond maxsize.
+    """
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        """Thread safe mapping of values computed for a version of their inputs.
+
+        Args:
+            maxsize: maximum number of keys, the least recently used key is evicted beyond
+        """
+        self.maxsize = maxsize
+        # key -> (version, value), ordered from least to most recently used
+        self._entries: "OrderedDict[Hashable, Tuple[Hashable, V]]" = OrderedDict()
+        # key -> lock held while the value of key is computed
+        self._key_locks: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key: Hashable, version: Hashable) -> Tuple[bool, Optional[V]]:
+        """Look up the value of key computed for version.
+
+        Args:
+            key: cache key
+            version: version of the inputs of the value
+
+        Returns:
+            tuple of whether the value is cached and the value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[1]
+
+    def get_or_compute(self, key: Hashable, version: Hashable, compute: Callable[[], V]) -> V:
+        """Get the value of key for version, computing it if the cached value belongs to another version.
+
+        Read version before the inputs of compute, then a value is never cached under a newer version than its inputs.
+
+        Args:
+            key: cache key
+            version: current version of the inputs of the value
+            compute: function computing the value
+
+        Returns:
+            value of key
+        """
+        hit, value = self._cached(key, version)
+        if hit:
+            return value
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # another caller may have computed the value while we waited
+            hit, value = self._cached(key, version)
+            if hit:
+                return value
+            value = compute()
+            with self._lock:
+                self._entries[key] = (version, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    evicted, _ = self._entries.popitem(last=False)
+                    self._key_locks.pop(evicted, None)
+            return value
+
+    def clear(self) -> None:
+        """Drop all entries.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,215 @@
+"""This module provides the ChallengeDefinition dataclass and the challenges available in metriker.
+
+A challenge is defined declaratively by the sport types counting towards it, an optional time window,
+the metric of an activity that is scored and how it is aggregated per user.
+Individual challenges rank users by their score, team challenges add up the scores of all users towards a goal.
+Definitions are compiled into one grouped query on the activity table, see database_utils.leaderboard.
+Scoring rules plain SQL can not express, like weights per sport type or capped daily points,
+are evaluated on columnar arrays instead, see database_utils.scoring.
+
+The challenges available in metriker are defined in challenges.json next to this module.
+"""
+import hashlib
+import json
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Type, Union
+
+import sqlalchemy as sa
+
+from database_utils.schema import Activity
+
+# columns of the activity table a challenge can score, "activity_count" counts activities
+METRICS = ("distance", "moving_time", "elapsed_time", "total_elevation_gain", "activity_count")
+AGGREGATIONS = ("sum", "max", "avg", "count")
+CHALLENGES_PATH = Path(__file__).parent / "challenges.json"
+
+
+class InvalidChallengeError(ValueError):
+    """A challenge definition is not valid."""
+
+    def __init__(self, name: str, reason: str) -> None:
+        """Init of InvalidChallengeError Exception.
+
+        Args:
+            name: name of the challenge
+            reason: what is wrong with the definition
+        """
+        super().__init__(f"Invalid definition of challenge {name}: {reason}")
+
+
+def _parse_date(value: Union[str, datetime, None]) -> Optional[datetime]:
+    """Parse a date of a challenge definition to a naive datetime in utc.
+
+    Args:
+        value: ISO 8601 text in utc, e.g. "2023-06-01T00:00:00", datetime or None
+
+    Returns:
+        naive datetime or None
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+@dataclass(frozen=True)
+class ScoringRules:
+    """Dataclass defining how activities are turned into points, for scores plain SQL aggregation can not express."""
+
+    # points per unit of the metric by sport type, as pairs to keep the definition hashable
+    sport_weights: Tuple[Tuple[str, float], ...] = ()
+    # points per unit of the metric for sport types without weight
+    default_weight: float = 1.0
+    # points per meter of elevation gain, added to the points of every activity
+    elevation_bonus: float = 0.0
+    # maximum points of a user per day in utc, None means uncapped
+    daily_cap: Optional[float] = None
+    # replace scores by the percentage of users scoring the same or less, 0 to 100
+    percentile: bool = False
+
+    @classmethod
+    def from_dict(cls: Type["ScoringRules"], rules: Dict) -> "ScoringRules":
+        """Create ScoringRules from their declarative form.
+
+        Args:
+            rules: dict with the fields of ScoringRules, sport_weights as object of sport type -> weight
+
+        Returns:
+            ScoringRules
+        """
+        rules = dict(rules)
+        rules["sport_weights"] = tuple(sorted(rules.get("sport_weights", {}).items()))
+        return cls(**rules)
+
+
+@dataclass(frozen=True)
+class ChallengeDefinition:
+    """Dataclass defining which activities count towards a challenge and how they are scored."""
+
+    name: str
+    # empty means all sport types count
+    sport_types: Tuple[str, ...] = ()
+    # naive datetimes in utc, None means unbounded
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+    metric: str = "distance"
+    aggregation: str = "sum"
+    # team challenges add up the scores of all users
+    team: bool = False
+    # score a team challenge aims for, in the unit of metric
+    goal: Optional[float] = None
+    # name of the flet icon shown in the app
+    icon: str = "emoji_events"
+    title: Optional[str] = None
+    # scores are computed by database_utils.scoring instead of the aggregation if set
+    scoring: Optional[ScoringRules] = None
+
+    def __post_init__(self) -> None:
+        """Validate the definition.
+
+        Returns:
+            None
+        """
+        if self.metric not in METRICS:
+            raise InvalidChallengeError(self.name, f"unknown metric {self.metric}, expected one of {METRICS}")
+        if self.aggregation not in AGGREGATIONS:
+            raise InvalidChallengeError(
+                self.name,
+                f"unknown aggregation {self.aggregation}, expected one of {AGGREGATIONS}",
+            )
+        if self.metric == "activity_count" and self.aggregation != "count":
+            raise InvalidChallengeError(self.name, "activity_count can only be aggregated by count")
+        if self.start_date and self.end_date and self.start_date >= self.end_date:
+            raise InvalidChallengeError(self.name, "start_date must be before end_date")
+        if self.scoring and self.aggregation not in ("sum", "count"):
+            raise InvalidChallengeError(self.name, "scoring rules add up points, use the aggregation sum")
+
+    def definition_hash(self) -> str:
+        """Hash the fields deciding the totals of the challenge, presentation fields like title are left out.
+
+        Returns:
+            hex digest of sha256
+        """
+        fields = {
+            "sport_types": sorted(self.sport_types),
+            "start_date": self.start_date.isoformat() if self.start_date else None,
+            "end_date": self.end_date.isoformat() if self.end_date else None,
+            "metric": self.metric,
+            "aggregation": self.aggregation,
+            "scoring": asdict(self.scoring) if self.scoring else None,
+        }
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def from_dict(cls: Type["ChallengeDefinition"], definition: Dict) -> "ChallengeDefinition":
+        """Create a ChallengeDefinition from its declarative form.
+
+        Args:
+            definition: dict with the fields of ChallengeDefinition, dates as ISO 8601 text in utc
+
+        Returns:
+            ChallengeDefinition
+        """
+        definition = dict(definition)
+        definition["sport_types"] = tuple(definition.get("sport_types", ()))
+        definition["start_date"] = _parse_date(definition.get("start_date"))
+        definition["end_date"] = _parse_date(definition.get("end_date"))
+        if definition.get("metric") == "activity_count":
+            definition.setdefault("aggregation", "count")
+        if definition.get("scoring") is not None:
+            definition["scoring"] = ScoringRules.from_dict(definition["scoring"])
+        return cls(**definition)
+
+
+def activity_conditions(challenge: ChallengeDefinition) -> List[sa.ColumnElement]:
+    """Build the conditions activities counting towards a challenge fulfill.
+
+    Args:
+        challenge: ChallengeDefinition
+
+    Returns:
+        list of conditions on the activity table
+    """
+    conditions = []
+    if challenge.sport_types:
+        conditions.append(Activity.sport_type.in_(challenge.sport_types))
+    if challenge.start_date:
+        conditions.append(Activity.start_date >= challenge.start_date)
+    if challenge.end_date:
+        conditions.append(Activity.start_date < challenge.end_date)
+    return conditions
+
+
+def parse_challenges(definitions: List[Dict]) -> Dict[str, ChallengeDefinition]:
+    """Create ChallengeDefinitions from their declarative form.
+
+    Args:
+        definitions: list of dicts with the fields of ChallengeDefinition
+
+    Returns:
+        dict of name -> ChallengeDefinition in the order of definitions
+    """
+    challenges = {}
+    for definition in definitions:
+        challenge = ChallengeDefinition.from_dict(definition)
+        if challenge.name in challenges:
+            raise InvalidChallengeError(challenge.name, "name is not unique")
+        challenges[challenge.name] = challenge
+    return challenges
+
+
+def load_challenges(path: Path = CHALLENGES_PATH) -> Dict[str, ChallengeDefinition]:
+    """Load challenge definitions from a json file holding a list of definitions.
+
+    Args:
+        path: path of the json file
+
+    Returns:
+        dict of name -> ChallengeDefinition in the order of the file
+    """
+    with path.open(encoding="utf-8") as file:
+        return parse_challenges(json.load(file))
+
+
+CHALLENGES: Dict[str, ChallengeDefinition] = load_challenges()
@@ -1,8 +1,86 @@
-"""Module containing DatabaseConnector class, managing connections to a SQL Database."""
+"""Module containing DatabaseConnector class, managing connections to a SQL Database.
+
+Engines are kept in a process-wide registry keyed by their connection uri.
+Every DatabaseConnector pointing to the same database shares one engine, one bounded connection pool
+and one thread scoped session registry, no matter how many handler objects are created.
+"""
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
 import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 
+from .migrations import upgrade
 from .schema import Base
+from .versions import bump_deferred_versions
+
+# process-wide registries, guarded by _REGISTRY_LOCK
+_ENGINES: Dict[str, sa.Engine] = {}
+_SESSIONS: Dict[str, scoped_session] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+# key in Session.info marking a session as already being used by an outer session_scope
+_SCOPE_ACTIVE = "metriker_scope_active"
+
+
+def get_engine(uri: str, pool_size: int = 5, max_overflow: int = 10, pool_recycle: int = 3600) -> sa.Engine:
+    """Return the engine registered for uri, creating it and the schema on first use.
+
+    Pool settings only take effect for the first call per uri.
+
+    Args:
+        uri: sqlalchemy connection uri
+        pool_size: number of connections kept open in the pool
+        max_overflow: number of connections allowed on top of pool_size under load
+        pool_recycle: seconds after which a pooled connection is replaced
+
+    Returns:
+        sa.Engine
+    """
+    with _REGISTRY_LOCK:
+        engine = _ENGINES.get(uri)
+        if engine is None:
+            engine = sa.create_engine(
+                uri,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_recycle=pool_recycle,
+                pool_pre_ping=True,
+            )
+            # create schema in db if it does not exist and migrate databases created by older revisions
+            Base.metadata.create_all(engine)
+            upgrade(engine)
+            _ENGINES[uri] = engine
+            _SESSIONS[uri] = scoped_session(sessionmaker(engine))
+        return engine
+
+
+def get_session_registry(uri: str) -> scoped_session:
+    """Return the thread scoped session registry for an uri already passed to get_engine.
+
+    Args:
+        uri: sqlalchemy connection uri
+
+    Returns:
+        scoped_session
+    """
+    return _SESSIONS[uri]
+
+
+def dispose_engines() -> None:
+    """Close all pooled connections and clear the registries, called on shutdown of a process.
+
+    Returns:
+        None
+    """
+    with _REGISTRY_LOCK:
+        for registry in _SESSIONS.values():
+            registry.remove()
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _SESSIONS.clear()
+        _ENGINES.clear()
 
 
 class DatabaseConnector:
@@ -15,6 +93,9 @@ class DatabaseConnector:
         host: str = None,
         port: str = None,
         database: str = None,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_recycle: int = 3600,
     ) -> None:
         """Init of DatabaseConnector.
 
@@ -24,6 +105,9 @@ class DatabaseConnector:
             host: host url
             port: service port
             database: name of the target data.
+            pool_size: number of connections kept open in the shared pool
+            max_overflow: number of connections allowed on top of pool_size under load
+            pool_recycle: seconds after which a pooled connection is replaced
         """
         self.engine = None
         self.session = None
@@ -34,19 +118,61 @@ class DatabaseConnector:
         self.port = port
         self.database = database
 
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+
         self._connect()
-        # create schema in db if it does not exist
-        Base.metadata.create_all(self.engine)
 
-    def _connect(self) -> None:
-        """Initiate the connection to the data service and populate the necessary obj variables."""
-        uri = f"sqlite:///{self.database}.db"
+    @property
+    def uri(self) -> str:
+        """Connection uri of the target data service.
+
+        Returns:
+            str
+        """
         if self.host:
-            uri = f"mariadb+mariadbconnector://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}"
-        self.engine = sa.create_engine(uri)
+            return f"mariadb+mariadbconnector://{self.user}:{self.password}@{self.host}:{self.port}/{self.database}"
+        return f"sqlite:///{self.database}.db"
+
+    def _connect(self) -> None:
+        """Attach to the shared engine and session registry and populate the necessary obj variables."""
+        self.engine = get_engine(
+            self.uri,
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_recycle=self.pool_recycle,
+        )
+        # scoped_session proxies to one session per thread
+        self.session = get_session_registry(self.uri)
+
+    @contextmanager
+    def session_scope(self) -> Iterator[Session]:
+        """Provide the session of the current thread as one unit of work.
+
+        The outermost scope commits on success, rolls back on errors and returns the connection to the pool.
+        Versions registered with bump_versions_after_commit are bumped right after the commit.
+        Nested scopes, also from other connectors on the same database, join the outer transaction.
+
+        Yields:
+            Session
+        """
+        session = self.session()
+        if session.info.get(_SCOPE_ACTIVE):
+            yield session
+            return
 
-        session = sessionmaker(self.engine)
-        self.session = session()
+        session.info[_SCOPE_ACTIVE] = True
+        try:
+            yield session
+            session.commit()
+            bump_deferred_versions(session)
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.info.pop(_SCOPE_ACTIVE, None)
+            self.session.remove()
 
     def insert(self, element: Base) -> None:
         """Insert a db object.
@@ -54,5 +180,5 @@ class DatabaseConnector:
         Args:
             element: db object inheriting from Base specified in tei_sql_schema
         """
-        self.session.add(element)
-        self.session.commit()
+        with self.session_scope() as session:
+            session.add(element)
@@ -0,0 +1,472 @@
+"""This module provides the StravaIngestionJob dataclass and the IngestionJobHandler.
+
+StravaIngestionJob defines a queued sync of the activity history of a user.
+IngestionJobHandler keeps the queue in the database, so jobs survive restarts of the ingestion service.
+Workers lease jobs, checkpoint their progress after every page and give the job up when the lease expires.
+Every lease carries a token, writes of a worker whose lease was taken over by another worker are rejected.
+
+Pages of a job are stored without recomputing the challenge totals of the user,
+they are recomputed once when the job is done or given up.
+
+Every user carries a sync watermark, the start_date of the latest activity a sync has seen.
+Incremental jobs only request activities after the watermark.
+Full jobs request the whole history and are queued periodically to catch activities incremental syncs missed,
+e.g. activities uploaded late with a start_date before the watermark.
+"""
+import logging
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database_utils import DatabaseConnector
+from database_utils.leaderboard import refresh_challenge_totals
+from database_utils.schema import IngestionJob, User
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# lower values are leased first
+PRIORITY_SYNC = 1
+PRIORITY_RECONCILE = 2
+
+
+class LeaseLostError(RuntimeError):
+    """The lease of a job expired and the job was taken over, its worker must not write to it anymore."""
+
+    def __init__(self, job_id: str) -> None:
+        """Init of LeaseLostError Exception.
+
+        Args:
+            job_id: id of the job
+        """
+        super().__init__(f"Lease of ingestion job {job_id} was lost")
+
+
+def _utc_now() -> datetime:
+    """Get the current time as naive datetime in utc.
+
+    Returns:
+        datetime
+    """
+    return datetime.now(tz=timezone.utc).replace(tzinfo=None)
+
+
+def _to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Convert a datetime to a naive datetime in utc, naive datetimes are assumed to be in utc already.
+
+    Args:
+        value: datetime or None
+
+    Returns:
+        naive datetime in utc or None
+    """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+@dataclass
+class StravaIngestionJob:
+    """Dataclass defining a queued sync of the activity history of a user."""
+
+    # we are shadowing names from the db so this is okayish here
+    id: str  # noqa: A003
+    user_id: str
+    status: str
+    priority: int
+    # naive datetimes in utc
+    before: Optional[datetime]
+    # None for a full sync of the history
+    after: Optional[datetime]
+    next_page: int
+    activity_count: int
+    latest_start_date: Optional[datetime]
+    attempts: int
+    error: Optional[str]
+    created_at: datetime
+    updated_at: datetime
+    # token of the current lease, passed back with every write of the worker holding it
+    lease_token: Optional[str] = None
+
+
+def _from_row(job: IngestionJob) -> StravaIngestionJob:
+    """Convert a row of the ingestion_job table into a StravaIngestionJob.
+
+    Args:
+        job: IngestionJob
+
+    Returns:
+        StravaIngestionJob
+    """
+    return StravaIngestionJob(
+        id=job.id,
+        user_id=job.user_id,
+        status=job.status,
+        priority=job.priority,
+        before=job.before,
+        after=job.after,
+        next_page=job.next_page,
+        activity_count=job.activity_count,
+        latest_start_date=job.latest_start_date,
+        attempts=job.attempts,
+        error=job.error,
+        created_at=job.created_at,
+        updated_at=job.updated_at,
+        lease_token=job.lease_token,
+    )
+
+
+class IngestionJobHandler(DatabaseConnector):
+    """IngestionJobHandler wraps the queue of ingestion jobs kept in the database."""
+
+    def get(self, job_id: str) -> (None, StravaIngestionJob):
+        """Get job by id from data.
+
+        Args:
+            job_id: id of the job
+
+        Returns:
+            StravaIngestionJob or None
+        """
+        with self.session_scope() as session:
+            job = session.get(IngestionJob, job_id)
+            if job:
+                return _from_row(job)
+        return None
+
+    def enqueue(
+        self,
+        user_id: str,
+        priority: int = PRIORITY_SYNC,
+        before: Optional[datetime] = None,
+        incremental: bool = True,
+    ) -> StravaIngestionJob:
+        """Queue a sync of the activity history of a user.
+
+        A user has at most one pending job, if one is queued or running already it is returned instead.
+        A full sync turns a pending incremental job into a full one.
+
+        Args:
+            user_id: id of the user on strava
+            priority: priority of the job, lower values are leased first
+            before: end of the synced interval as naive datetime in utc, defaults to the current time
+            incremental: only sync activities after the watermark of the user, the whole history if False
+
+        Returns:
+            StravaIngestionJob
+        """
+        try:
+            with self.session_scope() as session:
+                return self._enqueue(session, user_id, priority=priority, before=before, incremental=incremental)
+        except IntegrityError:
+            # another process queued a job for the user in the meantime, the unique pending_user_id prevents a second
+            logger.info("Concurrent ingestion job queued for user %s", user_id)
+        with self.session_scope() as session:
+            return self._enqueue(session, user_id, priority=priority, before=before, incremental=incremental)
+
+    def _enqueue(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        session: Session,
+        user_id: str,
+        priority: int,
+        before: Optional[datetime],
+        incremental: bool,
+    ) -> StravaIngestionJob:
+        """Return the pending job of a user or queue a new one.
+
+        Args:
+            session: session of the unit of work
+            user_id: id of the user on strava
+            priority: priority of the job, lower values are leased first
+            before: end of the synced interval as naive datetime in utc, defaults to the current time
+            incremental: only sync activities after the watermark of the user, the whole history if False
+
+        Returns:
+            StravaIngestionJob
+        """
+        pending = session.scalars(
+            sa.select(IngestionJob).where(IngestionJob.pending_user_id == user_id).with_for_update(),
+        ).first()
+        if pending:
+            logger.info("User %s already has pending ingestion job %s", user_id, pending.id)
+            if not incremental and pending.after is not None:
+                self._restart_as_full(pending)
+            return _from_row(pending)
+
+        after = None
+        if incremental:
+            after = session.scalar(sa.select(User.synced_until).where(User.id == user_id))
+        return _from_row(self._add_job(session, user_id, priority=priority, before=before, after=after))
+
+    @staticmethod
+    def _restart_as_full(job: IngestionJob) -> None:
+        """Turn a pending incremental job into a full sync starting at the first page.
+
+        Pages of the incremental interval do not match the pages of the whole history, so the progress is reset.
+        A running job is queued again with its lease revoked, the checkpoint of its worker is rejected.
+
+        Args:
+            job: pending IngestionJob
+
+        Returns:
+            None
+        """
+        logger.info("Turning ingestion job %s into a full sync", job.id)
+        job.after = None
+        job.next_page = 1
+        job.activity_count = 0
+        job.status = JOB_QUEUED
+        job.leased_until = None
+        job.lease_token = None
+        job.updated_at = _utc_now()
+
+    @staticmethod
+    def _add_job(
+        session: Session,
+        user_id: str,
+        priority: int,
+        before: Optional[datetime] = None,
+        after: Optional[datetime] = None,
+    ) -> IngestionJob:
+        """Add a queued job to the session.
+
+        Args:
+            session: session to add the job to
+            user_id: id of the user on strava
+            priority: priority of the job, lower values are leased first
+            before: end of the synced interval as naive datetime in utc, defaults to the current time
+            after: start of the synced interval as naive datetime in utc, None for the whole history
+
+        Returns:
+            IngestionJob
+        """
+        now = _utc_now()
+        job = IngestionJob(
+            id=str(uuid.uuid4()),
+            user_id=user_id,
+            status=JOB_QUEUED,
+            priority=priority,
+            before=before or now,
+            after=after,
+            next_page=1,
+            activity_count=0,
+            attempts=0,
+            created_at=now,
+            updated_at=now,
+            pending_user_id=user_id,
+        )
+        session.add(job)
+        session.flush()
+        logger.info("Queued %s ingestion job %s for user %s", "incremental" if after else "full", job.id, user_id)
+        return job
+
+    def enqueue_reconciliations(self, reconciled_before: datetime, limit: int = 10) -> int:
+        """Queue full syncs for users whose last full sync ended before reconciled_before.
+
+        Users with a pending job are skipped, the least recently reconciled users go first.
+        If a job is queued for one of the users concurrently, the unique pending_user_id fails the whole batch
+        and the users are picked up by the next sweep.
+
+        Args:
+            reconciled_before: naive datetime in utc
+            limit: maximum number of jobs to queue
+
+        Returns:
+            number of queued jobs
+        """
+        with self.session_scope() as session:
+            pending = sa.select(IngestionJob.user_id).where(IngestionJob.status.in_((JOB_QUEUED, JOB_RUNNING)))
+            user_ids = session.scalars(
+                sa.select(User.id)
+                .where(sa.or_(User.reconciled_at.is_(None), User.reconciled_at < reconciled_before))
+                .where(User.id.not_in(pending))
+                .order_by(User.reconciled_at.is_not(None), User.reconciled_at)
+                .limit(limit),
+            ).all()
+            for user_id in user_ids:
+                self._add_job(session, user_id, priority=PRIORITY_RECONCILE)
+        return len(user_ids)
+
+    def lease(self, lease_seconds: int = 300) -> Optional[StravaIngestionJob]:
+        """Lease the next job to process.
+
+        Queued jobs and running jobs whose lease expired are eligible, so jobs of crashed workers are resumed.
+        Every lease gets a new token, writes passing the token of an earlier lease are rejected.
+
+        Args:
+            lease_seconds: seconds the job is reserved for the calling worker without a checkpoint or renewal
+
+        Returns:
+            StravaIngestionJob or None if no job is waiting
+        """
+        now = _utc_now()
+        with self.session_scope() as session:
+            job = session.scalars(
+                sa.select(IngestionJob)
+                .where(
+                    sa.or_(
+                        IngestionJob.status == JOB_QUEUED,
+                        sa.and_(IngestionJob.status == JOB_RUNNING, IngestionJob.leased_until < now),
+                    ),
+                )
+                .order_by(IngestionJob.priority, IngestionJob.created_at)
+                .limit(1)
+                .with_for_update(skip_locked=True),
+            ).first()
+            if job is None:
+                return None
+
+            job.status = JOB_RUNNING
+            job.attempts += 1
+            job.leased_until = now + timedelta(seconds=lease_seconds)
+            job.lease_token = str(uuid.uuid4())
+            job.updated_at = now
+            return _from_row(job)
+
+    def renew(self, job_id: str, lease_token: str, lease_seconds: int = 300) -> bool:
+        """Extend the lease of a job, called periodically while a worker waits without checkpointing.
+
+        Args:
+            job_id: id of the job
+            lease_token: token of the lease held by the calling worker
+            lease_seconds: seconds the job stays reserved for the calling worker
+
+        Returns:
+            True if the lease was extended, False if it was lost
+        """
+        now = _utc_now()
+        with self.session_scope() as session:
+            result = session.execute(
+                sa.update(IngestionJob)
+                .where(IngestionJob.id == job_id)
+                .where(IngestionJob.lease_token == lease_token)
+                .values(leased_until=now + timedelta(seconds=lease_seconds)),
+            )
+            return result.rowcount > 0
+
+    def checkpoint(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        job_id: str,
+        lease_token: str,
+        next_page: int,
+        activity_count: int,
+        latest_start_date: Optional[datetime] = None,
+        lease_seconds: int = 300,
+    ) -> None:
+        """Store the progress of a job and extend its lease.
+
+        Raises LeaseLostError if the lease was taken over, rolling back the unit of work the checkpoint is part of.
+
+        Args:
+            job_id: id of the job
+            lease_token: token of the lease held by the calling worker
+            next_page: next page to request
+            activity_count: number of activities ingested so far
+            latest_start_date: start_date of the latest activity ingested so far
+            lease_seconds: seconds the job stays reserved for the calling worker
+
+        Returns:
+            None
+        """
+        now = _utc_now()
+        with self.session_scope() as session:
+            result = session.execute(
+                sa.update(IngestionJob)
+                .where(IngestionJob.id == job_id)
+                .where(IngestionJob.lease_token == lease_token)
+                .values(
+                    next_page=next_page,
+                    activity_count=activity_count,
+                    latest_start_date=_to_naive_utc(latest_start_date),
+                    leased_until=now + timedelta(seconds=lease_seconds),
+                    updated_at=now,
+                ),
+            )
+            if result.rowcount == 0:
+                raise LeaseLostError(job_id)
+
+    def complete(self, job_id: str, lease_token: str) -> None:
+        """Mark a job as done and advance the sync watermark of its user.
+
+        A full sync also marks the user as reconciled up to the end of the synced interval.
+        The challenge totals of the user are recomputed from the ingested activities.
+        Raises LeaseLostError if the lease was taken over.
+
+        Args:
+            job_id: id of the job
+            lease_token: token of the lease held by the calling worker
+
+        Returns:
+            None
+        """
+        with self.session_scope() as session:
+            job = session.get(IngestionJob, job_id, with_for_update=True)
+            if job is None or job.lease_token != lease_token:
+                raise LeaseLostError(job_id)
+            job.status = JOB_DONE
+            job.error = None
+            job.leased_until = None
+            job.lease_token = None
+            job.pending_user_id = None
+            job.updated_at = _utc_now()
+            refresh_challenge_totals(session, [job.user_id])
+
+            user = session.get(User, job.user_id)
+            if user is None:
+                return
+            if job.latest_start_date and (user.synced_until is None or user.synced_until < job.latest_start_date):
+                user.synced_until = job.latest_start_date
+            if job.after is None:
+                user.reconciled_at = job.before
+
+    def fail(self, job_id: str, lease_token: str, error: str, max_attempts: int = 5) -> None:
+        """Record a failed attempt of a job.
+
+        The job is queued again from its last checkpoint until it failed max_attempts times.
+        A job given up recomputes the challenge totals of its user, so the pages ingested so far count.
+        Failures of a worker whose lease was taken over are ignored, the job belongs to another worker by now.
+
+        Args:
+            job_id: id of the job
+            lease_token: token of the lease held by the calling worker
+            error: description of the failure
+            max_attempts: number of attempts after which the job is given up
+
+        Returns:
+            None
+        """
+        with self.session_scope() as session:
+            job = session.get(IngestionJob, job_id, with_for_update=True)
+            if job is None or job.lease_token != lease_token:
+                logger.info("Ignoring failure of ingestion job %s, its lease was lost", job_id)
+                return
+            job.status = JOB_FAILED if job.attempts >= max_attempts else JOB_QUEUED
+            job.error = error
+            job.leased_until = None
+            job.lease_token = None
+            if job.status == JOB_FAILED:
+                job.pending_user_id = None
+                refresh_challenge_totals(session, [job.user_id])
+            job.updated_at = _utc_now()
+
+    def delete_user_jobs(self, user_id: str) -> None:
+        """Delete all jobs of a user.
+
+        Args:
+            user_id: id of the user on strava
+
+        Returns:
+            None
+        """
+        with self.session_scope() as session:
+            session.execute(sa.delete(IngestionJob).where(IngestionJob.user_id == user_id))
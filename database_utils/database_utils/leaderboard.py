@@ -0,0 +1,217 @@
+"""This module provides the LeaderboardEntry dataclass and the aggregation of activities into challenge totals.
+
+Every challenge definition is compiled into one INSERT ... SELECT grouping the matching activities by user.
+
+Totals per user and challenge are kept in the challenge_total table.
+They are recomputed for the affected users whenever their activities change,
+so reading a leaderboard never has to scan the activity table.
+Every change of the totals of a challenge bumps its version after commit, see database_utils.versions.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from database_utils.challenges import CHALLENGES, ChallengeDefinition, activity_conditions
+from database_utils.schema import Activity, ChallengeTotal, User
+from database_utils.versions import bump_versions_after_commit, challenge_version
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+
+@dataclass
+class LeaderboardEntry:
+    """Dataclass defining the totals of a user in a challenge."""
+
+    challenge: str
+    user_id: str
+    user_name: str
+    distance: float
+    moving_time: int
+    total_elevation_gain: float
+    activity_count: int
+    # aggregated metric of the challenge
+    score: float
+
+
+def _score(challenge: ChallengeDefinition) -> sa.ColumnElement:
+    """Build the expression aggregating the metric of a challenge per user.
+
+    Args:
+        challenge: ChallengeDefinition
+
+    Returns:
+        sa.ColumnElement
+    """
+    if challenge.metric == "activity_count":
+        return sa.func.count(Activity.id)
+    column = getattr(Activity, challenge.metric)
+    aggregation = {
+        "sum": sa.func.sum,
+        "max": sa.func.max,
+        "avg": sa.func.avg,
+        "count": sa.func.count,
+    }[challenge.aggregation]
+    return sa.func.coalesce(aggregation(column), 0)
+
+
+def _totals_query(challenge: ChallengeDefinition, user_ids: Optional[List[str]] = None) -> sa.Select:
+    """Build the query aggregating activities of a challenge per user.
+
+    Args:
+        challenge: ChallengeDefinition
+        user_ids: restrict the aggregation to these users, all users if None
+
+    Returns:
+        sa.Select with the columns of ChallengeTotal
+    """
+    query = sa.select(
+        sa.literal(challenge.name),
+        Activity.user_id,
+        sa.func.coalesce(sa.func.sum(Activity.distance), 0),
+        sa.func.coalesce(sa.func.sum(Activity.moving_time), 0),
+        sa.func.coalesce(sa.func.sum(Activity.total_elevation_gain), 0),
+        sa.func.count(Activity.id),
+        _score(challenge),
+    ).where(*activity_conditions(challenge))
+    if user_ids is not None:
+        query = query.where(Activity.user_id.in_(user_ids))
+    return query.group_by(Activity.user_id)
+
+
+def _apply_scoring(session: Session, challenge: ChallengeDefinition, user_ids: Optional[List[str]] = None) -> None:
+    """Overwrite the scores of users in a challenge with scoring rules by the scores of the scoring engine.
+
+    Args:
+        session: session to run the statements in
+        challenge: ChallengeDefinition with scoring rules
+        user_ids: users to update scores for, all users if None
+
+    Returns:
+        None
+    """
+    # numpy is only loaded once a challenge with scoring rules is refreshed, not with every import of the schema
+    from database_utils.scoring import score_challenge
+
+    scores = score_challenge(session, challenge, user_ids)
+    if not len(scores.user_ids):
+        return
+    set_score = (
+        sa.update(ChallengeTotal)
+        .where(ChallengeTotal.challenge == challenge.name, ChallengeTotal.user_id == sa.bindparam("total_user_id"))
+        .values(score=sa.bindparam("total_score"))
+    )
+    session.connection().execute(
+        set_score,
+        [
+            {"total_user_id": user_id, "total_score": scores.scores[index].item()}
+            for index, user_id in enumerate(scores.user_ids.tolist())
+        ],
+    )
+
+
+def refresh_challenge_totals(
+    session: Session,
+    user_ids: Optional[Iterable[str]] = None,
+    challenges: Optional[Iterable[ChallengeDefinition]] = None,
+) -> None:
+    """Recompute the challenge totals of users from their activities.
+
+    Runs one DELETE and one INSERT ... SELECT per challenge in the transaction of session
+    and bumps the versions of the recomputed challenges once it committed.
+    Scores of challenges with scoring rules are computed by the scoring engine afterwards.
+
+    Args:
+        session: session to run the statements in
+        user_ids: users to recompute totals for, all users if None
+        challenges: challenges to recompute, all challenges if None
+
+    Returns:
+        None
+    """
+    if user_ids is not None:
+        user_ids = list({user_id for user_id in user_ids if user_id is not None})
+        if not user_ids:
+            return
+    # make pending activity changes visible to the aggregation
+    session.flush()
+    challenges = list(challenges or CHALLENGES.values())
+    for challenge in challenges:
+        delete = sa.delete(ChallengeTotal).where(ChallengeTotal.challenge == challenge.name)
+        if user_ids is not None:
+            delete = delete.where(ChallengeTotal.user_id.in_(user_ids))
+        session.execute(delete)
+        session.execute(
+            sa.insert(ChallengeTotal).from_select(
+                [
+                    ChallengeTotal.challenge,
+                    ChallengeTotal.user_id,
+                    ChallengeTotal.distance,
+                    ChallengeTotal.moving_time,
+                    ChallengeTotal.total_elevation_gain,
+                    ChallengeTotal.activity_count,
+                    ChallengeTotal.score,
+                ],
+                _totals_query(challenge, user_ids),
+            ),
+        )
+        if challenge.scoring:
+            _apply_scoring(session, challenge, user_ids)
+    bump_versions_after_commit(session, [challenge_version(challenge.name) for challenge in challenges])
+
+
+def delete_user_totals(session: Session, user_id: str) -> None:
+    """Delete all challenge totals of a user and bump the versions of all challenges.
+
+    Must run after the activities of the user were deleted, the scores of percentile challenges are recomputed
+    from the activities of the remaining users.
+
+    Args:
+        session: session to run the statement in
+        user_id: id of the user on strava
+
+    Returns:
+        None
+    """
+    session.execute(sa.delete(ChallengeTotal).where(ChallengeTotal.user_id == user_id))
+    for challenge in CHALLENGES.values():
+        # percentiles of the remaining users change
+        if challenge.scoring and challenge.scoring.percentile:
+            _apply_scoring(session, challenge)
+    bump_versions_after_commit(session, [challenge_version(name) for name in CHALLENGES])
+
+
+def read_leaderboard(session: Session, challenge: str, limit: Optional[int] = None) -> List[LeaderboardEntry]:
+    """Read the leaderboard of a challenge ordered by score.
+
+    Args:
+        session: session to run the query in
+        challenge: name of the challenge
+        limit: maximum number of entries, all if None
+
+    Returns:
+        list of LeaderboardEntry
+    """
+    query = (
+        sa.select(ChallengeTotal, User.name)
+        .join(User, User.id == ChallengeTotal.user_id)
+        .where(ChallengeTotal.challenge == challenge)
+        .order_by(ChallengeTotal.score.desc(), ChallengeTotal.user_id)
+        .limit(limit)
+    )
+    return [
+        LeaderboardEntry(
+            challenge=total.challenge,
+            user_id=total.user_id,
+            user_name=user_name,
+            distance=total.distance,
+            moving_time=total.moving_time,
+            total_elevation_gain=total.total_elevation_gain,
+            activity_count=total.activity_count,
+            score=total.score,
+        )
+        for total, user_name in session.execute(query)
+    ]
@@ -0,0 +1,328 @@
+"""Module containing in place migrations for databases created with older revisions of the schema.
+
+Every migration inspects the database and only changes what is outdated, so running them again is a no-op.
+They run once per engine right after the schema is created.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from .challenges import CHALLENGES
+from .leaderboard import refresh_challenge_totals
+from .schema import Base, ChallengeState
+from .versions import bump_deferred_versions
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+# number of rows converted per round trip when rewriting column values
+BATCH_SIZE = 1000
+
+
+def _columns(engine: sa.Engine, table: str) -> dict:
+    """Reflect the columns of a table.
+
+    Args:
+        engine: sa.Engine
+        table: name of the table
+
+    Returns:
+        dict of column name -> reflected column information
+    """
+    return {column["name"]: column for column in sa.inspect(engine).get_columns(table)}
+
+
+def _is_mysql(engine: sa.Engine) -> bool:
+    """Check if the engine talks to MariaDB or MySQL.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        bool
+    """
+    return engine.dialect.name in ("mysql", "mariadb")
+
+
+def _parse_legacy_date(value: Optional[str]) -> Optional[datetime]:
+    """Parse a start_date stored as text by older revisions to a naive utc datetime.
+
+    Args:
+        value: text representation of the date, e.g. "2023-01-01 10:00:00+00:00"
+
+    Returns:
+        naive datetime in utc or None if value is empty
+    """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def activity_start_date_to_datetime(engine: sa.Engine) -> None:
+    """Convert activity.start_date from TEXT to a native DATETIME column.
+
+    Values are copied in batches into a new column, which then replaces the old one.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    columns = _columns(engine, "activity")
+    if isinstance(columns["start_date"]["type"], sa.DateTime):
+        return
+    logger.warning("Migrating activity.start_date to DATETIME")
+
+    datetime_type = sa.DateTime().compile(dialect=engine.dialect)
+    if "start_date_new" not in columns:
+        with engine.begin() as connection:
+            connection.execute(sa.text(f"ALTER TABLE activity ADD COLUMN start_date_new {datetime_type}"))
+
+    activity = sa.table("activity", sa.column("id"), sa.column("start_date"), sa.column("start_date_new"))
+    set_date = (
+        sa.update(activity)
+        .where(activity.c.id == sa.bindparam("activity_id"))
+        .values(start_date_new=sa.bindparam("new_date"))
+    )
+    last_id = ""
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                sa.select(activity.c.id, activity.c.start_date)
+                .where(activity.c.id > last_id)
+                .order_by(activity.c.id)
+                .limit(BATCH_SIZE),
+            ).all()
+            if not rows:
+                break
+            connection.execute(
+                set_date,
+                [{"activity_id": row.id, "new_date": _parse_legacy_date(row.start_date)} for row in rows],
+            )
+            last_id = rows[-1].id
+
+    with engine.begin() as connection:
+        connection.execute(sa.text("ALTER TABLE activity DROP COLUMN start_date"))
+        if _is_mysql(engine):
+            connection.execute(sa.text(f"ALTER TABLE activity CHANGE start_date_new start_date {datetime_type}"))
+        else:
+            connection.execute(sa.text("ALTER TABLE activity RENAME COLUMN start_date_new TO start_date"))
+
+
+def activity_sport_type_to_varchar(engine: sa.Engine) -> None:
+    """Convert activity.sport_type from TEXT to VARCHAR so MariaDB can index it.
+
+    SQLite indexes TEXT columns just fine, so nothing is changed there.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    if not _is_mysql(engine):
+        return
+    if not isinstance(_columns(engine, "activity")["sport_type"]["type"], sa.Text):
+        return
+    logger.warning("Migrating activity.sport_type to VARCHAR")
+    with engine.begin() as connection:
+        connection.execute(sa.text("ALTER TABLE activity MODIFY sport_type VARCHAR(64)"))
+
+
+def user_name_to_varchar(engine: sa.Engine) -> None:
+    """Convert user.name from TEXT to VARCHAR so MariaDB can index it.
+
+    SQLite indexes TEXT columns just fine, so nothing is changed there.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    if not _is_mysql(engine):
+        return
+    if not isinstance(_columns(engine, "user")["name"]["type"], sa.Text):
+        return
+    logger.warning("Migrating user.name to VARCHAR")
+    with engine.begin() as connection:
+        connection.execute(sa.text("ALTER TABLE `user` MODIFY name VARCHAR(255)"))
+
+
+def user_name_not_null(engine: sa.Engine) -> None:
+    """Replace NULL user names by "" and make user.name NOT NULL.
+
+    The keyset of the paginated user listing compares names, NULL names would drop users from it.
+    SQLite can not change the nullability of a column in place, there names are only replaced.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    user = sa.table("user", sa.column("name"))
+    with engine.begin() as connection:
+        cursor = connection.execute(sa.update(user).where(user.c.name.is_(None)).values(name=""))
+        if cursor.rowcount:
+            logger.warning("Replaced %s NULL user names", cursor.rowcount)
+    if _is_mysql(engine) and _columns(engine, "user")["name"]["nullable"]:
+        logger.warning("Migrating user.name to NOT NULL")
+        with engine.begin() as connection:
+            connection.execute(sa.text("ALTER TABLE `user` MODIFY name VARCHAR(255) NOT NULL DEFAULT ''"))
+
+
+def add_missing_columns(engine: sa.Engine) -> None:
+    """Add columns defined in the schema that do not exist in the database yet.
+
+    create_all skips tables which already exist, including their new columns.
+    Added columns are nullable, existing rows get NULL.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    preparer = engine.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        existing = _columns(engine, table.name)
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            logger.warning("Adding column %s.%s", table.name, column.name)
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.execute(
+                    sa.text(
+                        f"ALTER TABLE {preparer.quote(table.name)} "
+                        f"ADD COLUMN {preparer.quote(column.name)} {column_type}",
+                    ),
+                )
+
+
+def ingestion_job_pending_user_id(engine: sa.Engine) -> None:
+    """Set pending_user_id of queued and running jobs written by older revisions.
+
+    Has to run before the unique index on pending_user_id is created. Older revisions could queue two pending
+    jobs for a user, all but the oldest one are marked as failed.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    job = sa.table(
+        "ingestion_job",
+        sa.column("id"),
+        sa.column("user_id"),
+        sa.column("status"),
+        sa.column("error"),
+        sa.column("created_at"),
+        sa.column("pending_user_id"),
+    )
+    with engine.begin() as connection:
+        rows = connection.execute(
+            sa.select(job.c.id, job.c.user_id)
+            .where(job.c.status.in_(("queued", "running")))
+            .where(job.c.pending_user_id.is_(None))
+            .order_by(job.c.user_id, job.c.created_at),
+        ).all()
+        if not rows:
+            return
+        logger.warning("Setting ingestion_job.pending_user_id of %s pending jobs", len(rows))
+        pending_users = set(
+            connection.scalars(sa.select(job.c.pending_user_id).where(job.c.pending_user_id.is_not(None))),
+        )
+        for row in rows:
+            if row.user_id in pending_users:
+                connection.execute(
+                    sa.update(job).where(job.c.id == row.id).values(status="failed", error="duplicate pending job"),
+                )
+            else:
+                connection.execute(sa.update(job).where(job.c.id == row.id).values(pending_user_id=row.user_id))
+                pending_users.add(row.user_id)
+
+
+def create_missing_indexes(engine: sa.Engine) -> None:
+    """Create indexes defined in the schema that do not exist in the database yet.
+
+    create_all skips tables which already exist, including their indexes.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def populate_challenge_totals(engine: sa.Engine) -> None:
+    """Compute totals for challenges which are new or whose definition changed since their totals were computed.
+
+    This fills the challenge_total table for existing activities and for newly defined challenges.
+    The hash of every computed definition is recorded in challenge_state, so challenges matching no activities
+    are not recomputed on every start and edited definitions, e.g. of their sport types or window, are picked up.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    with Session(engine) as session:
+        with session.begin():
+            computed = dict(session.execute(sa.select(ChallengeState.challenge, ChallengeState.definition_hash)).all())
+            outdated = [
+                challenge for name, challenge in CHALLENGES.items() if computed.get(name) != challenge.definition_hash()
+            ]
+            if outdated:
+                logger.info("Computing totals for challenges: %s", [challenge.name for challenge in outdated])
+                refresh_challenge_totals(session, challenges=outdated)
+                computed_at = datetime.now(tz=timezone.utc).replace(tzinfo=None)
+                for challenge in outdated:
+                    session.merge(
+                        ChallengeState(
+                            challenge=challenge.name,
+                            definition_hash=challenge.definition_hash(),
+                            computed_at=computed_at,
+                        ),
+                    )
+        bump_deferred_versions(session)
+
+
+# migrations in the order they have to run
+MIGRATIONS: List[Callable[[sa.Engine], None]] = [
+    activity_start_date_to_datetime,
+    activity_sport_type_to_varchar,
+    user_name_to_varchar,
+    user_name_not_null,
+    add_missing_columns,
+    ingestion_job_pending_user_id,
+    create_missing_indexes,
+    populate_challenge_totals,
+]
+
+
+def upgrade(engine: sa.Engine) -> None:
+    """Bring the database behind engine up to date with the schema.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    for migration in MIGRATIONS:
+        migration(engine)
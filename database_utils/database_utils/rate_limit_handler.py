@@ -0,0 +1,153 @@
+"""This module provides the RateLimitHandler.
+
+RateLimitHandler keeps the usage of the strava api per rate limit window in the database,
+so every worker of every process draws from the same budget.
+Strava resets the 15 minute limit at every full quarter hour and the daily limit at midnight utc.
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database_utils import DatabaseConnector
+from database_utils.schema import RateLimitWindow
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+WINDOW_15_MIN = "15min"
+WINDOW_DAILY = "daily"
+# limits strava grants by default, they are updated with the limits reported in response headers
+DEFAULT_LIMITS = {WINDOW_15_MIN: 100, WINDOW_DAILY: 1000}
+
+
+def _utc_now() -> datetime:
+    """Get the current time as naive datetime in utc.
+
+    Returns:
+        datetime
+    """
+    return datetime.now(tz=timezone.utc).replace(tzinfo=None)
+
+
+def window_bounds(name: str, now: datetime) -> Tuple[datetime, datetime]:
+    """Get start and end of the rate limit window containing now.
+
+    Args:
+        name: name of the window, WINDOW_15_MIN or WINDOW_DAILY
+        now: naive datetime in utc
+
+    Returns:
+        start and end of the window as naive datetimes in utc
+    """
+    if name == WINDOW_15_MIN:
+        start = now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0)
+        return start, start + timedelta(minutes=15)
+    start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return start, start + timedelta(days=1)
+
+
+def create_rate_limit_windows(engine: sa.Engine) -> None:
+    """Create the rows tracking the rate limit windows if they do not exist yet.
+
+    Args:
+        engine: sa.Engine
+
+    Returns:
+        None
+    """
+    now = _utc_now()
+    for name, usage_limit in DEFAULT_LIMITS.items():
+        try:
+            with Session(engine) as session, session.begin():
+                if session.get(RateLimitWindow, name) is None:
+                    session.add(
+                        RateLimitWindow(
+                            name=name,
+                            window_start=window_bounds(name, now)[0],
+                            usage=0,
+                            usage_limit=usage_limit,
+                        ),
+                    )
+        except IntegrityError:
+            # another process created the row in the meantime
+            logger.info("Rate limit window %s already exists", name)
+
+
+class RateLimitHandler(DatabaseConnector):
+    """RateLimitHandler tracks and reserves the usage of the strava api in the database."""
+
+    def _connect(self) -> None:
+        """Attach to the shared engine and make sure the rate limit windows exist."""
+        super()._connect()
+        create_rate_limit_windows(self.engine)
+
+    @staticmethod
+    def _locked_windows(session: Session, now: datetime) -> Dict[str, RateLimitWindow]:
+        """Lock the rows of all rate limit windows and reset those belonging to a past window.
+
+        Args:
+            session: session to run the queries in
+            now: naive datetime in utc
+
+        Returns:
+            dict of window name -> RateLimitWindow
+        """
+        windows = {
+            window.name: window
+            for window in session.scalars(sa.select(RateLimitWindow).with_for_update().order_by(RateLimitWindow.name))
+        }
+        for window in windows.values():
+            start, _ = window_bounds(window.name, now)
+            if window.window_start < start:
+                window.window_start = start
+                window.usage = 0
+        return windows
+
+    def reserve(self, now: Optional[datetime] = None) -> Optional[datetime]:
+        """Reserve budget for one request in every rate limit window.
+
+        Args:
+            now: naive datetime in utc, defaults to the current time
+
+        Returns:
+            None if the request may be sent, otherwise the time at which budget is available again
+        """
+        now = now or _utc_now()
+        with self.session_scope() as session:
+            windows = self._locked_windows(session, now)
+            exhausted = [window for window in windows.values() if window.usage >= window.usage_limit]
+            if exhausted:
+                return max(window_bounds(window.name, now)[1] for window in exhausted)
+            for window in windows.values():
+                window.usage += 1
+        return None
+
+    def track(
+        self,
+        limits: Dict[str, int],
+        usages: Dict[str, int],
+        now: Optional[datetime] = None,
+    ) -> None:
+        """Store limits and usage reported by strava.
+
+        Usage is only ever raised, reservations of other workers that strava has not counted yet are kept.
+
+        Args:
+            limits: dict of window name -> limit reported by strava
+            usages: dict of window name -> usage reported by strava
+            now: naive datetime in utc, defaults to the current time
+
+        Returns:
+            None
+        """
+        now = now or _utc_now()
+        with self.session_scope() as session:
+            for name, window in self._locked_windows(session, now).items():
+                if name in limits:
+                    window.usage_limit = limits[name]
+                if name in usages:
+                    window.usage = max(window.usage, usages[name])
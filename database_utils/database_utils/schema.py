@@ -9,10 +9,20 @@ class User(Base):
     """User, identified by user id and name, containing encrypted refresh token for api access."""
 
     __tablename__ = "user"
+    __table_args__ = (
+        # the user listing is paginated by name and id and searched by name prefix
+        sa.Index("ix_user_name_id", "name", "id"),
+    )
 
     id = sa.Column(sa.String(36), primary_key=True)  # noqa: A003
-    name = sa.Column(sa.TEXT)
+    # NOT NULL so the keyset of the paginated user listing is total, users without a name get ""
+    name = sa.Column(sa.String(255), nullable=False, default="")
     refresh_token = sa.Column(sa.TEXT)
+    # start_date of the latest activity seen by a sync, incremental syncs only request newer activities
+    # naive datetimes in utc
+    synced_until = sa.Column(sa.DateTime)
+    # end of the last full sync, catching activities incremental syncs missed
+    reconciled_at = sa.Column(sa.DateTime)
 
     def __repr__(self) -> str:
         """Output string representation of User.
@@ -27,6 +37,11 @@ class Activity(Base):
     """Activity, identified by id, belonging to user."""
 
     __tablename__ = "activity"
+    __table_args__ = (
+        # per user history and per challenge time window queries
+        sa.Index("ix_activity_user_id_start_date", "user_id", "start_date"),
+        sa.Index("ix_activity_sport_type_start_date", "sport_type", "start_date"),
+    )
 
     id = sa.Column(sa.String(36), primary_key=True)  # noqa: A003
     user_id = sa.Column(sa.ForeignKey("user.id"))
@@ -35,8 +50,9 @@ class Activity(Base):
     moving_time = sa.Column(sa.INTEGER)
     elapsed_time = sa.Column(sa.INTEGER)
     total_elevation_gain = sa.Column(sa.FLOAT)
-    sport_type = sa.Column(sa.TEXT)
-    start_date = sa.Column(sa.TEXT)
+    sport_type = sa.Column(sa.String(64))
+    # naive datetime in utc
+    start_date = sa.Column(sa.DateTime)
 
     def __repr__(self) -> str:
         """Output string representation of Activity.
@@ -45,3 +61,139 @@ class Activity(Base):
             str
         """
         return f"ACTIVITY: {self.name}\tID: {self.id}\tDATE: {self.start_date}\tDISTANCE: {self.distance}"
+
+
+class ChallengeTotal(Base):
+    """Precomputed totals of a user in a challenge, identified by challenge name and user id."""
+
+    __tablename__ = "challenge_total"
+    __table_args__ = (
+        # leaderboards are read ordered by score
+        sa.Index("ix_challenge_total_challenge_score", "challenge", "score"),
+    )
+
+    challenge = sa.Column(sa.String(64), primary_key=True)
+    user_id = sa.Column(sa.ForeignKey("user.id"), primary_key=True)
+    distance = sa.Column(sa.FLOAT)
+    moving_time = sa.Column(sa.INTEGER)
+    total_elevation_gain = sa.Column(sa.FLOAT)
+    activity_count = sa.Column(sa.INTEGER)
+    # metric of the challenge aggregated as defined by the challenge
+    score = sa.Column(sa.FLOAT)
+
+    def __repr__(self) -> str:
+        """Output string representation of ChallengeTotal.
+
+        Returns:
+            str
+        """
+        return f"CHALLENGE: {self.challenge}\tUSER: {self.user_id}\tSCORE: {self.score}"
+
+
+class ChallengeState(Base):
+    """Hash of the definition the totals of a challenge were last computed with, identified by challenge name."""
+
+    __tablename__ = "challenge_state"
+
+    challenge = sa.Column(sa.String(64), primary_key=True)
+    # see ChallengeDefinition.definition_hash
+    definition_hash = sa.Column(sa.String(64), nullable=False)
+    # naive datetime in utc
+    computed_at = sa.Column(sa.DateTime)
+
+    def __repr__(self) -> str:
+        """Output string representation of ChallengeState.
+
+        Returns:
+            str
+        """
+        return f"CHALLENGE STATE: {self.challenge}\tHASH: {self.definition_hash}\tCOMPUTED AT: {self.computed_at}"
+
+
+class RateLimitWindow(Base):
+    """Usage of the strava api in a rate limit window, shared by all workers."""
+
+    __tablename__ = "rate_limit_window"
+
+    # "15min" or "daily"
+    name = sa.Column(sa.String(16), primary_key=True)
+    # naive datetime in utc
+    window_start = sa.Column(sa.DateTime, nullable=False)
+    usage = sa.Column(sa.INTEGER, nullable=False, default=0)
+    usage_limit = sa.Column(sa.INTEGER, nullable=False)
+
+    def __repr__(self) -> str:
+        """Output string representation of RateLimitWindow.
+
+        Returns:
+            str
+        """
+        return f"RATE LIMIT: {self.name}\tSTART: {self.window_start}\tUSAGE: {self.usage}/{self.usage_limit}"
+
+
+class IngestionJob(Base):
+    """Job syncing the activity history of a user from strava, processed by the workers of the ingestion service."""
+
+    __tablename__ = "ingestion_job"
+    __table_args__ = (
+        # workers lease the oldest job of the highest priority
+        sa.Index("ix_ingestion_job_status_priority_created_at", "status", "priority", "created_at"),
+        sa.Index("ix_ingestion_job_user_id_status", "user_id", "status"),
+        # a user has at most one queued or running job, concurrent enqueues fail on this index
+        sa.Index("ux_ingestion_job_pending_user_id", "pending_user_id", unique=True),
+    )
+
+    id = sa.Column(sa.String(36), primary_key=True)  # noqa: A003
+    user_id = sa.Column(sa.ForeignKey("user.id"), nullable=False)
+    # "queued", "running", "done" or "failed"
+    status = sa.Column(sa.String(16), nullable=False)
+    priority = sa.Column(sa.INTEGER, nullable=False, default=1)
+    # end of the synced interval, fixed at creation so pages stay stable across restarts, naive datetime in utc
+    before = sa.Column(sa.DateTime)
+    # start of the synced interval, None for a full sync of the history
+    after = sa.Column(sa.DateTime)
+    # next page to request, progress is checkpointed after every page
+    next_page = sa.Column(sa.INTEGER, nullable=False, default=1)
+    activity_count = sa.Column(sa.INTEGER, nullable=False, default=0)
+    # start_date of the latest activity ingested so far, naive datetime in utc
+    latest_start_date = sa.Column(sa.DateTime)
+    attempts = sa.Column(sa.INTEGER, nullable=False, default=0)
+    error = sa.Column(sa.TEXT)
+    # naive datetimes in utc
+    created_at = sa.Column(sa.DateTime, nullable=False)
+    updated_at = sa.Column(sa.DateTime, nullable=False)
+    # a running job whose lease expired is picked up by another worker
+    leased_until = sa.Column(sa.DateTime)
+    # issued with every lease, writes of workers holding an older lease are rejected
+    lease_token = sa.Column(sa.String(36))
+    # id of the user while the job is queued or running, NULL once it is done or failed
+    pending_user_id = sa.Column(sa.String(36))
+
+    def __repr__(self) -> str:
+        """Output string representation of IngestionJob.
+
+        Returns:
+            str
+        """
+        return f"INGESTION JOB: {self.id}\tUSER: {self.user_id}\tSTATUS: {self.status}\tPAGE: {self.next_page}"
+
+
+class DataVersion(Base):
+    """Version counter of a part of the data, bumped in every transaction changing it.
+
+    Processes caching data derived from the database compare versions to detect stale entries.
+    """
+
+    __tablename__ = "data_version"
+
+    # e.g. "challenge:bike" or "users"
+    name = sa.Column(sa.String(128), primary_key=True)
+    version = sa.Column(sa.INTEGER, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        """Output string representation of DataVersion.
+
+        Returns:
+            str
+        """
+        return f"DATA VERSION: {self.name}\tVERSION: {self.version}"
@@ -0,0 +1,163 @@
+"""This module provides the scoring engine for challenges with ScoringRules.
+
+The activities counting towards a challenge are loaded once into columnar numpy arrays,
+the scores of all users are then evaluated with vectorized operations instead of iterating over activities.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from database_utils.challenges import ChallengeDefinition, ScoringRules, activity_conditions
+from database_utils.schema import Activity
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+
+@dataclass
+class ActivityColumns:
+    """Dataclass holding the activities of a challenge as columns, one element per activity."""
+
+    # distinct user ids, user_index points into it
+    user_ids: np.ndarray
+    user_index: np.ndarray
+    # ordinal of the day in utc, consecutive days differ by 1
+    day: np.ndarray
+    # distinct sport types, sport_index points into it
+    sport_types: np.ndarray
+    sport_index: np.ndarray
+    metric: np.ndarray
+    elevation: np.ndarray
+
+    def __len__(self) -> int:
+        """Number of activities.
+
+        Returns:
+            int
+        """
+        return len(self.user_index)
+
+
+@dataclass
+class Scores:
+    """Dataclass holding the scores of users in a challenge."""
+
+    user_ids: np.ndarray
+    scores: np.ndarray
+
+
+def load_activity_columns(
+    session: Session,
+    challenge: ChallengeDefinition,
+    user_ids: Optional[Iterable[str]] = None,
+) -> ActivityColumns:
+    """Load the activities counting towards a challenge into columnar arrays with one query.
+
+    Args:
+        session: session to run the query in
+        challenge: ChallengeDefinition
+        user_ids: only activities of these users, all users if None
+
+    Returns:
+        ActivityColumns
+    """
+    metric = sa.literal(1) if challenge.metric == "activity_count" else getattr(Activity, challenge.metric)
+    query = sa.select(
+        Activity.user_id,
+        Activity.start_date,
+        Activity.sport_type,
+        sa.func.coalesce(metric, 0),
+        sa.func.coalesce(Activity.total_elevation_gain, 0),
+    ).where(Activity.start_date.is_not(None), *activity_conditions(challenge))
+    if user_ids is not None:
+        query = query.where(Activity.user_id.in_(list(user_ids)))
+    rows = session.execute(query).all()
+    if not rows:
+        empty = np.array([], dtype=np.int64)
+        return ActivityColumns(
+            user_ids=np.array([], dtype=str),
+            user_index=empty,
+            day=empty,
+            sport_types=np.array([], dtype=str),
+            sport_index=empty,
+            metric=np.array([], dtype=np.float64),
+            elevation=np.array([], dtype=np.float64),
+        )
+
+    # numpy converts lists of plain values much faster than rows
+    distinct_users, user_index = np.unique(np.array([row[0] for row in rows], dtype=str), return_inverse=True)
+    distinct_sports, sport_index = np.unique(np.array([row[2] for row in rows], dtype=str), return_inverse=True)
+    return ActivityColumns(
+        user_ids=distinct_users,
+        user_index=user_index,
+        day=np.array([row[1].toordinal() for row in rows], dtype=np.int64),
+        sport_types=distinct_sports,
+        sport_index=sport_index,
+        metric=np.array([row[3] for row in rows], dtype=np.float64),
+        elevation=np.array([row[4] for row in rows], dtype=np.float64),
+    )
+
+
+def evaluate(columns: ActivityColumns, rules: ScoringRules) -> Scores:
+    """Evaluate the scores of all users in columns.
+
+    Args:
+        columns: ActivityColumns
+        rules: ScoringRules
+
+    Returns:
+        Scores of every user with activities in columns
+    """
+    if not len(columns):
+        return Scores(user_ids=columns.user_ids, scores=np.array([], dtype=np.float64))
+
+    # points of every activity
+    sport_weights = dict(rules.sport_weights)
+    weights = np.array([sport_weights.get(sport, rules.default_weight) for sport in columns.sport_types])
+    points = columns.metric * weights[columns.sport_index] + columns.elevation * rules.elevation_bonus
+
+    user_count = len(columns.user_ids)
+    if rules.daily_cap is None:
+        scores = np.bincount(columns.user_index, weights=points, minlength=user_count)
+    else:
+        # sum points per user and day, cap them, then sum per user
+        first_day = columns.day.min()
+        day_count = int(columns.day.max() - first_day) + 1
+        user_day = columns.user_index * day_count + (columns.day - first_day)
+        user_days, user_day_index = np.unique(user_day, return_inverse=True)
+        daily = np.minimum(np.bincount(user_day_index, weights=points), rules.daily_cap)
+        scores = np.bincount(user_days // day_count, weights=daily, minlength=user_count)
+
+    if rules.percentile:
+        # share of users scoring the same or less
+        scores = np.searchsorted(np.sort(scores), scores, side="right") / user_count * 100
+    return Scores(user_ids=columns.user_ids, scores=scores)
+
+
+def score_challenge(
+    session: Session,
+    challenge: ChallengeDefinition,
+    user_ids: Optional[Iterable[str]] = None,
+) -> Scores:
+    """Compute the scores of users in a challenge with ScoringRules.
+
+    Percentile scores depend on all users, so they are always computed for all users.
+
+    Args:
+        session: session to run the query in
+        challenge: ChallengeDefinition with scoring rules
+        user_ids: users to compute scores for, all users if None
+
+    Returns:
+        Scores
+    """
+    if challenge.scoring.percentile:
+        user_ids = None
+    columns = load_activity_columns(session, challenge, user_ids)
+    scores = evaluate(columns, challenge.scoring)
+    logger.info("Scored %s users, %s activities in challenge %s", len(scores.user_ids), len(columns), challenge.name)
+    return scores
@@ -0,0 +1,160 @@
+"""This module provides the TokenCipher, encrypting refresh tokens for storage in the database.
+
+flet.security derives a key from the secret with PBKDF2 on every call, so every token costs a full key derivation.
+TokenCipher derives the key of every key version once per process and encrypts with AES-GCM,
+which brings encrypting and decrypting a token down to microseconds.
+
+Tokens are stored as "v<version>$<urlsafe base64 of nonce and ciphertext>".
+Tokens without prefix were written by flet.security and count as version 0, they are decrypted with flet.
+Keys are rotated by adding a new version: tokens of older versions stay readable as long as their key is configured
+and are re-encrypted with the current version on their next write or by StravaUserHandler.reencrypt_tokens.
+"""
+import base64
+import secrets
+import threading
+from typing import Dict, Optional
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from flet.security import decrypt as legacy_decrypt
+
+# version of tokens written by flet.security, they carry no prefix
+LEGACY_VERSION = 0
+PREFIX_SEPARATOR = "$"
+NONCE_SIZE = 12
+KDF_ITERATIONS = 600_000
+
+
+class UnknownKeyVersionError(LookupError):
+    """A token was encrypted with a key version which is not configured."""
+
+    def __init__(self, version: int) -> None:
+        """Init of UnknownKeyVersionError Exception.
+
+        Args:
+            version: key version of the token
+        """
+        super().__init__(f"No key configured for token key version: {version}")
+
+
+def token_version(token: str) -> int:
+    """Get the key version a token was encrypted with.
+
+    Args:
+        token: encrypted token
+
+    Returns:
+        key version, LEGACY_VERSION for tokens written by flet.security
+    """
+    prefix, separator, _ = token.partition(PREFIX_SEPARATOR)
+    if not separator or not prefix.startswith("v") or not prefix[1:].isdigit():
+        return LEGACY_VERSION
+    return int(prefix[1:])
+
+
+def _derive_key(secret_key: str, version: int) -> bytes:
+    """Derive the AES key of a key version from a secret.
+
+    The salt is fixed per version: the key has to be derived again by every process from the secret alone,
+    and the secret is a random server secret, not a password that needs protection against precomputed tables.
+
+    Args:
+        secret_key: secret of the key version
+        version: key version
+
+    Returns:
+        32 byte key
+    """
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=f"metriker-token-v{version}".encode(),
+        iterations=KDF_ITERATIONS,
+    )
+    return kdf.derive(secret_key.encode())
+
+
+class TokenCipher:
+    """Thread safe cipher for refresh tokens, supporting several key versions."""
+
+    def __init__(self, keys: Dict[int, str], version: int) -> None:
+        """Thread safe cipher for refresh tokens, supporting several key versions.
+
+        Args:
+            keys: secrets by key version, version 0 is the secret tokens written by flet.security were encrypted with
+            version: key version new tokens are encrypted with, must be greater than 0
+        """
+        if version == LEGACY_VERSION or version not in keys:
+            raise UnknownKeyVersionError(version)
+        self.keys = keys
+        self.version = version
+        # derived keys by version, every key is derived on first use
+        self._ciphers: Dict[int, AESGCM] = {}
+        self._lock = threading.Lock()
+
+    def _cipher(self, version: int) -> AESGCM:
+        """Get the cipher of a key version, deriving its key once.
+
+        Args:
+            version: key version
+
+        Returns:
+            AESGCM
+        """
+        cipher = self._ciphers.get(version)
+        if cipher is None:
+            if version not in self.keys:
+                raise UnknownKeyVersionError(version)
+            with self._lock:
+                cipher = self._ciphers.get(version)
+                if cipher is None:
+                    cipher = AESGCM(_derive_key(self.keys[version], version))
+                    self._ciphers[version] = cipher
+        return cipher
+
+    def encrypt(self, plaintext: Optional[str]) -> Optional[str]:
+        """Encrypt a token with the current key version.
+
+        Args:
+            plaintext: token
+
+        Returns:
+            encrypted token, None if plaintext is None
+        """
+        if plaintext is None:
+            return None
+        nonce = secrets.token_bytes(NONCE_SIZE)
+        ciphertext = self._cipher(self.version).encrypt(nonce, plaintext.encode(), None)
+        encoded = base64.urlsafe_b64encode(nonce + ciphertext).decode()
+        return f"v{self.version}{PREFIX_SEPARATOR}{encoded}"
+
+    def decrypt(self, token: Optional[str]) -> Optional[str]:
+        """Decrypt a token of any configured key version.
+
+        Args:
+            token: encrypted token
+
+        Returns:
+            token, None if token is None
+        """
+        if token is None:
+            return None
+        version = token_version(token)
+        if version == LEGACY_VERSION:
+            if version not in self.keys:
+                raise UnknownKeyVersionError(version)
+            return legacy_decrypt(token, self.keys[version])
+        data = base64.urlsafe_b64decode(token.partition(PREFIX_SEPARATOR)[2])
+        return self._cipher(version).decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], None).decode()
+
+    def needs_reencryption(self, token: Optional[str]) -> bool:
+        """Check if a token was encrypted with another key version than the current one.
+
+        Args:
+            token: encrypted token
+
+        Returns:
+            bool
+        """
+        return token is not None and token_version(token) != self.version
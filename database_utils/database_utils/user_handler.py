@@ -1,29 +1,165 @@
 """This module provides the StravaUser dataclass and the StravaUserHandler.
 
 StravaUser defines how a user we receive from strava is modeled on our side.
+Users read from the database carry the encrypted refresh token, it is decrypted on first access only.
+Refresh tokens are encrypted with a TokenCipher, see database_utils.token_cipher.
 StravaUserHandler wraps basic data interactions regarding users.
+Users are cached in process, writes through the handler invalidate the cache.
 """
+from __future__ import annotations
+
 import logging
+import threading
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, List, Optional
 
-from flet.security import decrypt, encrypt
+import sqlalchemy as sa
 
 from database_utils import DatabaseConnector
+from database_utils.cache import TTLCache
 from database_utils.schema import User
+from database_utils.token_cipher import LEGACY_VERSION, PREFIX_SEPARATOR, TokenCipher
+from database_utils.versions import USERS_VERSION, bump_versions
 
 logger = logging.getLogger(__name__)
 logger.info(__name__)
 
 
-@dataclass
+class _LazyRefreshToken:
+    """Refresh token decrypted on first access, shared by all copies of a StravaUser."""
+
+    def __init__(
+        self,
+        plaintext: Optional[str] = None,
+        ciphertext: Optional[str] = None,
+        cipher: Optional[TokenCipher] = None,
+    ) -> None:
+        """Refresh token decrypted on first access.
+
+        Args:
+            plaintext: decrypted refresh token, if known
+            ciphertext: encrypted refresh token as stored in the database
+            cipher: TokenCipher to decrypt ciphertext
+        """
+        self.plaintext = plaintext
+        self.ciphertext = ciphertext
+        self.cipher = cipher
+        self._lock = threading.Lock()
+
+    def value(self) -> Optional[str]:
+        """Return the decrypted refresh token, decrypting it once.
+
+        Returns:
+            refresh token
+        """
+        if self.plaintext is None and self.ciphertext is not None:
+            with self._lock:
+                if self.plaintext is None:
+                    self.plaintext = self.cipher.decrypt(self.ciphertext)
+        return self.plaintext
+
+
+@dataclass(init=False)
 class StravaUser:
-    """Dataclass defining how we model a user pulled from strava."""
+    """Dataclass defining how we model a user pulled from strava.
+
+    The refresh token is not part of repr and comparisons.
+    """
 
     # we are shadowing names from the db so this is okayish here
     id: str  # noqa: A003
     name: str
-    refresh_token: str
+
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        id: str,  # noqa: A002
+        name: str,
+        refresh_token: Optional[str] = None,
+        encrypted_refresh_token: Optional[str] = None,
+        cipher: Optional[TokenCipher] = None,
+    ) -> None:
+        """Init of StravaUser.
+
+        Pass either the refresh token or the encrypted refresh token together with the cipher to decrypt it.
+
+        Args:
+            id: id of the user on strava
+            name: first name of the user
+            refresh_token: decrypted refresh token
+            encrypted_refresh_token: refresh token as stored in the database
+            cipher: TokenCipher to decrypt encrypted_refresh_token
+        """
+        self.id = id
+        self.name = name
+        self._refresh_token = _LazyRefreshToken(
+            plaintext=refresh_token,
+            ciphertext=None if refresh_token is not None else encrypted_refresh_token,
+            cipher=cipher,
+        )
+
+    @property
+    def refresh_token(self) -> Optional[str]:
+        """Refresh token of the user, decrypted on first access.
+
+        Returns:
+            refresh token
+        """
+        return self._refresh_token.value()
+
+    @refresh_token.setter
+    def refresh_token(self, refresh_token: str) -> None:
+        """Replace the refresh token of the user.
+
+        Args:
+            refresh_token: decrypted refresh token
+
+        Returns:
+            None
+        """
+        self._refresh_token = _LazyRefreshToken(plaintext=refresh_token)
+
+    @property
+    def encrypted_refresh_token(self) -> Optional[str]:
+        """Refresh token as read from the database, None if it was set in plaintext since.
+
+        Returns:
+            encrypted refresh token or None
+        """
+        return self._refresh_token.ciphertext
+
+    def copy(self) -> StravaUser:
+        """Copy the user, the copy shares the decrypted refresh token until either refresh token is replaced.
+
+        Returns:
+            StravaUser
+        """
+        user = StravaUser(id=self.id, name=self.name)
+        user._refresh_token = self._refresh_token  # noqa: SLF001 - Ignore: private member of the same class
+        return user
+
+
+@dataclass(frozen=True)
+class StravaUserSummary:
+    """Dataclass holding the public information of a user, without their refresh token."""
+
+    # we are shadowing names from the db so this is okayish here
+    id: str  # noqa: A003
+    name: str
+
+
+class MissingLegacyKeyError(ValueError):
+    """Tokens written by flet.security are left, but the secret key they were encrypted with is not configured."""
+
+    def __init__(self, count: int) -> None:
+        """Init of MissingLegacyKeyError Exception.
+
+        Args:
+            count: number of tokens written by flet.security
+        """
+        super().__init__(
+            f"{count} refresh tokens were written by flet.security, pass their secret key as previous secret key "
+            f"of version {LEGACY_VERSION} until reencrypt_tokens has finished",
+        )
 
 
 class StravaUserHandler(DatabaseConnector):
@@ -37,6 +173,13 @@ class StravaUserHandler(DatabaseConnector):
         host: str = None,
         port: str = None,
         database: str = None,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_recycle: int = 3600,
+        cache_ttl: float = 60.0,
+        cache_size: int = 1024,
+        secret_key_version: int = 1,
+        previous_secret_keys: Optional[Dict[int, str]] = None,
     ) -> None:
         """Init of StravaUserHandler.
 
@@ -47,9 +190,53 @@ class StravaUserHandler(DatabaseConnector):
             host: host url
             port: service port
             database: name of the target data.
+            pool_size: number of connections kept open in the shared pool
+            max_overflow: number of connections allowed on top of pool_size under load
+            pool_recycle: seconds after which a pooled connection is replaced
+            cache_ttl: seconds users are served from the cache, 0 disables the cache
+            cache_size: maximum number of cached users
+            secret_key_version: key version of secret_key, increase it when rotating the secret key
+            previous_secret_keys: secret keys of older key versions still needed to decrypt tokens,
+                version 0 is the key of tokens written by flet.security, it defaults to secret_key
+                while secret_key_version is 1. After a rotation it is required as long as such tokens are left,
+                MissingLegacyKeyError is raised otherwise.
         """
-        super().__init__(user=user, password=password, host=host, port=port, database=database)
+        super().__init__(
+            user=user,
+            password=password,
+            host=host,
+            port=port,
+            database=database,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_recycle=pool_recycle,
+        )
         self.secret_key = secret_key
+        keys = {**(previous_secret_keys or {}), secret_key_version: secret_key}
+        if secret_key_version == 1:
+            # the first version kept the secret key of flet.security
+            keys.setdefault(LEGACY_VERSION, secret_key)
+        elif LEGACY_VERSION not in keys:
+            # decrypting with the rotated key would break every token written by flet.security
+            legacy_tokens = self._count_legacy_tokens()
+            if legacy_tokens:
+                raise MissingLegacyKeyError(legacy_tokens)
+        self.cipher = TokenCipher(keys=keys, version=secret_key_version)
+        # decrypted users by id
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    def _count_legacy_tokens(self) -> int:
+        """Count the refresh tokens written by flet.security, they carry no key version prefix.
+
+        Returns:
+            number of tokens
+        """
+        with self.session_scope() as session:
+            return session.scalar(
+                sa.select(sa.func.count())
+                .select_from(User)
+                .where(User.refresh_token.is_not(None), User.refresh_token.not_like(f"v%{PREFIX_SEPARATOR}%")),
+            )
 
     def __getitem__(self, key: str) -> StravaUser:
         """Get user by key from data.
@@ -67,6 +254,37 @@ class StravaUserHandler(DatabaseConnector):
             raise KeyError
         return user
 
+    def _from_row(self, user: User) -> StravaUser:
+        """Convert a row of the user table into a StravaUser carrying the encrypted refresh token.
+
+        Args:
+            user: User
+
+        Returns:
+            StravaUser
+        """
+        return StravaUser(
+            id=user.id,
+            name=user.name,
+            encrypted_refresh_token=user.refresh_token,
+            cipher=self.cipher,
+        )
+
+    def _encrypted_refresh_token(self, user: StravaUser) -> str:
+        """Get the refresh token of a user encrypted for storage, reusing the ciphertext read from the database.
+
+        Ciphertexts of older key versions are re-encrypted with the current one.
+
+        Args:
+            user: StravaUser
+
+        Returns:
+            encrypted refresh token
+        """
+        if user.encrypted_refresh_token and not self.cipher.needs_reencryption(user.encrypted_refresh_token):
+            return user.encrypted_refresh_token
+        return self.cipher.encrypt(user.refresh_token)
+
     def get(self, user_id: str) -> (None, StravaUser):
         """Get user by user_id from data.
 
@@ -78,10 +296,18 @@ class StravaUserHandler(DatabaseConnector):
         Returns:
             StravaUser or None when user with given id is not available
         """
+        cached = self._cache.get(user_id)
+        if cached:
+            # callers may modify the user before passing it to update, so they get a copy
+            return cached.copy()
+
         logger.info("Get user: %s", user_id)
-        user = self.session.query(User).filter(User.id == user_id).first()
-        if user:
-            return StravaUser(id=user.id, name=user.name, refresh_token=decrypt(user.refresh_token, self.secret_key))
+        with self.session_scope() as session:
+            user = session.query(User).filter(User.id == user_id).first()
+            if user:
+                strava_user = self._from_row(user)
+                self._cache.set(user_id, strava_user)
+                return strava_user.copy()
         return None
 
     def add(self, user: StravaUser) -> None:
@@ -94,8 +320,9 @@ class StravaUserHandler(DatabaseConnector):
             None
         """
         logger.info("Add user: %s", user.id)
-        new_user = User(id=user.id, name=user.name, refresh_token=encrypt(user.refresh_token, self.secret_key))
+        new_user = User(id=user.id, name=user.name or "", refresh_token=self._encrypted_refresh_token(user))
         self.insert(new_user)
+        self._cache.invalidate(user.id)
 
     def update(self, user: StravaUser) -> None:
         """Update existing StravaUser in data.
@@ -107,14 +334,18 @@ class StravaUserHandler(DatabaseConnector):
             None
         """
         logger.info("Update user: %s", user.id)
-        self.session.query(User).filter(User.id == user.id).update(
-            {
-                User.id: user.id,
-                User.name: user.name,
-                User.refresh_token: encrypt(user.refresh_token, self.secret_key),
-            },
-        )
-        self.session.commit()
+        with self.session_scope() as session:
+            # leaderboards show user names, refreshed tokens alone do not invalidate them
+            if session.scalar(sa.select(User.name).where(User.id == user.id)) != (user.name or ""):
+                bump_versions(session, [USERS_VERSION])
+            session.query(User).filter(User.id == user.id).update(
+                {
+                    User.id: user.id,
+                    User.name: user.name or "",
+                    User.refresh_token: self._encrypted_refresh_token(user),
+                },
+            )
+        self._cache.invalidate(user.id)
 
     def delete(self, user_id: str) -> None:
         """Delete existing StravaUser from data.
@@ -126,25 +357,95 @@ class StravaUserHandler(DatabaseConnector):
             None
         """
         logger.info("Delete user: %s", user_id)
-        user = self.session.query(User).filter(User.id == user_id).first()
-        self.session.delete(user)
-        self.session.commit()
+        with self.session_scope() as session:
+            session.execute(sa.delete(User).where(User.id == user_id))
+            bump_versions(session, [USERS_VERSION])
+        self._cache.invalidate(user_id)
+
+    def page_summaries(
+        self,
+        limit: int = 50,
+        search: Optional[str] = None,
+        after: Optional[StravaUserSummary] = None,
+    ) -> List[StravaUserSummary]:
+        """Return one page of the user listing ordered by name and id, without decrypting refresh tokens.
+
+        Pages are selected by keyset: the next page starts after the last user of the previous one,
+        so every page is a range scan on the index of name and id, no matter how deep the listing goes.
+
+        Args:
+            limit: maximum number of users on the page
+            search: only users whose name starts with search, case insensitive for the default collations
+            after: last user of the previous page, None for the first page
+
+        Returns:
+            List of StravaUserSummary objects.
+        """
+        query = sa.select(User.id, User.name).order_by(User.name, User.id).limit(limit)
+        if search:
+            escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            query = query.where(User.name.like(f"{escaped}%", escape="\\"))
+        if after is not None:
+            query = query.where(
+                sa.or_(User.name > after.name, sa.and_(User.name == after.name, User.id > after.id)),
+            )
+        with self.session_scope() as session:
+            return [StravaUserSummary(id=user_id, name=name) for user_id, name in session.execute(query)]
+
+    def __contains__(self, user_id: str) -> bool:
+        """Check if a user is stored in the database.
 
-    def keys(self) -> List[str]:
-        """Return a list containing all ids of users stored in the database.
+        Args:
+            user_id: id of the user on strava
 
         Returns:
-            List of strings.
+            bool
         """
-        return [obj.id for obj in self.session.query(User.id).all()]
+        # a lookup by primary key, served from the cache of users, instead of listing all users
+        return self.get(user_id) is not None
 
     def values(self) -> List[StravaUser]:
         """Returns a list of StravaUser objects for all users stored in the database.
 
+        Refresh tokens are decrypted on first access only.
+
         Returns:
             List of StravaUser objects.
         """
-        return [
-            StravaUser(id=obj.id, name=obj.name, refresh_token=decrypt(obj.refresh_token, self.secret_key))
-            for obj in self.session.query(User).all()
-        ]
+        with self.session_scope() as session:
+            return [self._from_row(obj) for obj in session.query(User).all()]
+
+    def reencrypt_tokens(self, batch_size: int = 100) -> int:
+        """Re-encrypt refresh tokens of older key versions with the current key version.
+
+        Users are processed in batches by id, every batch in its own short transaction, so this can run
+        while the services are serving requests. A row is only rewritten if its token did not change since
+        it was read, tokens refreshed meanwhile are already encrypted with the current version.
+
+        Args:
+            batch_size: number of users read per transaction
+
+        Returns:
+            number of re-encrypted tokens
+        """
+        reencrypted = 0
+        last_id = ""
+        while True:
+            with self.session_scope() as session:
+                rows = session.execute(
+                    sa.select(User.id, User.refresh_token).where(User.id > last_id).order_by(User.id).limit(batch_size),
+                ).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                for user_id, token in rows:
+                    if not self.cipher.needs_reencryption(token):
+                        continue
+                    reencrypted += session.execute(
+                        sa.update(User)
+                        .where(User.id == user_id, User.refresh_token == token)
+                        .values(refresh_token=self.cipher.encrypt(self.cipher.decrypt(token))),
+                    ).rowcount
+                    self._cache.invalidate(user_id)
+        logger.info("Re-encrypted %s refresh tokens", reencrypted)
+        return reencrypted
@@ -0,0 +1,259 @@
+"""This module provides the UserStats dataclass and the aggregation of the activities of a user into statistics.
+
+Totals per week and month, personal bests and streaks are computed by grouped queries on the activity table,
+which only touch the activities of one user thanks to the index on user_id and start_date.
+Weeks start on monday, days, weeks and months are in utc.
+"""
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple, Union
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from database_utils.schema import Activity
+from database_utils.versions import UnsupportedDialectError
+
+
+@dataclass
+class PeriodTotal:
+    """Dataclass defining the totals of a user for a sport type in a week or month."""
+
+    period_start: date
+    sport_type: str
+    distance: float
+    moving_time: int
+    total_elevation_gain: float
+    activity_count: int
+
+
+@dataclass
+class PersonalBest:
+    """Dataclass defining the best single activities of a user for a sport type."""
+
+    sport_type: str
+    longest_distance: float
+    longest_moving_time: int
+    most_elevation_gain: float
+    activity_count: int
+
+
+@dataclass
+class UserStats:
+    """Dataclass holding the statistics of a user."""
+
+    user_id: str
+    # ordered by period_start descending, then sport_type
+    weekly: List[PeriodTotal] = field(default_factory=list)
+    monthly: List[PeriodTotal] = field(default_factory=list)
+    # ordered by activity_count descending
+    personal_bests: List[PersonalBest] = field(default_factory=list)
+    # consecutive days with at least one activity, the current streak ends today or yesterday
+    current_streak: int = 0
+    longest_streak: int = 0
+
+
+def _day(dialect: str) -> sa.ColumnElement:
+    """Build the expression truncating start_date to its day.
+
+    Args:
+        dialect: name of the sql dialect
+
+    Returns:
+        sa.ColumnElement
+    """
+    if dialect in ("mysql", "mariadb", "sqlite"):
+        return sa.func.date(Activity.start_date)
+    raise UnsupportedDialectError(dialect)
+
+
+def _week_start(dialect: str) -> sa.ColumnElement:
+    """Build the expression truncating start_date to the monday of its week.
+
+    Args:
+        dialect: name of the sql dialect
+
+    Returns:
+        sa.ColumnElement
+    """
+    if dialect in ("mysql", "mariadb"):
+        # WEEKDAY is 0 for monday, SUBDATE subtracts days
+        return sa.func.date(sa.func.subdate(Activity.start_date, sa.func.weekday(Activity.start_date)))
+    if dialect == "sqlite":
+        # the next sunday on or after the day, minus six days
+        return sa.func.date(Activity.start_date, "weekday 0", "-6 days")
+    raise UnsupportedDialectError(dialect)
+
+
+def _month_start(dialect: str) -> sa.ColumnElement:
+    """Build the expression truncating start_date to the first day of its month.
+
+    Args:
+        dialect: name of the sql dialect
+
+    Returns:
+        sa.ColumnElement
+    """
+    if dialect in ("mysql", "mariadb"):
+        return sa.func.date_format(Activity.start_date, "%Y-%m-01")
+    if dialect == "sqlite":
+        return sa.func.strftime("%Y-%m-01", Activity.start_date)
+    raise UnsupportedDialectError(dialect)
+
+
+def _to_date(value: Union[str, date]) -> date:
+    """Convert a day returned by the database to a date, sqlite returns text.
+
+    Args:
+        value: date or text, e.g. "2023-01-01"
+
+    Returns:
+        date
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _period_totals(session: Session, user_id: str, period: sa.ColumnElement, since: datetime) -> List[PeriodTotal]:
+    """Read the totals of a user per period and sport type.
+
+    Args:
+        session: session to run the query in
+        user_id: id of the user on strava
+        period: expression truncating start_date to the start of its period
+        since: only activities starting at or after since, naive datetime in utc
+
+    Returns:
+        list of PeriodTotal ordered by period descending, then sport type
+    """
+    period = period.label("period_start")
+    query = (
+        sa.select(
+            period,
+            Activity.sport_type,
+            sa.func.coalesce(sa.func.sum(Activity.distance), 0),
+            sa.func.coalesce(sa.func.sum(Activity.moving_time), 0),
+            sa.func.coalesce(sa.func.sum(Activity.total_elevation_gain), 0),
+            sa.func.count(Activity.id),
+        )
+        .where(Activity.user_id == user_id, Activity.start_date >= since)
+        .group_by(period, Activity.sport_type)
+        .order_by(period.desc(), Activity.sport_type)
+    )
+    return [
+        PeriodTotal(
+            period_start=_to_date(period_start),
+            sport_type=sport_type,
+            distance=distance,
+            moving_time=moving_time,
+            total_elevation_gain=total_elevation_gain,
+            activity_count=activity_count,
+        )
+        for period_start, sport_type, distance, moving_time, total_elevation_gain, activity_count in session.execute(
+            query,
+        )
+    ]
+
+
+def _personal_bests(session: Session, user_id: str) -> List[PersonalBest]:
+    """Read the best single activities of a user per sport type.
+
+    Args:
+        session: session to run the query in
+        user_id: id of the user on strava
+
+    Returns:
+        list of PersonalBest ordered by activity count descending
+    """
+    query = (
+        sa.select(
+            Activity.sport_type,
+            sa.func.coalesce(sa.func.max(Activity.distance), 0),
+            sa.func.coalesce(sa.func.max(Activity.moving_time), 0),
+            sa.func.coalesce(sa.func.max(Activity.total_elevation_gain), 0),
+            sa.func.count(Activity.id),
+        )
+        .where(Activity.user_id == user_id)
+        .group_by(Activity.sport_type)
+        .order_by(sa.func.count(Activity.id).desc(), Activity.sport_type)
+    )
+    return [
+        PersonalBest(
+            sport_type=sport_type,
+            longest_distance=longest_distance,
+            longest_moving_time=longest_moving_time,
+            most_elevation_gain=most_elevation_gain,
+            activity_count=activity_count,
+        )
+        for sport_type, longest_distance, longest_moving_time, most_elevation_gain, activity_count in session.execute(
+            query,
+        )
+    ]
+
+
+def _streaks(days: List[date], today: date) -> Tuple[int, int]:
+    """Compute the current and the longest run of consecutive days.
+
+    Args:
+        days: distinct days with activities in ascending order
+        today: current day, a streak ending yesterday is still current
+
+    Returns:
+        tuple of current streak and longest streak in days
+    """
+    longest = 0
+    streak = 0
+    previous: Optional[date] = None
+    for day in days:
+        streak = streak + 1 if previous is not None and day - previous == timedelta(days=1) else 1
+        longest = max(longest, streak)
+        previous = day
+    current = streak if previous is not None and today - previous <= timedelta(days=1) else 0
+    return current, longest
+
+
+def read_user_stats(session: Session, user_id: str, today: date, weeks: int = 12, months: int = 12) -> UserStats:
+    """Compute the statistics of a user from their activities.
+
+    Args:
+        session: session to run the queries in
+        user_id: id of the user on strava
+        today: current day in utc
+        weeks: number of weeks with weekly totals, including the current week
+        months: number of months with monthly totals, including the current month
+
+    Returns:
+        UserStats
+    """
+    dialect = session.get_bind().dialect.name
+    current_week = today - timedelta(days=today.weekday())
+    first_week = datetime.combine(current_week - timedelta(weeks=weeks - 1), datetime.min.time())
+    first_month = today.replace(day=1)
+    for _ in range(months - 1):
+        first_month = (first_month - timedelta(days=1)).replace(day=1)
+
+    day = _day(dialect).label("day")
+    days = [
+        _to_date(value)
+        for value in session.scalars(
+            sa.select(day).where(Activity.user_id == user_id).group_by(day).order_by(day),
+        )
+        if value is not None
+    ]
+    current_streak, longest_streak = _streaks(days, today)
+    return UserStats(
+        user_id=user_id,
+        weekly=_period_totals(session, user_id, _week_start(dialect), first_week),
+        monthly=_period_totals(
+            session,
+            user_id,
+            _month_start(dialect),
+            datetime.combine(first_month, datetime.min.time()),
+        ),
+        personal_bests=_personal_bests(session, user_id),
+        current_streak=current_streak,
+        longest_streak=longest_streak,
+    )
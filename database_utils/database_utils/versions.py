@@ -0,0 +1,147 @@
+"""This module provides version counters for parts of the data, shared by all processes using the database.
+
+Writers bump the versions of what they change in the same transaction as the change itself.
+Versions bumped by many concurrent writers, like those of challenges, are bumped right after the transaction
+committed instead, so their rows are not locked for the length of the writing transaction.
+Readers caching derived data, e.g. leaderboards, read the versions first and recompute only when they moved,
+which also picks up changes written by other processes like the ingestion service.
+"""
+from typing import Iterable, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import Insert
+
+from database_utils.schema import DataVersion
+
+# version of the names of all users
+USERS_VERSION = "users"
+
+# key in Session.info collecting the versions to bump once the transaction of the session committed
+_DEFERRED_VERSIONS = "metriker_deferred_versions"
+
+
+class UnsupportedDialectError(NotImplementedError):
+    """The sql dialect of the database does not support an operation."""
+
+    def __init__(self, dialect: str) -> None:
+        """Init of UnsupportedDialectError Exception.
+
+        Args:
+            dialect: name of the sql dialect
+        """
+        super().__init__(f"Operation is not supported for dialect: {dialect}")
+
+
+def challenge_version(challenge: str) -> str:
+    """Name of the version of the totals of a challenge.
+
+    Args:
+        challenge: name of the challenge
+
+    Returns:
+        str
+    """
+    return f"challenge:{challenge}"
+
+
+def user_version(user_id: str) -> str:
+    """Name of the version of the activities of a user.
+
+    Args:
+        user_id: id of the user on strava
+
+    Returns:
+        str
+    """
+    return f"user:{user_id}"
+
+
+def _bump_statement(session: Session, names: Iterable[str]) -> Insert:
+    """Build an insert of version rows that increments rows which already exist.
+
+    Args:
+        session: session the statement will be executed in, used to pick the sql dialect
+        names: names of the versions
+
+    Returns:
+        Insert statement
+    """
+    rows = [{"name": name, "version": 1} for name in names]
+    dialect = session.get_bind().dialect.name
+    if dialect in ("mysql", "mariadb"):
+        return mysql_insert(DataVersion).values(rows).on_duplicate_key_update(version=DataVersion.version + 1)
+    if dialect == "sqlite":
+        return (
+            sqlite_insert(DataVersion)
+            .values(rows)
+            .on_conflict_do_update(index_elements=[DataVersion.name], set_={"version": DataVersion.version + 1})
+        )
+    raise UnsupportedDialectError(dialect)
+
+
+def bump_versions(session: Session, names: Iterable[str]) -> None:
+    """Increment versions in the transaction of session.
+
+    Args:
+        session: session changing the versioned data
+        names: names of the versions
+
+    Returns:
+        None
+    """
+    # sorted so concurrent transactions lock the rows in the same order
+    names = sorted(set(names))
+    if names:
+        session.execute(_bump_statement(session, names))
+
+
+def bump_versions_after_commit(session: Session, names: Iterable[str]) -> None:
+    """Increment versions in a short transaction of their own, once the transaction of session committed.
+
+    Inside the writing transaction the version rows would stay locked until its commit,
+    serializing all writers of the same versions on MariaDB.
+    Readers may serve cached data for a moment after the commit, until the versions moved.
+    The bump runs in DatabaseConnector.session_scope, other sessions call bump_deferred_versions after commit.
+
+    Args:
+        session: session changing the versioned data
+        names: names of the versions
+
+    Returns:
+        None
+    """
+    session.info.setdefault(_DEFERRED_VERSIONS, set()).update(names)
+
+
+def bump_deferred_versions(session: Session) -> None:
+    """Increment the versions collected by bump_versions_after_commit and commit.
+
+    Args:
+        session: session whose transaction committed
+
+    Returns:
+        None
+    """
+    names = session.info.pop(_DEFERRED_VERSIONS, None)
+    if names:
+        bump_versions(session, names)
+        session.commit()
+
+
+def read_versions(session: Session, names: Iterable[str]) -> Tuple[int, ...]:
+    """Read versions, a version which was never bumped is 0.
+
+    Args:
+        session: session to run the query in
+        names: names of the versions
+
+    Returns:
+        tuple of versions in the order of names
+    """
+    names = list(names)
+    query = sa.select(DataVersion.name, DataVersion.version).where(DataVersion.name.in_(names))
+    versions = dict(session.execute(query).all())
+    return tuple(versions.get(name, 0) for name in names)
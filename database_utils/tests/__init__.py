@@ -0,0 +1 @@
+"""Tests of database_utils, run against SQLite databases in temporary directories."""
@@ -0,0 +1,20 @@
+"""Fixtures shared by the tests of database_utils."""
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from database_utils.database_connector import dispose_engines
+
+
+@pytest.fixture()
+def database(tmp_path: Path) -> Iterator[str]:
+    """Name of a SQLite database in a temporary directory, as passed to DatabaseConnector.
+
+    Engines are registered per process, they are disposed after every test.
+
+    Yields:
+        name of the database, the file is created as <name>.db
+    """
+    yield str(tmp_path / "metriker")
+    dispose_engines()
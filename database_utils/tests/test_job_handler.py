@@ -0,0 +1,154 @@
+"""Tests leasing ingestion jobs and queueing at most one pending job per user."""
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from database_utils.job_handler import (
+    JOB_DONE,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    IngestionJobHandler,
+    LeaseLostError,
+    StravaIngestionJob,
+)
+from database_utils.schema import IngestionJob, User
+
+SYNCED_UNTIL = datetime(2023, 1, 1, tzinfo=timezone.utc).replace(tzinfo=None)
+LATEST_START_DATE = datetime(2023, 2, 1, tzinfo=timezone.utc).replace(tzinfo=None)
+
+
+@pytest.fixture()
+def handler(database: str) -> IngestionJobHandler:
+    """IngestionJobHandler on a fresh database with a user synced until SYNCED_UNTIL.
+
+    Args:
+        database: name of the database
+
+    Returns:
+        IngestionJobHandler
+    """
+    handler = IngestionJobHandler(database=database)
+    with handler.session_scope() as session:
+        session.add(User(id="1", name="Alice", synced_until=SYNCED_UNTIL))
+    return handler
+
+
+def _lease(handler: IngestionJobHandler, lease_seconds: int = 300) -> StravaIngestionJob:
+    """Lease the next job, failing the test if there is none.
+
+    Args:
+        handler: IngestionJobHandler
+        lease_seconds: seconds the job is reserved
+
+    Returns:
+        StravaIngestionJob
+    """
+    job = handler.lease(lease_seconds=lease_seconds)
+    assert job is not None
+    return job
+
+
+def test_enqueue_returns_pending_job(handler: IngestionJobHandler) -> None:
+    """A user has at most one queued or running job, a new one is queued once it is done."""
+    job = handler.enqueue("1")
+    assert job.after == SYNCED_UNTIL
+
+    assert handler.enqueue("1").id == job.id
+    leased = _lease(handler)
+    assert handler.enqueue("1").id == job.id
+
+    handler.complete(job.id, leased.lease_token)
+    assert handler.enqueue("1").id != job.id
+
+
+def test_concurrent_enqueue_returns_job_of_other_process(
+    handler: IngestionJobHandler,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    """A job queued by another process between the lookup and the insert is returned instead of a second job."""
+    concurrent: Optional[StravaIngestionJob] = None
+    enqueue = IngestionJobHandler._enqueue  # noqa: SLF001 - Ignore: the lookup is raced on purpose
+
+    def racing_enqueue(self: IngestionJobHandler, session: Session, user_id: str, **kwargs) -> StravaIngestionJob:
+        """Queue a job in another session right before inserting without lookup, only on the first call."""
+        nonlocal concurrent
+        if concurrent is not None:
+            return enqueue(self, session, user_id, **kwargs)
+        with Session(handler.engine) as other_session, other_session.begin():
+            concurrent = enqueue(self, other_session, user_id, **kwargs)
+        return self._add_job(session, user_id, priority=kwargs["priority"])
+
+    monkeypatch.setattr(IngestionJobHandler, "_enqueue", racing_enqueue)
+    caplog.set_level(logging.INFO, logger="database_utils.job_handler")
+
+    job = handler.enqueue("1")
+
+    assert concurrent is not None
+    assert job.id == concurrent.id
+    assert "Concurrent ingestion job queued for user 1" in caplog.messages
+    with handler.session_scope() as session:
+        assert session.scalar(sa.select(sa.func.count()).select_from(IngestionJob)) == 1
+
+
+def test_expired_lease_is_taken_over(handler: IngestionJobHandler) -> None:
+    """A running job is only leased again once its lease expired, the earlier lease is fenced off."""
+    job = handler.enqueue("1")
+    stale = _lease(handler, lease_seconds=-1)
+    assert stale.status == JOB_RUNNING
+
+    current = _lease(handler)
+    assert current.id == job.id
+    assert current.lease_token != stale.lease_token
+    assert current.attempts == 2
+    assert handler.lease() is None
+
+    with pytest.raises(LeaseLostError):
+        handler.checkpoint(job.id, stale.lease_token, next_page=2, activity_count=200)
+    assert not handler.renew(job.id, stale.lease_token)
+    handler.fail(job.id, stale.lease_token, error="stale worker")
+    with pytest.raises(LeaseLostError):
+        handler.complete(job.id, stale.lease_token)
+
+    stored = handler.get(job.id)
+    assert (stored.status, stored.next_page, stored.error) == (JOB_RUNNING, 1, None)
+
+
+def test_current_lease_checkpoints_and_completes(handler: IngestionJobHandler) -> None:
+    """The worker holding the lease stores its progress and advances the watermark of the user."""
+    job = handler.enqueue("1")
+    leased = _lease(handler)
+
+    assert handler.renew(job.id, leased.lease_token)
+    handler.checkpoint(job.id, leased.lease_token, next_page=3, activity_count=400, latest_start_date=LATEST_START_DATE)
+    handler.complete(job.id, leased.lease_token)
+
+    stored = handler.get(job.id)
+    assert (stored.status, stored.next_page, stored.activity_count, stored.lease_token) == (JOB_DONE, 3, 400, None)
+    with handler.session_scope() as session:
+        assert session.get(User, "1").synced_until == LATEST_START_DATE
+
+
+def test_full_sync_upgrades_running_incremental_job(handler: IngestionJobHandler) -> None:
+    """A full sync restarts the pending incremental job from the first page and revokes its lease."""
+    job = handler.enqueue("1")
+    leased = _lease(handler)
+    handler.checkpoint(job.id, leased.lease_token, next_page=2, activity_count=200)
+
+    upgraded = handler.enqueue("1", incremental=False)
+
+    assert upgraded.id == job.id
+    assert (upgraded.status, upgraded.after, upgraded.next_page, upgraded.activity_count) == (JOB_QUEUED, None, 1, 0)
+    assert upgraded.lease_token is None
+    with pytest.raises(LeaseLostError):
+        handler.checkpoint(job.id, leased.lease_token, next_page=3, activity_count=400)
+    assert not handler.renew(job.id, leased.lease_token)
+
+    released = _lease(handler)
+    assert released.id == job.id
+    assert released.after is None
+    assert released.next_page == 1
@@ -0,0 +1,152 @@
+"""Tests upgrading databases created with older revisions of the schema."""
+from dataclasses import replace
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+import pytest
+import sqlalchemy as sa
+
+from database_utils import DatabaseConnector, migrations
+from database_utils.challenges import CHALLENGES
+from database_utils.database_connector import dispose_engines
+from database_utils.schema import Activity, ChallengeTotal
+
+# schema of the first revision, start_date was stored as text
+LEGACY_SCHEMA = [
+    "CREATE TABLE user (id VARCHAR(36) PRIMARY KEY, name TEXT, refresh_token TEXT)",
+    "CREATE TABLE activity ("
+    "id VARCHAR(36) PRIMARY KEY, user_id VARCHAR(36) REFERENCES user (id), name TEXT, distance FLOAT, "
+    "moving_time INTEGER, elapsed_time INTEGER, total_elevation_gain FLOAT, sport_type TEXT, start_date TEXT)",
+]
+
+
+def _utc(*args: int) -> datetime:
+    """Naive datetime in utc, as stored in the database.
+
+    Args:
+        args: year, month, day, hour and minute
+
+    Returns:
+        datetime without tzinfo
+    """
+    return datetime(*args, tzinfo=timezone.utc).replace(tzinfo=None)
+
+
+def _create_legacy_database(database: str) -> None:
+    """Create a database with the legacy schema holding one user and their activities.
+
+    Args:
+        database: name of the database
+
+    Returns:
+        None
+    """
+    engine = sa.create_engine(f"sqlite:///{database}.db")
+    with engine.begin() as connection:
+        for statement in LEGACY_SCHEMA:
+            connection.execute(sa.text(statement))
+        connection.execute(sa.text("INSERT INTO user VALUES ('1', 'Alice', 'token')"))
+        connection.execute(
+            sa.text(
+                "INSERT INTO activity VALUES "
+                "('10', '1', 'Morning Run', 5000, 1500, 1600, 10, 'Run', '2023-01-01 10:00:00+00:00'), "
+                "('11', '1', 'Evening Run', 3000, 900, 950, 5, 'Run', '2023-01-02T19:30:00Z'), "
+                "('12', '1', 'Lunch Run', 2000, 600, 600, 0, 'Run', '2023-01-03 13:00:00+01:00'), "
+                "('13', '1', 'Ride', 20000, 3600, 3700, 100, 'Ride', NULL)",
+            ),
+        )
+    engine.dispose()
+
+
+def test_upgrade_converts_start_date_to_datetime(database: str) -> None:
+    """Text start dates become naive datetimes in utc."""
+    _create_legacy_database(database)
+
+    connector = DatabaseConnector(database=database)
+
+    columns = {column["name"]: column for column in sa.inspect(connector.engine).get_columns("activity")}
+    assert isinstance(columns["start_date"]["type"], sa.DateTime)
+    assert "start_date_new" not in columns
+    with connector.session_scope() as session:
+        start_dates = dict(session.execute(sa.select(Activity.id, Activity.start_date)).all())
+    assert start_dates == {
+        "10": _utc(2023, 1, 1, 10, 0),
+        "11": _utc(2023, 1, 2, 19, 30),
+        "12": _utc(2023, 1, 3, 12, 0),
+        "13": None,
+    }
+
+
+def test_upgrade_adds_columns_indexes_and_totals(database: str) -> None:
+    """Columns and indexes of later revisions are added and challenge totals are computed."""
+    _create_legacy_database(database)
+
+    connector = DatabaseConnector(database=database)
+
+    inspector = sa.inspect(connector.engine)
+    assert {"synced_until", "reconciled_at"} <= {column["name"] for column in inspector.get_columns("user")}
+    assert "ix_activity_user_id_start_date" in {index["name"] for index in inspector.get_indexes("activity")}
+    with connector.session_scope() as session:
+        totals = {
+            total.challenge: (total.distance, total.activity_count)
+            for total in session.scalars(sa.select(ChallengeTotal).where(ChallengeTotal.user_id == "1"))
+        }
+    assert totals == {"run": (10000, 3), "bike": (20000, 1)}
+
+
+def test_upgrade_is_idempotent(database: str) -> None:
+    """Connecting to an upgraded database again changes nothing."""
+    _create_legacy_database(database)
+    DatabaseConnector(database=database)
+    dispose_engines()
+
+    connector = DatabaseConnector(database=database)
+
+    with connector.session_scope() as session:
+        assert session.scalar(sa.select(sa.func.count()).select_from(Activity)) == 4
+        assert session.scalar(sa.select(sa.func.count()).select_from(ChallengeTotal)) == 2
+
+
+def _totals(connector: DatabaseConnector) -> Dict[str, Tuple[float, int]]:
+    """Read the totals of the legacy user.
+
+    Args:
+        connector: DatabaseConnector
+
+    Returns:
+        dict of challenge -> (distance, activity_count)
+    """
+    with connector.session_scope() as session:
+        return {
+            total.challenge: (total.distance, total.activity_count)
+            for total in session.scalars(sa.select(ChallengeTotal).where(ChallengeTotal.user_id == "1"))
+        }
+
+
+def test_unchanged_challenges_are_not_recomputed(database: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Challenges are recomputed once, also those matching no activities."""
+    empty = replace(CHALLENGES["run"], name="swim", sport_types=("Swim",))
+    monkeypatch.setitem(CHALLENGES, empty.name, empty)
+    connector = DatabaseConnector(database=database)
+    refreshed: List[str] = []
+    monkeypatch.setattr(
+        migrations,
+        "refresh_challenge_totals",
+        lambda _, challenges: refreshed.extend(challenge.name for challenge in challenges),
+    )
+
+    migrations.populate_challenge_totals(connector.engine)
+
+    assert refreshed == []
+
+
+def test_changed_challenges_are_recomputed(database: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Totals of a challenge whose definition changed are recomputed with the new definition."""
+    _create_legacy_database(database)
+    connector = DatabaseConnector(database=database)
+    assert _totals(connector) == {"run": (10000, 3), "bike": (20000, 1)}
+
+    monkeypatch.setitem(CHALLENGES, "bike", replace(CHALLENGES["bike"], sport_types=("Ride", "Run")))
+    migrations.populate_challenge_totals(connector.engine)
+
+    assert _totals(connector) == {"run": (10000, 3), "bike": (30000, 4)}
@@ -0,0 +1,90 @@
+"""Tests reserving and tracking the strava api budget across rate limit windows."""
+from datetime import datetime, timedelta, timezone
+from typing import Dict
+
+import pytest
+import sqlalchemy as sa
+
+from database_utils.rate_limit_handler import WINDOW_15_MIN, WINDOW_DAILY, RateLimitHandler
+from database_utils.schema import RateLimitWindow
+
+# windows are created at the current time, the tests run in windows after it
+NOW = datetime(2100, 1, 1, 10, 5, tzinfo=timezone.utc).replace(tzinfo=None)
+QUARTER_HOUR_END = datetime(2100, 1, 1, 10, 15, tzinfo=timezone.utc).replace(tzinfo=None)
+DAY_END = datetime(2100, 1, 2, tzinfo=timezone.utc).replace(tzinfo=None)
+
+
+@pytest.fixture()
+def handler(database: str) -> RateLimitHandler:
+    """RateLimitHandler on a fresh database.
+
+    Args:
+        database: name of the database
+
+    Returns:
+        RateLimitHandler
+    """
+    return RateLimitHandler(database=database)
+
+
+def _usage(handler: RateLimitHandler) -> Dict[str, int]:
+    """Read the usage of all windows.
+
+    Args:
+        handler: RateLimitHandler
+
+    Returns:
+        dict of window name -> usage
+    """
+    with handler.session_scope() as session:
+        return dict(session.execute(sa.select(RateLimitWindow.name, RateLimitWindow.usage)).all())
+
+
+def test_reserve_until_15_min_limit_is_exhausted(handler: RateLimitHandler) -> None:
+    """Reservations succeed up to the limit, then the end of the 15 minute window is returned."""
+    handler.track({WINDOW_15_MIN: 3, WINDOW_DAILY: 10}, {}, now=NOW)
+
+    assert [handler.reserve(now=NOW) for _ in range(3)] == [None, None, None]
+    assert handler.reserve(now=NOW + timedelta(minutes=5)) == QUARTER_HOUR_END
+    assert _usage(handler) == {WINDOW_15_MIN: 3, WINDOW_DAILY: 3}
+
+
+def test_reserve_after_15_min_rollover(handler: RateLimitHandler) -> None:
+    """The 15 minute usage is reset in the next window, the daily usage carries over."""
+    handler.track({WINDOW_15_MIN: 2, WINDOW_DAILY: 10}, {}, now=NOW)
+    handler.reserve(now=NOW)
+    handler.reserve(now=NOW)
+
+    assert handler.reserve(now=QUARTER_HOUR_END) is None
+    assert _usage(handler) == {WINDOW_15_MIN: 1, WINDOW_DAILY: 3}
+
+
+def test_reserve_until_daily_limit_is_exhausted(handler: RateLimitHandler) -> None:
+    """An exhausted daily window blocks until midnight utc, across 15 minute windows."""
+    handler.track({WINDOW_15_MIN: 2, WINDOW_DAILY: 3}, {}, now=NOW)
+    handler.reserve(now=NOW)
+    handler.reserve(now=NOW)
+    handler.reserve(now=QUARTER_HOUR_END)
+
+    assert handler.reserve(now=QUARTER_HOUR_END) == DAY_END
+    assert handler.reserve(now=DAY_END) is None
+    assert _usage(handler) == {WINDOW_15_MIN: 1, WINDOW_DAILY: 1}
+
+
+def test_track_only_raises_usage(handler: RateLimitHandler) -> None:
+    """Usage reported by strava never lowers reservations that strava has not counted yet."""
+    for _ in range(5):
+        handler.reserve(now=NOW)
+
+    handler.track({WINDOW_15_MIN: 100}, {WINDOW_15_MIN: 2, WINDOW_DAILY: 40}, now=NOW)
+
+    assert _usage(handler) == {WINDOW_15_MIN: 5, WINDOW_DAILY: 40}
+
+
+def test_track_resets_past_windows(handler: RateLimitHandler) -> None:
+    """Usage of a past window is dropped before the reported usage is applied."""
+    handler.track({}, {WINDOW_15_MIN: 90, WINDOW_DAILY: 90}, now=NOW)
+
+    handler.track({}, {WINDOW_15_MIN: 1}, now=QUARTER_HOUR_END)
+
+    assert _usage(handler) == {WINDOW_15_MIN: 1, WINDOW_DAILY: 90}
@@ -0,0 +1,205 @@
+"""Tests scoring challenges with ScoringRules, in memory and against SQLite."""
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pytest
+import sqlalchemy as sa
+
+from database_utils.activity_handler import StravaActivity, StravaActivityHandler
+from database_utils.challenges import CHALLENGES, ChallengeDefinition, ScoringRules
+from database_utils.schema import ChallengeTotal, User
+from database_utils.scoring import ActivityColumns, Scores, evaluate, score_challenge
+
+PERCENTILE_CHALLENGE = ChallengeDefinition.from_dict(
+    {"name": "percentile", "metric": "distance", "aggregation": "sum", "scoring": {"percentile": True}},
+)
+
+
+def _columns(activities: List[Tuple[str, int, str, float, float]]) -> ActivityColumns:
+    """Build ActivityColumns like load_activity_columns does.
+
+    Args:
+        activities: list of (user id, day, sport type, metric, elevation)
+
+    Returns:
+        ActivityColumns
+    """
+    user_ids, user_index = np.unique(np.array([activity[0] for activity in activities], dtype=str), return_inverse=True)
+    sport_types, sport_index = np.unique(
+        np.array([activity[2] for activity in activities], dtype=str),
+        return_inverse=True,
+    )
+    return ActivityColumns(
+        user_ids=user_ids,
+        user_index=user_index,
+        day=np.array([activity[1] for activity in activities], dtype=np.int64),
+        sport_types=sport_types,
+        sport_index=sport_index,
+        metric=np.array([activity[3] for activity in activities], dtype=np.float64),
+        elevation=np.array([activity[4] for activity in activities], dtype=np.float64),
+    )
+
+
+def _as_dict(scores: Scores) -> Dict[str, float]:
+    """Map user ids to their scores.
+
+    Args:
+        scores: Scores
+
+    Returns:
+        dict of user id -> score
+    """
+    return {user_id: scores.scores[index].item() for index, user_id in enumerate(scores.user_ids.tolist())}
+
+
+def _activity(activity_id: str, user_id: str, distance: float, sport_type: str = "Run", day: int = 1) -> StravaActivity:
+    """Build a StravaActivity in January 2023.
+
+    Args:
+        activity_id: id of the activity
+        user_id: id of the user
+        distance: distance in meters
+        sport_type: sport type
+        day: day of the month
+
+    Returns:
+        StravaActivity
+    """
+    return StravaActivity(
+        id=activity_id,
+        user_id=user_id,
+        name=f"Activity {activity_id}",
+        distance=distance,
+        moving_time=600,
+        elapsed_time=600,
+        total_elevation_gain=10,
+        sport_type=sport_type,
+        start_date=datetime(2023, 1, day, 10, tzinfo=timezone.utc),
+    )
+
+
+@pytest.fixture()
+def handler(database: str) -> StravaActivityHandler:
+    """StravaActivityHandler on a fresh database with the users a, b, c and d.
+
+    Args:
+        database: name of the database
+
+    Returns:
+        StravaActivityHandler
+    """
+    handler = StravaActivityHandler(database=database)
+    with handler.session_scope() as session:
+        session.add_all([User(id=user_id, name=user_id) for user_id in "abcd"])
+    return handler
+
+
+def test_evaluate_weights_sports_and_adds_elevation_bonus() -> None:
+    """Points are the weighted metric plus the elevation bonus, summed per user."""
+    rules = ScoringRules(sport_weights=(("Ride", 0.25),), default_weight=1.0, elevation_bonus=2.0)
+    columns = _columns([("a", 1, "Ride", 40, 10), ("a", 2, "Run", 10, 0), ("b", 1, "Swim", 5, 1)])
+
+    assert _as_dict(evaluate(columns, rules)) == {"a": 40.0, "b": 7.0}
+
+
+def test_evaluate_caps_points_per_user_and_day() -> None:
+    """The cap applies to the sum of a day, not to single activities, and days of users are kept apart."""
+    rules = ScoringRules(daily_cap=10)
+    columns = _columns(
+        [
+            ("a", 1, "Run", 6, 0),
+            ("a", 1, "Run", 6, 0),
+            ("a", 3, "Run", 4, 0),
+            ("b", 1, "Run", 25, 0),
+            ("b", 2, "Run", 3, 0),
+        ],
+    )
+
+    assert _as_dict(evaluate(columns, rules)) == {"a": 14.0, "b": 13.0}
+
+
+def test_evaluate_percentile_counts_ties() -> None:
+    """Percentiles are the share of users scoring the same or less."""
+    rules = ScoringRules(percentile=True)
+    columns = _columns([("a", 1, "Run", 10, 0), ("b", 1, "Run", 30, 0), ("c", 1, "Run", 10, 0), ("d", 1, "Run", 20, 0)])
+
+    assert _as_dict(evaluate(columns, rules)) == {"a": 50.0, "b": 100.0, "c": 50.0, "d": 75.0}
+
+
+def test_evaluate_percentile_after_daily_cap() -> None:
+    """Percentiles rank the capped scores."""
+    rules = ScoringRules(daily_cap=10, percentile=True)
+    columns = _columns([("a", 1, "Run", 50, 0), ("b", 1, "Run", 5, 0), ("b", 2, "Run", 8, 0)])
+
+    assert _as_dict(evaluate(columns, rules)) == {"a": 50.0, "b": 100.0}
+
+
+def test_evaluate_without_activities() -> None:
+    """No activities give no scores."""
+    scores = evaluate(_columns([("a", 1, "Run", 1, 0)]), ScoringRules())
+    empty = ActivityColumns(
+        user_ids=np.array([], dtype=str),
+        user_index=np.array([], dtype=np.int64),
+        day=np.array([], dtype=np.int64),
+        sport_types=np.array([], dtype=str),
+        sport_index=np.array([], dtype=np.int64),
+        metric=np.array([], dtype=np.float64),
+        elevation=np.array([], dtype=np.float64),
+    )
+
+    assert _as_dict(scores) == {"a": 1.0}
+    assert _as_dict(evaluate(empty, ScoringRules(daily_cap=1, percentile=True))) == {}
+
+
+def test_score_challenge_loads_matching_activities(handler: StravaActivityHandler) -> None:
+    """Only activities of the sport types of the challenge count, days are the days in utc."""
+    challenge = ChallengeDefinition.from_dict(
+        {"name": "capped", "sport_types": ["Run"], "metric": "distance", "scoring": {"daily_cap": 5000}},
+    )
+    handler.bulk_upsert(
+        [
+            _activity("1", "a", 4000),
+            _activity("2", "a", 4000),
+            _activity("3", "a", 3000, day=2),
+            _activity("4", "b", 9000, sport_type="Ride"),
+            _activity("5", "b", 1000),
+        ],
+    )
+
+    with handler.session_scope() as session:
+        assert _as_dict(score_challenge(session, challenge)) == {"a": 8000.0, "b": 1000.0}
+        assert _as_dict(score_challenge(session, challenge, ["b"])) == {"b": 1000.0}
+
+
+def _percentiles(handler: StravaActivityHandler) -> Dict[str, float]:
+    """Read the stored scores of the percentile challenge.
+
+    Args:
+        handler: StravaActivityHandler
+
+    Returns:
+        dict of user id -> score
+    """
+    with handler.session_scope() as session:
+        return dict(
+            session.execute(
+                sa.select(ChallengeTotal.user_id, ChallengeTotal.score).where(ChallengeTotal.challenge == "percentile"),
+            ).all(),
+        )
+
+
+def test_percentiles_are_rescored_for_all_users(
+    handler: StravaActivityHandler,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Writing or deleting activities of one user changes the stored percentiles of every user."""
+    monkeypatch.setitem(CHALLENGES, PERCENTILE_CHALLENGE.name, PERCENTILE_CHALLENGE)
+    handler.bulk_upsert([_activity("1", "a", 1000), _activity("2", "b", 2000), _activity("3", "c", 3000)])
+    assert _percentiles(handler) == {"a": pytest.approx(100 / 3), "b": pytest.approx(200 / 3), "c": 100.0}
+
+    handler.bulk_upsert([_activity("4", "d", 4000)])
+    assert _percentiles(handler) == {"a": 25.0, "b": 50.0, "c": 75.0, "d": 100.0}
+
+    handler.delete_user_activities("d")
+    assert _percentiles(handler) == {"a": pytest.approx(100 / 3), "b": pytest.approx(200 / 3), "c": 100.0}
@@ -0,0 +1,72 @@
+"""Tests configuring the secret keys of the StravaUserHandler."""
+from typing import Dict, Optional
+
+import pytest
+
+from database_utils import DatabaseConnector
+from database_utils.schema import User
+from database_utils.token_cipher import LEGACY_VERSION
+from database_utils.user_handler import MissingLegacyKeyError, StravaUserHandler
+
+# tokens written by flet.security carry no key version prefix
+LEGACY_TOKEN = "bGVnYWN5LXRva2Vu"
+CURRENT_TOKEN = "v1$Y3VycmVudC10b2tlbg=="
+
+
+def _add_users(database: str, tokens: Dict[str, Optional[str]]) -> None:
+    """Add users with encrypted refresh tokens.
+
+    Args:
+        database: name of the database
+        tokens: dict of user id -> encrypted refresh token
+
+    Returns:
+        None
+    """
+    with DatabaseConnector(database=database).session_scope() as session:
+        session.add_all([User(id=user_id, name=user_id, refresh_token=token) for user_id, token in tokens.items()])
+
+
+def test_rotated_key_without_legacy_key_is_rejected(database: str) -> None:
+    """Legacy tokens would be decrypted with the rotated key, which breaks all of them."""
+    _add_users(database, {"1": LEGACY_TOKEN, "2": CURRENT_TOKEN, "3": None})
+
+    with pytest.raises(MissingLegacyKeyError, match="^1 refresh tokens"):
+        StravaUserHandler(secret_key="new", database=database, secret_key_version=2, previous_secret_keys={1: "old"})
+
+
+def test_rotated_key_with_legacy_key(database: str) -> None:
+    """Legacy tokens stay readable with the key of version 0."""
+    _add_users(database, {"1": LEGACY_TOKEN})
+
+    handler = StravaUserHandler(
+        secret_key="new",
+        database=database,
+        secret_key_version=2,
+        previous_secret_keys={LEGACY_VERSION: "old", 1: "old"},
+    )
+
+    assert handler.cipher.keys[LEGACY_VERSION] == "old"
+
+
+def test_rotated_key_without_legacy_tokens(database: str) -> None:
+    """Once all tokens are re-encrypted the key of version 0 is not needed anymore."""
+    _add_users(database, {"2": CURRENT_TOKEN})
+
+    handler = StravaUserHandler(
+        secret_key="new",
+        database=database,
+        secret_key_version=2,
+        previous_secret_keys={1: "old"},
+    )
+
+    assert LEGACY_VERSION not in handler.cipher.keys
+
+
+def test_first_key_version_defaults_legacy_key(database: str) -> None:
+    """Version 1 kept the secret key of flet.security."""
+    _add_users(database, {"1": LEGACY_TOKEN})
+
+    handler = StravaUserHandler(secret_key="key", database=database)
+
+    assert handler.cipher.keys == {LEGACY_VERSION: "key", 1: "key"}
@@ -0,0 +1 @@
+"""Api of the fake_strava_service for metriker."""
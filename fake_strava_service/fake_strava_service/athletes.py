@@ -0,0 +1,479 @@
+"""This module provides synthetic athletes with deterministic activity histories of any size.
+
+Activities are not stored: every activity is generated on request from the seed, the id of its athlete
+and its position in the history of the athlete, so a history of millions of activities costs no memory.
+Only changes made since the server started, created, renamed and deleted activities, are kept.
+"""
+import logging
+import math
+import random
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+# activity id = athlete id * ACTIVITY_ID_STRIDE + index of the activity in the history of the athlete
+ACTIVITY_ID_STRIDE = 10**9
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# characters of google encoded polylines, summary polylines are slices of one random string of them
+POLYLINE_ALPHABET = "".join(chr(code) for code in range(63, 127))
+FIRST_NAMES = ("Anna", "Ben", "Clara", "David", "Eva", "Felix", "Greta", "Hannes", "Ida", "Jonas", "Lena", "Max")
+LAST_NAMES = ("Bauer", "Fischer", "Hoffmann", "Koch", "Meyer", "Richter", "Schmidt", "Schulz", "Wagner", "Weber")
+DAYTIMES = ((5, "Morning"), (11, "Lunch"), (14, "Afternoon"), (18, "Evening"), (22, "Night"))
+
+
+@dataclass(frozen=True)
+class SportProfile:
+    """Dataclass describing the activities generated for a sport type."""
+
+    sport_type: str
+    # deprecated type field of strava, still sent along with sport_type
+    activity_type: str
+    # relative frequency of the sport type
+    weight: float
+    # distance of activities in meters
+    min_distance: float
+    max_distance: float
+    # average moving speed in meters per second
+    speed: float
+    # elevation gain in meters per kilometer
+    climb: float
+
+
+SPORT_PROFILES = (
+    SportProfile("Ride", "Ride", 3.0, 10_000, 120_000, 7.5, 8.0),
+    SportProfile("Run", "Run", 3.0, 3_000, 25_000, 3.0, 5.0),
+    SportProfile("MountainBikeRide", "Ride", 1.0, 10_000, 60_000, 5.0, 20.0),
+    SportProfile("GravelRide", "Ride", 1.0, 20_000, 150_000, 6.5, 10.0),
+    SportProfile("VirtualRide", "VirtualRide", 1.0, 15_000, 60_000, 8.0, 5.0),
+    SportProfile("TrailRun", "Run", 1.0, 5_000, 30_000, 2.6, 30.0),
+    SportProfile("Walk", "Walk", 1.0, 2_000, 10_000, 1.4, 3.0),
+    SportProfile("Hike", "Hike", 1.0, 5_000, 25_000, 1.1, 40.0),
+    SportProfile("Swim", "Swim", 1.0, 500, 4_000, 0.7, 0.0),
+)
+SPORT_WEIGHTS = tuple(profile.weight for profile in SPORT_PROFILES)
+
+
+def _timestamp(epoch: float) -> str:
+    """Format a point in time like strava does.
+
+    Args:
+        epoch: seconds since epoch
+
+    Returns:
+        e.g. "2023-02-18T09:30:00Z"
+    """
+    return datetime.fromtimestamp(epoch, tz=timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+@dataclass
+class SyntheticAthlete:
+    """Dataclass holding an athlete and the changes to its generated history."""
+
+    id: int  # noqa: A003
+    firstname: str
+    lastname: str
+    created_at: float
+    # the generated history, history_size activities starting at history_start, interval seconds apart
+    history_size: int
+    history_start: float
+    interval: float
+    # start times of activities created since the server started, their indices follow the history
+    created: List[int] = field(default_factory=list)
+    deleted: Set[int] = field(default_factory=set)
+    # changed names by index
+    names: Dict[int, str] = field(default_factory=dict)
+
+    @property
+    def activity_count(self) -> int:
+        """Number of activities, including deleted ones.
+
+        Returns:
+            int
+        """
+        return self.history_size + len(self.created)
+
+    def activity_id(self, index: int) -> int:
+        """Get the id of an activity of the athlete.
+
+        Args:
+            index: index of the activity in the history
+
+        Returns:
+            activity id
+        """
+        return self.id * ACTIVITY_ID_STRIDE + index
+
+    def start_time(self, index: int) -> int:
+        """Get the start of an activity.
+
+        Args:
+            index: index of the activity in the history
+
+        Returns:
+            seconds since epoch
+        """
+        if index < self.history_size:
+            return int(self.history_start + index * self.interval)
+        return self.created[index - self.history_size]
+
+    def first_index_after(self, epoch: int) -> int:
+        """Get the index of the first activity starting after a point in time.
+
+        Start times grow with the index, so the index is computed instead of searched.
+
+        Args:
+            epoch: seconds since epoch
+
+        Returns:
+            index, activity_count if no activity starts after epoch
+        """
+        index = min(max(math.floor((epoch - self.history_start) / self.interval) + 1, 0), self.history_size)
+        # start times are truncated to seconds, correct the estimate by the rounding error
+        while index > 0 and self.start_time(index - 1) > epoch:
+            index -= 1
+        while index < self.history_size and self.start_time(index) <= epoch:
+            index += 1
+        if index < self.history_size:
+            return index
+        return self.history_size + bisect_right(self.created, epoch)
+
+    def list_activities(
+        self,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        page: int = 1,
+        per_page: int = 30,
+    ) -> List[int]:
+        """List the indices of the activities on a page of getLoggedInAthleteActivities.
+
+        Activities are ordered by start, oldest first if only after is given, newest first otherwise.
+
+        Args:
+            before: only activities starting before, seconds since epoch
+            after: only activities starting after, seconds since epoch
+            page: number of the page, starting at 1
+            per_page: number of activities per page
+
+        Returns:
+            list of indices
+        """
+        low = self.first_index_after(after) if after is not None else 0
+        high = self.first_index_after(before - 1) if before is not None else self.activity_count
+        deleted = sorted(index for index in self.deleted if low <= index < high)
+        offset = (page - 1) * per_page
+        indices: List[int] = []
+        if after is not None and before is None:
+            # skip the offset, every deleted activity in front of the page moves it back by one
+            index = low + offset
+            for deleted_index in deleted:
+                if deleted_index > index:
+                    break
+                index += 1
+            while index < high and len(indices) < per_page:
+                if index not in self.deleted:
+                    indices.append(index)
+                index += 1
+        else:
+            index = high - 1 - offset
+            for deleted_index in reversed(deleted):
+                if deleted_index < index:
+                    break
+                index -= 1
+            while index >= low and len(indices) < per_page:
+                if index not in self.deleted:
+                    indices.append(index)
+                index -= 1
+        return indices
+
+    def has_activity(self, index: int) -> bool:
+        """Check if an activity exists.
+
+        Args:
+            index: index of the activity in the history
+
+        Returns:
+            bool
+        """
+        return 0 <= index < self.activity_count and index not in self.deleted
+
+    def create_activity(self, epoch: float) -> int:
+        """Create an activity starting at a point in time, after all other activities.
+
+        Args:
+            epoch: seconds since epoch
+
+        Returns:
+            index of the activity
+        """
+        latest = self.start_time(self.activity_count - 1) if self.activity_count else 0
+        self.created.append(max(int(epoch), latest + 1))
+        return self.activity_count - 1
+
+    def random_activity(self, rng: random.Random, attempts: int = 10) -> Optional[int]:
+        """Pick an existing activity at random.
+
+        Args:
+            rng: random number generator
+            attempts: number of picks before giving up when most activities are deleted
+
+        Returns:
+            index of the activity, None if none was found
+        """
+        for _ in range(attempts):
+            if not self.activity_count:
+                return None
+            index = rng.randrange(self.activity_count)
+            if index not in self.deleted:
+                return index
+        return None
+
+    def to_api(self) -> Dict:
+        """Convert the athlete to a DetailedAthlete object as returned by strava.
+
+        https://developers.strava.com/docs/reference/#api-models-DetailedAthlete
+
+        Returns:
+            dict
+        """
+        created_at = _timestamp(self.created_at)
+        return {
+            "id": self.id,
+            "username": f"{self.firstname}_{self.lastname}_{self.id}".lower(),
+            "resource_state": 3,
+            "firstname": self.firstname,
+            "lastname": self.lastname,
+            "bio": None,
+            "city": "Berlin",
+            "state": "Berlin",
+            "country": "Germany",
+            "sex": None,
+            "premium": False,
+            "summit": False,
+            "created_at": created_at,
+            "updated_at": created_at,
+            "badge_type_id": 0,
+            "weight": None,
+            "profile_medium": "avatar/athlete/medium.png",
+            "profile": "avatar/athlete/large.png",
+            "friend": None,
+            "follower": None,
+        }
+
+
+class AthleteRegistry:
+    """Synthetic athletes, generated on first access and kept with their changes."""
+
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        seed: int,
+        first_athlete_id: int,
+        athlete_count: int,
+        activities_per_athlete: int,
+        history_days: int,
+        now: float,
+        history_sizes: Optional[Dict[int, int]] = None,
+    ) -> None:
+        """Synthetic athletes, generated on first access and kept with their changes.
+
+        Args:
+            seed: seed of all generated data
+            first_athlete_id: id of the first athlete, athletes have consecutive ids
+            athlete_count: number of athletes
+            activities_per_athlete: size of the generated history of every athlete
+            history_days: number of days the generated histories span
+            now: end of the generated histories, seconds since epoch
+            history_sizes: history sizes by athlete id, overriding activities_per_athlete
+        """
+        self.seed = seed
+        self.first_athlete_id = first_athlete_id
+        self.athlete_count = athlete_count
+        self.activities_per_athlete = activities_per_athlete
+        self.history_seconds = history_days * 86400
+        self.now = now
+        self.history_sizes = history_sizes or {}
+        self._athletes: Dict[int, SyntheticAthlete] = {}
+        self._polylines = "".join(random.Random(seed).choices(POLYLINE_ALPHABET, k=8192))
+
+    def _random(self, *keys: int) -> random.Random:
+        """Create a random number generator for one generated object, independent of the order of requests.
+
+        Args:
+            *keys: ids identifying the object
+
+        Returns:
+            random.Random
+        """
+        seed = self.seed
+        for key in keys:
+            seed = seed * 1_000_003 + key
+        return random.Random(seed)
+
+    def athlete_ids(self) -> range:
+        """Ids of all athletes.
+
+        Returns:
+            range of athlete ids
+        """
+        return range(self.first_athlete_id, self.first_athlete_id + self.athlete_count)
+
+    def get(self, athlete_id: int) -> Optional[SyntheticAthlete]:
+        """Get an athlete by id.
+
+        Args:
+            athlete_id: id of the athlete
+
+        Returns:
+            SyntheticAthlete or None if there is no athlete with this id
+        """
+        athlete = self._athletes.get(athlete_id)
+        if athlete is None and athlete_id in self.athlete_ids():
+            rng = self._random(athlete_id)
+            history_size = self.history_sizes.get(athlete_id, self.activities_per_athlete)
+            history_start = self.now - self.history_seconds
+            athlete = SyntheticAthlete(
+                id=athlete_id,
+                firstname=rng.choice(FIRST_NAMES),
+                lastname=rng.choice(LAST_NAMES),
+                created_at=history_start - rng.uniform(0, self.history_seconds),
+                history_size=history_size,
+                history_start=history_start,
+                interval=self.history_seconds / max(history_size, 1),
+            )
+            self._athletes[athlete_id] = athlete
+        return athlete
+
+    def random_athlete(self, rng: random.Random) -> SyntheticAthlete:
+        """Pick an athlete at random.
+
+        Args:
+            rng: random number generator
+
+        Returns:
+            SyntheticAthlete
+        """
+        return self.get(rng.choice(self.athlete_ids()))
+
+    def find_activity(self, activity_id: int) -> Tuple[Optional[SyntheticAthlete], int]:
+        """Find the athlete an activity belongs to.
+
+        Args:
+            activity_id: id of the activity
+
+        Returns:
+            SyntheticAthlete or None if the activity does not exist, index of the activity
+        """
+        athlete_id, index = divmod(activity_id, ACTIVITY_ID_STRIDE)
+        athlete = self.get(athlete_id)
+        if athlete is None or not athlete.has_activity(index):
+            return None, index
+        return athlete, index
+
+    def activity(self, athlete: SyntheticAthlete, index: int, detailed: bool = False) -> Dict:
+        """Generate an activity as returned by strava.
+
+        https://developers.strava.com/docs/reference/#api-models-SummaryActivity
+        https://developers.strava.com/docs/reference/#api-models-DetailedActivity
+
+        Args:
+            athlete: SyntheticAthlete
+            index: index of the activity in the history of the athlete
+            detailed: generate a DetailedActivity instead of a SummaryActivity
+
+        Returns:
+            dict
+        """
+        activity_id = athlete.activity_id(index)
+        rng = self._random(activity_id)
+        profile = rng.choices(SPORT_PROFILES, weights=SPORT_WEIGHTS)[0]
+        distance = round(rng.uniform(profile.min_distance, profile.max_distance), 1)
+        speed = profile.speed * rng.uniform(0.8, 1.2)
+        moving_time = int(distance / speed)
+        elapsed_time = int(moving_time * rng.uniform(1.0, 1.3))
+        elevation_gain = round(distance / 1000 * profile.climb * rng.uniform(0.5, 1.5), 1)
+        start = athlete.start_time(index)
+        # activities are recorded in central european time
+        start_local = start + 3600
+        hour = (start_local // 3600) % 24
+        daytime = next((name for first_hour, name in reversed(DAYTIMES) if hour >= first_hour), "Night")
+        polyline_start = rng.randrange(len(self._polylines))
+        polyline = self._polylines[polyline_start : polyline_start + min(int(distance / 25), 2000)]
+        start_latlng = [round(52.52 + rng.uniform(-0.2, 0.2), 6), round(13.40 + rng.uniform(-0.2, 0.2), 6)]
+
+        activity = {
+            "resource_state": 3 if detailed else 2,
+            "athlete": {"id": athlete.id, "resource_state": 1},
+            "name": athlete.names.get(index, f"{daytime} {profile.sport_type}"),
+            "distance": distance,
+            "moving_time": moving_time,
+            "elapsed_time": elapsed_time,
+            "total_elevation_gain": elevation_gain,
+            "type": profile.activity_type,
+            "sport_type": profile.sport_type,
+            "workout_type": None,
+            "id": activity_id,
+            "start_date": _timestamp(start),
+            "start_date_local": _timestamp(start_local),
+            "timezone": "(GMT+01:00) Europe/Berlin",
+            "utc_offset": 3600.0,
+            "location_city": None,
+            "location_state": None,
+            "location_country": "Germany",
+            "achievement_count": rng.randrange(5),
+            "kudos_count": rng.randrange(20),
+            "comment_count": rng.randrange(3),
+            "athlete_count": 1,
+            "photo_count": 0,
+            "map": {"id": f"a{activity_id}", "summary_polyline": polyline, "resource_state": 2},
+            "trainer": profile.sport_type == "VirtualRide",
+            "commute": False,
+            "manual": False,
+            "private": False,
+            "visibility": "everyone",
+            "flagged": False,
+            "gear_id": None,
+            "start_latlng": start_latlng,
+            "end_latlng": start_latlng,
+            "average_speed": round(distance / max(moving_time, 1), 3),
+            "max_speed": round(speed * rng.uniform(1.5, 2.5), 3),
+            "has_heartrate": False,
+            "heartrate_opt_out": False,
+            "display_hide_heartrate_option": False,
+            "elev_high": round(40 + elevation_gain / 2, 1),
+            "elev_low": 40.0,
+            "upload_id": activity_id,
+            "upload_id_str": str(activity_id),
+            "external_id": f"{activity_id}.fit",
+            "from_accepted_tag": False,
+            "pr_count": 0,
+            "total_photo_count": 0,
+            "has_kudoed": False,
+        }
+        if detailed:
+            activity.update(
+                {
+                    "description": None,
+                    "calories": round(moving_time / 3600 * rng.uniform(300, 800), 1),
+                    "device_name": "Garmin Edge 530",
+                    "embed_token": f"{activity_id:x}",
+                    "segment_efforts": [],
+                    "splits_metric": [
+                        {
+                            "distance": 1000.0,
+                            "elapsed_time": int(1000 / speed),
+                            "elevation_difference": round(profile.climb * rng.uniform(-1, 1), 1),
+                            "moving_time": int(1000 / speed),
+                            "split": split,
+                            "average_speed": round(speed, 3),
+                            "pace_zone": 0,
+                        }
+                        for split in range(1, min(int(distance / 1000), 200) + 1)
+                    ],
+                    "laps": [],
+                    "best_efforts": [],
+                },
+            )
+        return activity
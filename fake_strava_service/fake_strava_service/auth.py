@@ -0,0 +1,142 @@
+"""This module provides the TokenStore, issuing and checking the tokens of the fake OAuth flow.
+
+Refresh tokens and authorization codes carry the id of their athlete, "fake-refresh-<athlete id>" and
+"fake-code-<athlete id>", so users can be set up in the metriker database without talking to the fake first.
+"""
+import logging
+import secrets
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+REFRESH_TOKEN_PREFIX = "fake-refresh-"  # noqa: S105 - Ignore: prefix, not a password
+AUTHORIZATION_CODE_PREFIX = "fake-code-"
+# strava returns the current access token on a refresh, unless it expires within the hour
+ACCESS_TOKEN_REUSE_MARGIN = 3600
+
+
+def refresh_token_for(athlete_id: int) -> str:
+    """Get the refresh token of an athlete, which stays valid when tokens are rotated.
+
+    Args:
+        athlete_id: id of the athlete
+
+    Returns:
+        refresh token
+    """
+    return f"{REFRESH_TOKEN_PREFIX}{athlete_id}"
+
+
+def _athlete_id(token: Optional[str], prefix: str) -> Optional[int]:
+    """Read the athlete id of a refresh token or authorization code.
+
+    Args:
+        token: refresh token or authorization code
+        prefix: prefix of the token
+
+    Returns:
+        id of the athlete, None if the token is malformed
+    """
+    if not token or not token.startswith(prefix):
+        return None
+    athlete_id = token[len(prefix) :].partition("-")[0]
+    return int(athlete_id) if athlete_id.isdigit() else None
+
+
+@dataclass
+class AccessToken:
+    """Dataclass holding an issued access token."""
+
+    access_token: str
+    athlete_id: int
+    expires_at: int
+
+
+class TokenStore:
+    """Issued access tokens, one valid token per athlete."""
+
+    def __init__(self, lifetime: int = 21600, rotate_refresh_tokens: bool = False) -> None:
+        """Issued access tokens, one valid token per athlete.
+
+        Args:
+            lifetime: seconds an access token is valid
+            rotate_refresh_tokens: issue a new refresh token with every exchange
+        """
+        self.lifetime = lifetime
+        self.rotate_refresh_tokens = rotate_refresh_tokens
+        self._by_token: Dict[str, AccessToken] = {}
+        self._by_athlete: Dict[int, AccessToken] = {}
+
+    @staticmethod
+    def athlete_of_refresh_token(refresh_token: Optional[str]) -> Optional[int]:
+        """Read the athlete id of a refresh token.
+
+        Args:
+            refresh_token: refresh token
+
+        Returns:
+            id of the athlete, None if the token is malformed
+        """
+        return _athlete_id(refresh_token, REFRESH_TOKEN_PREFIX)
+
+    @staticmethod
+    def athlete_of_authorization_code(code: Optional[str]) -> Optional[int]:
+        """Read the athlete id of an authorization code.
+
+        Args:
+            code: authorization code
+
+        Returns:
+            id of the athlete, None if the code is malformed
+        """
+        return _athlete_id(code, AUTHORIZATION_CODE_PREFIX)
+
+    def issue(self, athlete_id: int, now: float) -> Dict:
+        """Issue an access token for an athlete, reusing the current one unless it expires soon.
+
+        Args:
+            athlete_id: id of the athlete
+            now: seconds since epoch
+
+        Returns:
+            token response as returned by strava
+        """
+        token = self._by_athlete.get(athlete_id)
+        if token is None or token.expires_at - now < ACCESS_TOKEN_REUSE_MARGIN:
+            if token is not None:
+                del self._by_token[token.access_token]
+            token = AccessToken(
+                access_token=secrets.token_hex(20),
+                athlete_id=athlete_id,
+                expires_at=int(now) + self.lifetime,
+            )
+            self._by_token[token.access_token] = token
+            self._by_athlete[athlete_id] = token
+
+        refresh_token = refresh_token_for(athlete_id)
+        if self.rotate_refresh_tokens:
+            refresh_token = f"{refresh_token}-{secrets.token_hex(8)}"
+        return {
+            "token_type": "Bearer",
+            "access_token": token.access_token,
+            "expires_at": token.expires_at,
+            "expires_in": token.expires_at - int(now),
+            "refresh_token": refresh_token,
+        }
+
+    def athlete_of_access_token(self, access_token: Optional[str], now: float) -> Optional[int]:
+        """Check an access token.
+
+        Args:
+            access_token: access token
+            now: seconds since epoch
+
+        Returns:
+            id of the athlete, None if the token is unknown or expired
+        """
+        token = self._by_token.get(access_token) if access_token else None
+        if token is None or token.expires_at <= now:
+            return None
+        return token.athlete_id
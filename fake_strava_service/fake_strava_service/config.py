@@ -0,0 +1,64 @@
+"""Config for the fake strava service.
+
+The config is read from env vars, .env files and default values in this order.
+"""
+from typing import Dict, List, Optional
+
+from pydantic import AnyUrl, BaseSettings, SecretStr
+
+
+class Settings(BaseSettings):
+    """Settings Class storing all settings passed by env vars."""
+
+    class Config:
+        """Config Class defines how settings are loaded from .env files and which prefixes define them."""
+
+        env_file = "./dev.env"
+        env_file_encoding = "utf-8"
+        env_prefix = "METRIKER_FAKE_STRAVA_"
+
+    ENVIRONMENT: str = "local"
+    LOGGING_CONFIG_PATH: str = "./logging.ini"
+
+    # credentials the token endpoint expects, any credentials are accepted if None
+    CLIENT_ID: Optional[str] = None
+    CLIENT_SECRET: Optional[SecretStr] = None
+    ACCESS_TOKEN_LIFETIME: int = 21600
+    # issue a new refresh token with every token exchange, like strava may do
+    ROTATE_REFRESH_TOKENS: bool = False
+
+    # synthetic athletes and their histories are generated from the seed, the same seed gives the same data
+    SEED: int = 0
+    FIRST_ATHLETE_ID: int = 1
+    ATHLETE_COUNT: int = 100
+    ACTIVITIES_PER_ATHLETE: int = 1000
+    # json object of athlete id -> number of activities, for athletes with a history size of their own
+    ATHLETE_ACTIVITIES: Dict[int, int] = {}
+    # the generated histories end at server start and go back this many days
+    HISTORY_DAYS: int = 3650
+
+    # limits of the 15 minute and daily windows, as reported in the X-RateLimit-* headers
+    RATE_LIMIT_15_MIN: int = 200
+    RATE_LIMIT_DAILY: int = 2000
+    READ_RATE_LIMIT_15_MIN: int = 100
+    READ_RATE_LIMIT_DAILY: int = 1000
+    # answer requests exceeding a limit with 429, only report the usage otherwise
+    ENFORCE_RATE_LIMITS: bool = True
+
+    # seconds every request is delayed by, plus a uniformly distributed jitter of up to LATENCY_JITTER seconds
+    LATENCY: float = 0.0
+    LATENCY_JITTER: float = 0.0
+    # share of requests answered with one of ERROR_STATUS_CODES
+    ERROR_RATE: float = 0.0
+    ERROR_STATUS_CODES: List[int] = [500, 502, 503]
+
+    # events are only emitted if a url is set, e.g. http://localhost:8001/webhook
+    WEBHOOK_URL: AnyUrl = None
+    WEBHOOK_SUBSCRIPTION_ID: int = 1
+    # average number of events emitted per second in the background, 0 emits events only on request
+    WEBHOOK_EVENTS_PER_SECOND: float = 0.0
+    # relative frequency of activity events by aspect type
+    WEBHOOK_EVENT_WEIGHTS: Dict[str, float] = {"create": 6.0, "update": 3.0, "delete": 1.0}
+
+
+settings = Settings()
@@ -0,0 +1,213 @@
+"""Endpoints of the fake_strava_service for metriker.
+
+The api endpoints follow the strava REST Api, https://developers.strava.com/docs/reference/,
+the remaining endpoints control the fake.
+"""
+import logging
+import time
+from http import HTTPStatus
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Request
+from fastapi.responses import ORJSONResponse
+
+from .athletes import AthleteRegistry, SyntheticAthlete
+from .auth import TokenStore
+from .config import settings
+from .faults import FaultInjector, StravaFaultError
+from .rate_limits import RateLimits
+from .webhook_emitter import WebhookEmitter
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+# maximum page size of list endpoints
+MAX_PER_PAGE = 200
+
+registry = AthleteRegistry(
+    seed=settings.SEED,
+    first_athlete_id=settings.FIRST_ATHLETE_ID,
+    athlete_count=settings.ATHLETE_COUNT,
+    activities_per_athlete=settings.ACTIVITIES_PER_ATHLETE,
+    history_days=settings.HISTORY_DAYS,
+    now=time.time(),
+    history_sizes=settings.ATHLETE_ACTIVITIES,
+)
+token_store = TokenStore(
+    lifetime=settings.ACCESS_TOKEN_LIFETIME,
+    rotate_refresh_tokens=settings.ROTATE_REFRESH_TOKENS,
+)
+rate_limits = RateLimits(
+    limit_15_min=settings.RATE_LIMIT_15_MIN,
+    limit_daily=settings.RATE_LIMIT_DAILY,
+    read_limit_15_min=settings.READ_RATE_LIMIT_15_MIN,
+    read_limit_daily=settings.READ_RATE_LIMIT_DAILY,
+    enforce=settings.ENFORCE_RATE_LIMITS,
+)
+fault_injector = FaultInjector(
+    latency=settings.LATENCY,
+    latency_jitter=settings.LATENCY_JITTER,
+    error_rate=settings.ERROR_RATE,
+    error_status_codes=settings.ERROR_STATUS_CODES,
+    seed=settings.SEED,
+)
+webhook_emitter = WebhookEmitter(
+    registry=registry,
+    webhook_url=settings.WEBHOOK_URL,
+    subscription_id=settings.WEBHOOK_SUBSCRIPTION_ID,
+    events_per_second=settings.WEBHOOK_EVENTS_PER_SECOND,
+    event_weights=settings.WEBHOOK_EVENT_WEIGHTS,
+    seed=settings.SEED,
+)
+
+# responses are returned as ORJSONResponse, which skips validating and encoding them field by field
+router = APIRouter()
+
+
+def _authenticated_athlete(request: Request) -> SyntheticAthlete:
+    """Get the athlete the bearer token of a request belongs to.
+
+    Args:
+        request: request to the api
+
+    Returns:
+        SyntheticAthlete
+    """
+    scheme, _, access_token = request.headers.get("Authorization", "").partition(" ")
+    athlete_id = token_store.athlete_of_access_token(access_token, time.time()) if scheme == "Bearer" else None
+    athlete = registry.get(athlete_id) if athlete_id is not None else None
+    if athlete is None:
+        raise StravaFaultError(
+            HTTPStatus.UNAUTHORIZED,
+            "Authorization Error",
+            [{"resource": "Athlete", "field": "access_token", "code": "invalid"}],
+        )
+    return athlete
+
+
+@router.post("/oauth/token")
+async def token(request: Request) -> ORJSONResponse:
+    """Exchange a refresh token or an authorization code for an access token.
+
+    Parameters are read from the form data or the query, like strava accepts them.
+
+    Args:
+        request: request with client_id, client_secret, grant_type and refresh_token or code
+
+    Returns:
+        200, token response, with the athlete for the authorization_code grant
+    """
+    params = {**request.query_params, **await request.form()}
+    if (settings.CLIENT_ID and params.get("client_id") != settings.CLIENT_ID) or (
+        settings.CLIENT_SECRET and params.get("client_secret") != settings.CLIENT_SECRET.get_secret_value()
+    ):
+        raise StravaFaultError(
+            HTTPStatus.UNAUTHORIZED,
+            "Authorization Error",
+            [{"resource": "Application", "field": "client_id", "code": "invalid"}],
+        )
+
+    grant_type = params.get("grant_type")
+    if grant_type == "refresh_token":
+        athlete_id = token_store.athlete_of_refresh_token(params.get("refresh_token"))
+        field = "refresh_token"
+    elif grant_type == "authorization_code":
+        athlete_id = token_store.athlete_of_authorization_code(params.get("code"))
+        field = "code"
+    else:
+        raise StravaFaultError(
+            HTTPStatus.BAD_REQUEST,
+            "Bad Request",
+            [{"resource": "Application", "field": "grant_type", "code": "invalid"}],
+        )
+    athlete = registry.get(athlete_id) if athlete_id is not None else None
+    if athlete is None:
+        raise StravaFaultError(
+            HTTPStatus.BAD_REQUEST,
+            "Bad Request",
+            [{"resource": "RefreshToken", "field": field, "code": "invalid"}],
+        )
+
+    content = token_store.issue(athlete.id, time.time())
+    if grant_type == "authorization_code":
+        content["athlete"] = athlete.to_api()
+    return ORJSONResponse(content)
+
+
+@router.get("/api/v3/athlete")
+async def get_logged_in_athlete(request: Request) -> ORJSONResponse:
+    """Implements getLoggedInAthlete.
+
+    Args:
+        request: request with bearer token
+
+    Returns:
+        200, DetailedAthlete
+    """
+    return ORJSONResponse(_authenticated_athlete(request).to_api())
+
+
+@router.get("/api/v3/athlete/activities")
+async def get_logged_in_athlete_activities(
+    request: Request,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    page: int = 1,
+    per_page: int = 30,
+) -> ORJSONResponse:
+    """Implements getLoggedInAthleteActivities.
+
+    Args:
+        request: request with bearer token
+        before: only activities starting before, seconds since epoch
+        after: only activities starting after, seconds since epoch
+        page: number of the page, starting at 1
+        per_page: number of activities per page, at most 200
+
+    Returns:
+        200, list of SummaryActivity
+    """
+    athlete = _authenticated_athlete(request)
+    indices = athlete.list_activities(
+        before=before,
+        after=after,
+        page=max(page, 1),
+        per_page=min(max(per_page, 1), MAX_PER_PAGE),
+    )
+    return ORJSONResponse([registry.activity(athlete, index) for index in indices])
+
+
+@router.get("/api/v3/activities/{activity_id}")
+async def get_activity_by_id(request: Request, activity_id: int) -> ORJSONResponse:
+    """Implements getActivityById.
+
+    Args:
+        request: request with bearer token
+        activity_id: id of the activity
+
+    Returns:
+        200, DetailedActivity
+    """
+    athlete = _authenticated_athlete(request)
+    owner, index = registry.find_activity(activity_id)
+    # activities of other athletes are not visible, strava answers them like unknown activities
+    if owner is None or owner.id != athlete.id:
+        raise StravaFaultError(
+            HTTPStatus.NOT_FOUND,
+            "Record Not Found",
+            [{"resource": "Activity", "field": "id", "code": "invalid"}],
+        )
+    return ORJSONResponse(registry.activity(athlete, index, detailed=True))
+
+
+@router.post("/emitWebhookEvents")
+async def emit_webhook_events(count: int = 1) -> List[Dict]:
+    """Change random activities and send webhook events about the changes to the configured webhook.
+
+    Args:
+        count: number of events
+
+    Returns:
+        200, list of emitted events
+    """
+    return await webhook_emitter.emit(count)
@@ -0,0 +1,112 @@
+"""This module provides strava style error responses and the FaultInjector delaying and failing requests.
+
+Errors are answered with the Fault object of strava:
+https://developers.strava.com/docs/reference/#api-models-Fault
+"""
+import asyncio
+import logging
+import random
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+# paths of the fake strava api, requests to other paths are neither delayed nor failed nor rate limited
+API_PATHS = ("/api/v3", "/oauth")
+
+
+class StravaFaultError(Exception):
+    """Request is answered with an error as strava would answer it."""
+
+    def __init__(self, status_code: int, message: str, errors: Optional[List[Dict]] = None) -> None:
+        """Init of StravaFaultError Exception.
+
+        Args:
+            status_code: http status code of the response
+            message: message of the Fault object
+            errors: list of Error objects, e.g. {"resource": "Athlete", "field": "access_token", "code": "invalid"}
+        """
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.errors = errors or []
+
+
+def fault_response(status_code: int, message: str, errors: Optional[List[Dict]] = None) -> ORJSONResponse:
+    """Build a response holding a strava Fault object.
+
+    Args:
+        status_code: http status code of the response
+        message: message of the Fault object
+        errors: list of Error objects
+
+    Returns:
+        ORJSONResponse
+    """
+    return ORJSONResponse({"message": message, "errors": errors or []}, status_code=status_code)
+
+
+async def strava_fault_handler(_: Request, fault: StravaFaultError) -> ORJSONResponse:
+    """Answer a raised StravaFaultError, registered as exception handler of the app.
+
+    Args:
+        _: request that raised the fault
+        fault: StravaFaultError raised by an endpoint
+
+    Returns:
+        ORJSONResponse
+    """
+    return fault_response(fault.status_code, fault.message, fault.errors)
+
+
+class FaultInjector:
+    """Http middleware adding latency to requests and answering a share of them with errors."""
+
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_status_codes: Sequence[int] = (HTTPStatus.INTERNAL_SERVER_ERROR,),
+        seed: Optional[int] = None,
+    ) -> None:
+        """Http middleware adding latency to requests and answering a share of them with errors.
+
+        Args:
+            latency: seconds every request is delayed by
+            latency_jitter: maximum seconds added to latency, uniformly distributed
+            error_rate: share of requests answered with an error, 0 to 1
+            error_status_codes: status codes of injected errors, picked at random
+            seed: seed of the random decisions
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status_codes = list(error_status_codes)
+        self._random = random.Random(seed)
+
+    async def __call__(self, request: Request, call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+        """Delay the request and answer it with an error or pass it on.
+
+        Args:
+            request: incoming request
+            call_next: handler of the request
+
+        Returns:
+            Response
+        """
+        if not request.url.path.startswith(API_PATHS):
+            return await call_next(request)
+
+        delay = self.latency + self._random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self._random.random() < self.error_rate:
+            status_code = self._random.choice(self.error_status_codes)
+            logger.info("Injected error %s for %s", status_code, request.url.path)
+            return fault_response(status_code, HTTPStatus(status_code).phrase)
+        return await call_next(request)
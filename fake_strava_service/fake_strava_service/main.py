@@ -0,0 +1,32 @@
+"""Main Api of the fake_strava_service for metriker.
+
+This service stands in for the strava api in load tests, see the README of the fake_strava_service.
+"""
+import logging.config
+
+from fastapi import FastAPI
+
+from . import endpoints
+from .config import settings
+from .faults import StravaFaultError, strava_fault_handler
+
+# setup logging
+logging.config.fileConfig(settings.LOGGING_CONFIG_PATH, disable_existing_loggers=False)
+logger = logging.getLogger(__name__)
+
+SHOW_DOCS_ENVIRONMENT = ("local",)
+
+app_config = {}
+# disable openapi docs if not in local environment
+if settings.ENVIRONMENT not in SHOW_DOCS_ENVIRONMENT:
+    app_config["openapi_url"] = None
+
+app = FastAPI(**app_config)
+app.include_router(endpoints.router)
+app.add_exception_handler(StravaFaultError, strava_fault_handler)
+# the middleware added last runs first: requests are counted against the rate limits before faults are injected
+app.middleware("http")(endpoints.fault_injector)
+app.middleware("http")(endpoints.rate_limits)
+# change activities and send webhook events in the background
+app.add_event_handler("startup", endpoints.webhook_emitter.start)
+app.add_event_handler("shutdown", endpoints.webhook_emitter.stop)
@@ -0,0 +1,146 @@
+"""This module provides the RateLimits middleware, counting api requests like strava does.
+
+Strava limits the requests of an application in 15 minute windows, starting at 0, 15, 30 and 45 minutes
+past the hour, and in daily windows, starting at midnight utc. Every response reports the limits and
+the usage of both windows in the X-RateLimit-* headers, read requests additionally in the X-ReadRateLimit-* headers.
+Requests exceeding a limit are answered with 429 and still count towards the usage.
+"""
+import logging
+import time
+from dataclasses import dataclass
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict
+
+from fastapi import Request, Response
+
+from .faults import fault_response
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+API_PATH = "/api/v3"
+WINDOW_15_MIN_SECONDS = 900
+WINDOW_DAILY_SECONDS = 86400
+
+
+@dataclass
+class Window:
+    """Dataclass counting the requests in fixed windows of a length."""
+
+    limit: int
+    seconds: int
+    # number of the current window since epoch
+    window: int = -1
+    usage: int = 0
+
+    def current_usage(self, now: float) -> int:
+        """Get the usage of the window now falls into.
+
+        Args:
+            now: seconds since epoch
+
+        Returns:
+            number of requests
+        """
+        if int(now // self.seconds) != self.window:
+            return 0
+        return self.usage
+
+    def count(self, now: float) -> bool:
+        """Count a request.
+
+        Args:
+            now: seconds since epoch
+
+        Returns:
+            True if the request exceeds the limit
+        """
+        window = int(now // self.seconds)
+        if window != self.window:
+            self.window = window
+            self.usage = 0
+        self.usage += 1
+        return self.usage > self.limit
+
+
+class RateLimits:
+    """Http middleware counting api requests in the 15 minute and daily windows and reporting the usage."""
+
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        limit_15_min: int = 200,
+        limit_daily: int = 2000,
+        read_limit_15_min: int = 100,
+        read_limit_daily: int = 1000,
+        enforce: bool = True,
+    ) -> None:
+        """Http middleware counting api requests in the 15 minute and daily windows and reporting the usage.
+
+        Args:
+            limit_15_min: limit of all requests per 15 minute window
+            limit_daily: limit of all requests per day
+            read_limit_15_min: limit of read requests per 15 minute window
+            read_limit_daily: limit of read requests per day
+            enforce: answer requests exceeding a limit with 429, only report the usage if False
+        """
+        self.overall = (Window(limit_15_min, WINDOW_15_MIN_SECONDS), Window(limit_daily, WINDOW_DAILY_SECONDS))
+        self.read = (Window(read_limit_15_min, WINDOW_15_MIN_SECONDS), Window(read_limit_daily, WINDOW_DAILY_SECONDS))
+        self.enforce = enforce
+
+    def count(self, now: float, read: bool) -> bool:
+        """Count a request in all windows it falls into.
+
+        Args:
+            now: seconds since epoch
+            read: the request only reads data
+
+        Returns:
+            True if the request exceeds a limit
+        """
+        windows = (*self.overall, *self.read) if read else self.overall
+        # count in every window, a request exceeding one limit still counts towards the others
+        exceeded = [window.count(now) for window in windows]
+        return any(exceeded)
+
+    def headers(self, now: float) -> Dict[str, str]:
+        """Build the rate limit headers of a response.
+
+        Args:
+            now: seconds since epoch
+
+        Returns:
+            dict of header -> value
+        """
+        return {
+            "X-RateLimit-Limit": ",".join(str(window.limit) for window in self.overall),
+            "X-RateLimit-Usage": ",".join(str(window.current_usage(now)) for window in self.overall),
+            "X-ReadRateLimit-Limit": ",".join(str(window.limit) for window in self.read),
+            "X-ReadRateLimit-Usage": ",".join(str(window.current_usage(now)) for window in self.read),
+        }
+
+    async def __call__(self, request: Request, call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+        """Count an api request and add the rate limit headers to its response.
+
+        Args:
+            request: incoming request
+            call_next: handler of the request
+
+        Returns:
+            Response
+        """
+        if not request.url.path.startswith(API_PATH):
+            return await call_next(request)
+
+        now = time.time()
+        exceeded = self.count(now, read=request.method in ("GET", "HEAD"))
+        if exceeded and self.enforce:
+            logger.info("Rate limit exceeded for %s", request.url.path)
+            response = fault_response(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                "Rate Limit Exceeded",
+                [{"resource": "Application", "field": "rate limit", "code": "exceeded"}],
+            )
+        else:
+            response = await call_next(request)
+        response.headers.update(self.headers(now))
+        return response
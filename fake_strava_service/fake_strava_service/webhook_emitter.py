@@ -0,0 +1,150 @@
+"""This module provides the WebhookEmitter, changing synthetic activities and sending webhook events about them.
+
+Events have the shape of the events strava sends to a push subscription, every event is sent in a request of its own:
+https://developers.strava.com/docs/webhooks/
+"""
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from .athletes import AthleteRegistry
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+
+class WebhookEmitter:
+    """Emitter of activity events, on request or as a poisson process in the background."""
+
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        registry: AthleteRegistry,
+        webhook_url: Optional[str],
+        subscription_id: int = 1,
+        events_per_second: float = 0.0,
+        event_weights: Optional[Dict[str, float]] = None,
+        seed: Optional[int] = None,
+        timeout: float = 2.0,
+    ) -> None:
+        """Emitter of activity events, on request or as a poisson process in the background.
+
+        Args:
+            registry: athletes whose activities are changed
+            webhook_url: url events are sent to, events are only generated if None
+            subscription_id: id of the push subscription sent with every event
+            events_per_second: average rate of events emitted in the background, 0 disables the background emitter
+            event_weights: relative frequency of the aspect types create, update and delete
+            seed: seed of the random events
+            timeout: seconds to wait for the webhook, strava waits two seconds
+        """
+        self.registry = registry
+        self.webhook_url = webhook_url
+        self.subscription_id = subscription_id
+        self.events_per_second = events_per_second
+        event_weights = event_weights or {"create": 1.0}
+        self.aspect_types = list(event_weights)
+        self.aspect_weights = list(event_weights.values())
+        self.timeout = timeout
+
+        self._random = random.Random(seed)
+        self._http: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Start emitting events in the background if a rate and a url are set.
+
+        Returns:
+            None
+        """
+        self._http = httpx.AsyncClient(timeout=self.timeout)
+        if self.events_per_second > 0 and self.webhook_url:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop emitting events and close the connections to the webhook.
+
+        Returns:
+            None
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                logger.info("Stopped webhook emitter")
+            self._task = None
+        if self._http:
+            await self._http.aclose()
+            self._http = None
+
+    async def _run(self) -> None:
+        """Emit events with exponentially distributed pauses until cancelled.
+
+        Returns:
+            None
+        """
+        while True:
+            await asyncio.sleep(self._random.expovariate(self.events_per_second))
+            try:
+                await self.emit()
+            except httpx.HTTPError:
+                logger.exception("Sending webhook event failed")
+
+    def _next_event(self) -> Optional[Dict]:
+        """Change a random activity of a random athlete and describe the change as webhook event.
+
+        Returns:
+            event, None if no activity was found to update or delete
+        """
+        now = time.time()
+        athlete = self.registry.random_athlete(self._random)
+        aspect_type = self._random.choices(self.aspect_types, weights=self.aspect_weights)[0]
+        updates = {}
+        if aspect_type == "create":
+            index = athlete.create_activity(now)
+        else:
+            index = athlete.random_activity(self._random)
+            if index is None:
+                return None
+            if aspect_type == "update":
+                title = f"Renamed activity {self._random.randrange(1000)}"
+                athlete.names[index] = title
+                updates = {"title": title}
+            else:
+                athlete.deleted.add(index)
+        return {
+            "aspect_type": aspect_type,
+            "event_time": int(now),
+            "object_id": athlete.activity_id(index),
+            "object_type": "activity",
+            "owner_id": athlete.id,
+            "subscription_id": self.subscription_id,
+            "updates": updates,
+        }
+
+    async def emit(self, count: int = 1) -> List[Dict]:
+        """Change random activities and send an event about every change to the webhook.
+
+        Args:
+            count: number of events
+
+        Returns:
+            list of emitted events
+        """
+        events = []
+        for _ in range(count):
+            event = self._next_event()
+            if event is None:
+                continue
+            events.append(event)
+            if not self.webhook_url or not self._http:
+                continue
+            response = await self._http.post(self.webhook_url, json=event)
+            if not response.is_success:
+                logger.warning("Webhook answered event with %s", response.status_code)
+        logger.info("Emitted %s webhook events", len(events))
+        return events
@@ -1,8 +1,13 @@
 """Entrypoint of the metriker flet app."""
 import flet as ft
+from database_utils.database_connector import dispose_engines
 
 from metriker_app.config import settings
 from metriker_app.main import main
 
 if __name__ == "__main__":
-    ft.app(target=main, port=settings.APP_PORT, view=ft.WEB_BROWSER)
+    try:
+        ft.app(target=main, port=settings.APP_PORT, view=ft.WEB_BROWSER)
+    finally:
+        # close pooled database connections once the app stopped serving
+        dispose_engines()
@@ -3,6 +3,8 @@
 The config is read from env vars, .env files and default values in this order.
 """
 
+from typing import Dict
+
 from pydantic import AnyUrl, BaseSettings, SecretStr
 
 
@@ -38,8 +40,18 @@ class Settings(BaseSettings):
     DB_HOST: str
     DB_PORT: str
     DB_NAME: str
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_RECYCLE: int = 3600
+    USER_CACHE_TTL: float = 60.0
+    USER_CACHE_SIZE: int = 1024
 
     SECRET_KEY: SecretStr
+    # increase when rotating SECRET_KEY and keep the old key in PREVIOUS_SECRET_KEYS until tokens are re-encrypted
+    SECRET_KEY_VERSION: int = 1
+    # json object of key version -> secret key, version 0 defaults to SECRET_KEY while SECRET_KEY_VERSION is 1,
+    # after a rotation it is required as long as tokens written by flet.security are left
+    PREVIOUS_SECRET_KEYS: Dict[int, SecretStr] = {}
 
 
 settings = Settings()
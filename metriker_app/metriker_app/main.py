@@ -16,6 +16,34 @@ logger = logging.getLogger(__name__)
 # setup logging to sentry
 sentry_sdk.init(dsn=settings.SENTRY_DSN)
 
+# database wrappers are shared by all sessions of this process
+# they hold no per-session state and hand out thread scoped sessions from one connection pool
+user_handler = StravaUserHandler(
+    secret_key=settings.SECRET_KEY.get_secret_value(),
+    user=settings.DB_USER,
+    password=settings.DB_PASS.get_secret_value(),
+    host=settings.DB_HOST,
+    port=settings.DB_PORT,
+    database=settings.DB_NAME,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    cache_ttl=settings.USER_CACHE_TTL,
+    cache_size=settings.USER_CACHE_SIZE,
+    secret_key_version=settings.SECRET_KEY_VERSION,
+    previous_secret_keys={version: key.get_secret_value() for version, key in settings.PREVIOUS_SECRET_KEYS.items()},
+)
+activity_handler = StravaActivityHandler(
+    user=settings.DB_USER,
+    password=settings.DB_PASS.get_secret_value(),
+    host=settings.DB_HOST,
+    port=settings.DB_PORT,
+    database=settings.DB_NAME,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+)
+
 
 def main(page: ft.Page) -> None:
     """Initialize all Components of the Metriker App.
@@ -40,22 +68,6 @@ def main(page: ft.Page) -> None:
         user_scopes=[settings.STRAVA_USER_SCOPES],
         user_id_fn=lambda user: user["id"],
     )
-    user_handler = StravaUserHandler(
-        secret_key=settings.SECRET_KEY.get_secret_value(),
-        user=settings.DB_USER,
-        password=settings.DB_PASS.get_secret_value(),
-        host=settings.DB_HOST,
-        port=settings.DB_PORT,
-        database=settings.DB_NAME,
-    )
-    activity_handler = StravaActivityHandler(
-        user=settings.DB_USER,
-        password=settings.DB_PASS.get_secret_value(),
-        host=settings.DB_HOST,
-        port=settings.DB_PORT,
-        database=settings.DB_NAME,
-    )
-
     app = Metriker(
         page=page,
         auth_provider=auth_provider,
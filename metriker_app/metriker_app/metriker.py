@@ -65,7 +65,8 @@ class Metriker(ft.UserControl):
         # url of server interfacing with strava api to request activities
         self.strava_service_url = strava_service_url
 
-        self.challenges_view = ChallengesView(self)
+        # created on first visit after login, the avatar in its AppBar depends on the logged-in user
+        self.challenges_view = None
 
     def build(self) -> ft.Column:
         """Method required to create initial site.
@@ -101,8 +102,8 @@ class Metriker(ft.UserControl):
         if not event.error:
             # set user
             self.user = self.page.auth.user
-            # initialise challenges view
-            self.challenges_view = ChallengesView(self)
+            # the challenges view is built on first visit with the new user
+            self.challenges_view = None
             existing_user = self.user_handler.get(self.user.id)
             if not existing_user:
                 # add new user to db
@@ -157,6 +158,16 @@ class Metriker(ft.UserControl):
         self.page.update()
         self.page.go("/")
 
+    def _get_challenges_view(self) -> ChallengesView:
+        """Get the challenges view of this session, creating it on first use.
+
+        Returns:
+            ChallengesView
+        """
+        if self.challenges_view is None:
+            self.challenges_view = ChallengesView(self)
+        return self.challenges_view
+
     def route_change(self, _: ft.RouteChangeEvent) -> None:  # noqa: C901 - Ignore: `route_change` is too complex
         """Handle route changes by setting appropriate views and content.
 
@@ -186,24 +197,25 @@ class Metriker(ft.UserControl):
 
         # handle challenges views
         if template_route.match("/challenges*"):
+            challenges_view = self._get_challenges_view()
             # redirect to first challenge
             if template_route.match("/challenges"):
                 self.page.views.clear()
-                self.page.views.append(self.challenges_view)
+                self.page.views.append(challenges_view)
                 self.page.update()
-                first_challenge = list(self.challenges_view.challenges.values())[0]
+                first_challenge = list(challenges_view.challenges.values())[0]
                 self.page.go(f"/challenges/{first_challenge.name}")
             # set internal content of the challenges view to match the selected challenge
             if template_route.match("/challenges/:challenge_name"):
                 # attributes are assigned dynamically
                 challenge_name = template_route.challenge_name
-                self.challenges_view.set_active_challenge(challenge_name)
+                challenges_view.set_active_challenge(challenge_name)
 
         # handle user views
         if template_route.match("/user/:user_id"):
             # attributes are assigned dynamically
             user_id = template_route.user_id
-            if user_id not in self.user_handler.keys():
+            if user_id not in self.user_handler:
                 self.page.go("/")
                 return
             self.page.views.append(UserView(self, user_id=user_id))
@@ -1,38 +1,32 @@
 """Module holding ChallengesView."""
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List, Optional
 
 import flet as ft
+from database_utils.challenges import CHALLENGES
 
 from .base_view import BaseView
+from .formatting import format_metric
 
 if TYPE_CHECKING:
-    from ..metriker import Metriker
-
-
-@dataclass
-class Challenge:
-    """Temporary Dataclass to define a challenge."""
-
-    name: str
-    icon: str
-    content: ft.Control
+    from database_utils.challenges import ChallengeDefinition
+    from database_utils.leaderboard import LeaderboardEntry
+    from database_utils.user_handler import StravaUserSummary
 
-
-CHALLENGES = {
-    "bike": Challenge(name="bike", icon=ft.icons.PEDAL_BIKE, content=ft.Container(content=ft.Text("bike"))),
-    "run": Challenge(name="run", icon=ft.icons.HIKING, content=ft.Container(content=ft.Text("run"))),
-}
+    from ..metriker import Metriker
 
 
 class ChallengesView(BaseView):
     """ChallengesView expands the BaseView with a NavBar on the bottom of the page.
 
     The content of every challenge is displayed in the center and can be changed with the NavBAr.
+    Users are listed page by page and can be searched by name, so the view stays small for large communities.
     """
 
+    # number of users loaded at once into the user list
+    users_per_page = 50
+
     def __init__(self, app: Metriker, *args, **kwargs) -> None:
         """Init of ChallengesView.
 
@@ -49,37 +43,106 @@ class ChallengesView(BaseView):
         self.nav_bar = self._create_nav_bar()
         self._active_content = ft.Container()
 
+        # state of the paginated user list
+        self._search: Optional[str] = None
+        self._last_user: Optional[StravaUserSummary] = None
+        self._search_field = ft.TextField(
+            label="Search athletes",
+            prefix_icon=ft.icons.SEARCH,
+            on_change=self.on_search_change,
+        )
+        self._user_list = ft.Column(scroll=ft.ScrollMode.AUTO, expand=True)
+        self._load_more_button = ft.TextButton(text="Load more", on_click=self.on_load_more, visible=False)
+
         # add controls to frame
         self.extend_controls()
 
     def extend_controls(self) -> None:
         """Extends the contents of the page.
 
-        Adds buttons leading to each user to the content section and a NavBar to the bottom of the page.
+        Adds a search field and the first page of buttons leading to each user to the content section
+        and a NavBar to the bottom of the page.
         Overrides the extend_controls method of BaseView.
 
         Returns:
             None
         """
+        self._load_users()
         self.controls.extend(
             [
                 self.nav_bar,
-                ft.Column(
-                    controls=[
-                        ft.FilledButton(
-                            text=f"{user.name}",
-                            on_click=lambda e: self.app.page.go(f"/user/{e.control.data}"),
-                            data=user.id,
-                        )
-                        for user in self.app.user_handler.values()
-                    ],
-                    scroll=ft.ScrollMode.AUTO,
-                    expand=True,
-                ),
+                self._search_field,
+                self._user_list,
+                self._load_more_button,
                 self._active_content,
             ],
         )
 
+    def _create_user_button(self, user: StravaUserSummary) -> ft.Control:
+        """Creates a Button leading to the page of a user.
+
+        Args:
+            user: StravaUserSummary
+
+        Returns:
+            ft.FilledButton
+        """
+        return ft.FilledButton(
+            text=f"{user.name}",
+            on_click=lambda e: self.app.page.go(f"/user/{e.control.data}"),
+            data=user.id,
+        )
+
+    def _load_users(self, reset: bool = False) -> None:
+        """Append the next page of users matching the current search to the user list.
+
+        One more user than shown is requested to know whether another page exists.
+
+        Args:
+            reset: clear the list and start over at the first page
+
+        Returns:
+            None
+        """
+        if reset:
+            self._user_list.controls.clear()
+            self._last_user = None
+        users = self.app.user_handler.page_summaries(
+            limit=self.users_per_page + 1,
+            search=self._search,
+            after=self._last_user,
+        )
+        page = users[: self.users_per_page]
+        self._user_list.controls.extend(self._create_user_button(user) for user in page)
+        if page:
+            self._last_user = page[-1]
+        self._load_more_button.visible = len(users) > self.users_per_page
+
+    def on_search_change(self, _: ft.ControlEvent) -> None:
+        """Trigger flow when the text of the search field changes.
+
+        Args:
+            _: unused event provided by the search field.
+
+        Returns:
+            None
+        """
+        self._search = self._search_field.value.strip() or None
+        self._load_users(reset=True)
+        self.update()
+
+    def on_load_more(self, _: ft.ControlEvent) -> None:
+        """Trigger flow when the button to load more users is clicked.
+
+        Args:
+            _: unused event provided by the button.
+
+        Returns:
+            None
+        """
+        self._load_users()
+        self.update()
+
     def _create_nav_bar(self) -> ft.NavigationBar:
         """Creates and ft.NavigationBar Control containing the available challenges.
 
@@ -88,13 +151,74 @@ class ChallengesView(BaseView):
         """
         return ft.NavigationBar(
             destinations=[
-                ft.NavigationDestination(icon=challenge.icon, label=challenge.name)
+                ft.NavigationDestination(icon=challenge.icon, label=challenge.title or challenge.name)
                 for challenge in self.challenges.values()
             ],
             selected_index=0,
             on_change=self.on_nav_change,
         )
 
+    @staticmethod
+    def _create_team_progress(challenge: ChallengeDefinition, entries: List[LeaderboardEntry]) -> List[ft.Control]:
+        """Creates Controls showing the score of all users together in a team challenge.
+
+        Args:
+            challenge: ChallengeDefinition of a team challenge
+            entries: all leaderboard entries of the challenge
+
+        Returns:
+            list of ft.Control
+        """
+        team_score = sum(entry.score or 0 for entry in entries)
+        if not challenge.goal:
+            return [ft.Text(f"Together: {format_metric(challenge.metric, team_score)}", size=18)]
+        return [
+            ft.Text(
+                f"Together: {format_metric(challenge.metric, team_score)} "
+                f"of {format_metric(challenge.metric, challenge.goal)}",
+                size=18,
+            ),
+            ft.ProgressBar(value=min(team_score / challenge.goal, 1.0), width=400),
+        ]
+
+    def _create_leaderboard(self, challenge: ChallengeDefinition, entries: List[LeaderboardEntry]) -> ft.Control:
+        """Creates a Control listing the score of every user in a challenge.
+
+        Args:
+            challenge: ChallengeDefinition
+            entries: leaderboard entries ordered by rank
+
+        Returns:
+            ft.Container
+        """
+        if not entries:
+            return ft.Container(content=ft.Text("No activities yet"))
+        header = self._create_team_progress(challenge, entries) if challenge.team else []
+        return ft.Container(
+            content=ft.Column(
+                controls=[
+                    *header,
+                    *(
+                        ft.Row(
+                            controls=[
+                                ft.Text(f"{rank}.", width=40),
+                                ft.TextButton(
+                                    text=entry.user_name,
+                                    on_click=lambda e: self.app.page.go(f"/user/{e.control.data}"),
+                                    data=entry.user_id,
+                                    width=160,
+                                ),
+                                ft.Text(format_metric(challenge.metric, entry.score), width=100),
+                                ft.Text(f"{entry.activity_count} activities"),
+                            ],
+                        )
+                        for rank, entry in enumerate(entries, start=1)
+                    ),
+                ],
+                scroll=ft.ScrollMode.AUTO,
+            ),
+        )
+
     def set_active_challenge(self, name: str) -> None:
         """Sets the active challenge to be displayed.
 
@@ -104,7 +228,14 @@ class ChallengesView(BaseView):
         Returns:
             None
         """
-        self._active_content = self.challenges[name].content
+        challenge = self.challenges.get(name)
+        if challenge is None:
+            self._active_content = ft.Container(content=ft.Text("Unknown challenge"))
+        else:
+            self._active_content = self._create_leaderboard(
+                challenge,
+                self.app.activity_handler.get_leaderboard(name),
+            )
         self.controls[-1] = self._active_content
         self.update()
 
@@ -0,0 +1,45 @@
+"""This module provides helpers formatting activity metrics for display."""
+
+
+def format_duration(seconds: int) -> str:
+    """Format a duration in seconds as hours and minutes.
+
+    Args:
+        seconds: duration in seconds
+
+    Returns:
+        str, e.g. "12:05 h"
+    """
+    hours, minutes = divmod(int(seconds or 0) // 60, 60)
+    return f"{hours}:{minutes:02d} h"
+
+
+def format_distance(meters: float) -> str:
+    """Format a distance in meters as kilometers.
+
+    Args:
+        meters: distance in meters
+
+    Returns:
+        str, e.g. "42.2 km"
+    """
+    return f"{(meters or 0) / 1000:.1f} km"
+
+
+def format_metric(metric: str, value: float) -> str:
+    """Format the value of an activity metric, as scored by challenges, in its unit.
+
+    Args:
+        metric: name of the metric, see database_utils.challenges.METRICS
+        value: value of the metric
+
+    Returns:
+        str, e.g. "42.2 km"
+    """
+    if metric == "distance":
+        return format_distance(value)
+    if metric in ("moving_time", "elapsed_time"):
+        return format_duration(value)
+    if metric == "total_elevation_gain":
+        return f"{value or 0:.0f} m"
+    return f"{value or 0:.0f}"
@@ -1,14 +1,16 @@
 """Module holding UserView."""
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List
 
 import flet as ft
 
 from .base_view import BaseView
+from .formatting import format_distance, format_duration
 
 if TYPE_CHECKING:
     from database_utils.user_handler import StravaUser
+    from database_utils.user_stats import PeriodTotal, PersonalBest, UserStats
 
     from ..metriker import Metriker
 
@@ -28,17 +30,94 @@ class UserView(BaseView):
         super().__init__(app, *args, **kwargs)
         self.app = app
         self.route = f"/user/{user_id}"
+        # the refresh token of the user is not decrypted, only the name is shown
         self.user: StravaUser = self.app.user_handler.get(user_id)
+        self.stats: UserStats = self.app.activity_handler.get_user_stats(user_id)
 
         # add controls to frame
         self.extend_controls()
 
     def extend_controls(self) -> None:
-        """Adds username to content section.
+        """Adds username, streaks, personal bests and weekly and monthly totals to content section.
 
         Overrides the extend_controls method of BaseView.
 
         Returns:
             None
         """
-        self.controls.extend([ft.Text(self.user.name)])
+        self.controls.extend(
+            [
+                ft.Text(self.user.name, size=24),
+                ft.Text(
+                    f"Current streak: {self.stats.current_streak} days    "
+                    f"Longest streak: {self.stats.longest_streak} days",
+                ),
+                ft.Column(
+                    controls=[
+                        self._create_personal_bests(self.stats.personal_bests),
+                        self._create_period_totals("Weekly", self.stats.weekly),
+                        self._create_period_totals("Monthly", self.stats.monthly),
+                    ],
+                    scroll=ft.ScrollMode.AUTO,
+                    expand=True,
+                ),
+            ],
+        )
+
+    @staticmethod
+    def _create_personal_bests(personal_bests: List[PersonalBest]) -> ft.Control:
+        """Creates a Control listing the best single activities of the user per sport type.
+
+        Args:
+            personal_bests: list of PersonalBest
+
+        Returns:
+            ft.Column
+        """
+        return ft.Column(
+            controls=[
+                ft.Text("Personal bests", size=18),
+                *(
+                    ft.Row(
+                        controls=[
+                            ft.Text(best.sport_type, width=160),
+                            ft.Text(format_distance(best.longest_distance), width=100),
+                            ft.Text(format_duration(best.longest_moving_time), width=100),
+                            ft.Text(f"{best.most_elevation_gain:.0f} m", width=80),
+                            ft.Text(f"{best.activity_count} activities"),
+                        ],
+                    )
+                    for best in personal_bests
+                ),
+            ],
+        )
+
+    @staticmethod
+    def _create_period_totals(title: str, totals: List[PeriodTotal]) -> ft.Control:
+        """Creates a Control listing the totals of the user per period and sport type.
+
+        Args:
+            title: title of the section, e.g. "Weekly"
+            totals: list of PeriodTotal ordered by period
+
+        Returns:
+            ft.Column
+        """
+        return ft.Column(
+            controls=[
+                ft.Text(title, size=18),
+                *(
+                    ft.Row(
+                        controls=[
+                            ft.Text(total.period_start.isoformat(), width=100),
+                            ft.Text(total.sport_type, width=160),
+                            ft.Text(format_distance(total.distance), width=100),
+                            ft.Text(format_duration(total.moving_time), width=100),
+                            ft.Text(f"{total.total_elevation_gain:.0f} m", width=80),
+                            ft.Text(f"{total.activity_count} activities"),
+                        ],
+                    )
+                    for total in totals
+                ),
+            ],
+        )
@@ -0,0 +1,262 @@
+"""This module provides an async wrapper for the strava REST api.
+
+Waiting for strava does not block a thread, so one worker can have many outstanding api calls.
+Database access of the user handler is blocking and runs in the threadpool.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict
+
+import httpx
+from database_utils.user_handler import StravaUserHandler
+from fastapi.concurrency import run_in_threadpool
+
+from .rate_limiter import Priority, RateLimitScheduler
+from .strava_handler import (
+    RETRY_STATUS_CODES,
+    STRAVA_API_URL,
+    STRAVA_TOKEN_URL,
+    BaseStravaHandler,
+    TokenRefreshFailed,
+)
+from .token_cache import AccessToken, TokenCache
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+
+def create_async_http_client(pool_size: int = 10, max_retries: int = 3, timeout: int = 15) -> httpx.AsyncClient:
+    """Create a httpx.AsyncClient keeping pooled connections alive and retrying failed connection attempts.
+
+    Args:
+        pool_size: number of connections kept alive
+        max_retries: number of retries of failed connection attempts
+        timeout: timeout of requests in seconds
+
+    Returns:
+        httpx.AsyncClient
+    """
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    transport = httpx.AsyncHTTPTransport(limits=limits, retries=max_retries)
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+
+class AsyncStravaHandler(BaseStravaHandler):
+    """Async wrapper for Strava REST Api."""
+
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        client_id: str,
+        client_secret: str,
+        user_handler: StravaUserHandler,
+        rate_limiter: RateLimitScheduler,
+        token_cache: TokenCache = None,
+        http_client: httpx.AsyncClient = None,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        api_url: str = STRAVA_API_URL,
+        token_url: str = STRAVA_TOKEN_URL,
+    ) -> None:
+        """Async wrapper for Strava REST Api.
+
+        Args:
+            client_id: client_id of application on strava
+            client_secret: client_secret of application on strava
+            user_handler: wrapper class to handle strava users.
+            rate_limiter: scheduler releasing requests as rate limit budget is available
+            token_cache: access tokens shared with the other handlers of the process, a cache of its own if None
+            http_client: client used for all requests, a pooled client is created if None
+            max_retries: number of retries of requests answered with a 5xx status
+            backoff_factor: factor for the exponential sleep between retries
+            api_url: base url of the strava REST Api
+            token_url: url of the strava OAuth token endpoint
+        """
+        super().__init__(
+            client_id=client_id,
+            client_secret=client_secret,
+            user_handler=user_handler,
+            rate_limiter=rate_limiter,
+            token_cache=token_cache,
+            api_url=api_url,
+            token_url=token_url,
+        )
+        # long-lived client, so requests reuse pooled keep-alive connections to strava
+        self.http = http_client or create_async_http_client(timeout=self.timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+    async def aclose(self) -> None:
+        """Close the pooled connections of the http client.
+
+        Returns:
+            None
+        """
+        await self.http.aclose()
+
+    async def _send(self, method: str, url: str, priority: Priority, **kwargs) -> httpx.Response:
+        """Send a request, retrying 5xx responses with exponential backoff.
+
+        Every attempt counts towards the rate limits of strava, so rate limit budget is reserved for every attempt.
+
+        Args:
+            method: method of request to the api
+            url: target url
+            priority: Priority of the request when waiting for rate limit budget
+            **kwargs: additional arguments for httpx.AsyncClient.request
+
+        Returns:
+            httpx.Response
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire_async(priority)
+            response = await self.http.request(method=method, url=url, **kwargs)
+            await self.rate_limiter.track_async(response.headers)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                break
+            await asyncio.sleep(self.backoff_factor * 2**attempt)
+        return response
+
+    async def _get_access_token(self, user_id: str, priority: Priority) -> str:
+        """Return a cached access token of a user, refreshing it if it is about to expire.
+
+        Args:
+            user_id: id of the user on strava
+            priority: Priority of the request when waiting for rate limit budget
+
+        Returns:
+            access_token
+        """
+        access_token = self.token_cache.get(user_id)
+        if access_token:
+            return access_token
+
+        async with self.token_cache.refreshing_async(user_id):
+            # another thread or task might have refreshed the token while we were waiting for the lock
+            access_token = self.token_cache.get(user_id)
+            if not access_token:
+                token = await self._request_access_token(user_id, priority)
+                self.token_cache.put(user_id, token)
+                access_token = token.access_token
+            return access_token
+
+    async def _request_access_token(self, user_id: str, priority: Priority) -> AccessToken:
+        """Exchange refresh token for access token and return it.
+
+        Strava may rotate the refresh token with every exchange, a new refresh token is stored in the user data.
+
+        Args:
+            user_id: user_id on strava for user to get the token for
+            priority: Priority of the request when waiting for rate limit budget
+
+        Returns:
+            AccessToken
+        """
+        user = await run_in_threadpool(self.user_handler.__getitem__, user_id)
+        data = self._token_request_data(user.refresh_token)
+
+        response = await self._send(method="post", url=self.token_url, priority=priority, data=data)
+
+        if response.is_success:
+            content = response.json()
+            if content["refresh_token"] != user.refresh_token:
+                user.refresh_token = content["refresh_token"]
+                await run_in_threadpool(self.user_handler.update, user)
+            return AccessToken(
+                access_token=content["access_token"],
+                expires_at=datetime.fromtimestamp(content["expires_at"], tz=timezone.utc),
+            )
+
+        logger.error("Requesting Access Token Failed: %s", response.json())
+        raise TokenRefreshFailed(response.content)
+
+    async def _request(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        user_id: str,
+        method: str,
+        url: str,
+        data: Dict = None,
+        params: Dict = None,
+        priority: Priority = Priority.BACKFILL,
+    ) -> httpx.Response:
+        """Wrap request to strava REST Api.
+
+        This handles rate limits and authentication. Raises httpx.HTTPStatusError for failed requests.
+
+        Args:
+            user_id: id of the user on strava
+            method: method of request to the api
+            url: target url
+            data: data to pass with request
+            params: params to pass with request
+            priority: Priority of the request when waiting for rate limit budget
+
+        Returns:
+            httpx.Response
+        """
+        access_token = await self._get_access_token(user_id, priority)
+
+        headers = {"Authorization": f"Bearer {access_token}"}
+        # httpx sends None values, requests drops them
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        response = await self._send(
+            method=method,
+            url=url,
+            priority=priority,
+            headers=headers,
+            data=data,
+            params=params,
+        )
+
+        if not response.is_success:
+            self._log_failed_response(user_id, response.status_code)
+            # the status tells callers whether a retry can succeed, e.g. 404 for deleted activities
+            response.raise_for_status()
+        return response
+
+    async def get_logged_in_athlete(self, user_id: str, priority: Priority = Priority.INTERACTIVE) -> Dict:
+        """Implements getLoggedInAthlete endpoint.
+
+        https://developers.strava.com/docs/reference/#api-Athletes-getLoggedInAthlete
+
+        Args:
+            user_id: id of the user to get information for
+            priority: Priority of the request when waiting for rate limit budget
+
+        Returns:
+            detailed athlete object as defined by strava
+            https://developers.strava.com/docs/reference/#api-models-DetailedAthlete
+        """
+        endpoint_url = f"{self.api_url}/athlete"
+        response = await self._request(user_id=user_id, method="get", url=endpoint_url, priority=priority)
+        return response.json()
+
+    async def get_activity_by_id(
+        self,
+        user_id: str,
+        activity_id: str,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> Dict:
+        """Implements getActivityById endpoint.
+
+        https://developers.strava.com/docs/reference/#api-Activities-getActivityById
+
+        Args:
+            user_id: id of user the activity belongs to
+            activity_id: id of the activity to request
+            priority: Priority of the request when waiting for rate limit budget
+
+        Returns:
+            detailed activity object as defined on strava
+            https://developers.strava.com/docs/reference/#api-models-DetailedActivity
+        """
+        activity_url = f"{self.api_url}/activities/{activity_id}"
+        params = {"include_all_efforts": False}  # we don't use those
+        response = await self._request(
+            user_id=user_id,
+            method="get",
+            url=activity_url,
+            params=params,
+            priority=priority,
+        )
+        return response.json()
@@ -2,6 +2,8 @@
 
 The config is read from env vars, .env files and default values in this order.
 """
+from typing import Dict
+
 from pydantic import AnyUrl, BaseSettings, SecretStr
 
 
@@ -22,14 +24,42 @@ class Settings(BaseSettings):
 
     STRAVA_CLIENT_ID: str
     STRAVA_CLIENT_SECRET: SecretStr
+    # point both urls to a local fake_strava_service for load tests
+    STRAVA_API_URL: AnyUrl = "https://www.strava.com/api/v3"
+    STRAVA_TOKEN_URL: AnyUrl = "https://www.strava.com/oauth/token"
+    STRAVA_TOKEN_REFRESH_MARGIN: int = 300
+    STRAVA_HTTP_POOL_SIZE: int = 10
+    STRAVA_HTTP_MAX_RETRIES: int = 3
+    STRAVA_HTTP_BACKOFF_FACTOR: float = 0.5
+    STRAVA_RATE_LIMIT_MAX_WAIT: int = 960
+    STRAVA_RATE_LIMIT_POLL_INTERVAL: float = 1.0
+
+    INGESTION_WORKERS: int = 2
+    INGESTION_POLL_INTERVAL: float = 5.0
+    INGESTION_LEASE_SECONDS: int = 300
+    INGESTION_MAX_ATTEMPTS: int = 5
+    # full syncs catching activities incremental syncs missed, default once a week per user
+    INGESTION_RECONCILE_INTERVAL: int = 604800
+    INGESTION_RECONCILE_BATCH_SIZE: int = 10
+    INGESTION_SWEEP_INTERVAL: float = 3600.0
 
     DB_USER: str
     DB_PASS: SecretStr
     DB_HOST: str
     DB_PORT: str
     DB_NAME: str
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_RECYCLE: int = 3600
+    # refresh tokens are rotated by the app on login, so they are read fresh from the database by default
+    USER_CACHE_TTL: float = 0.0
 
     SECRET_KEY: SecretStr
+    # increase when rotating SECRET_KEY and keep the old key in PREVIOUS_SECRET_KEYS until tokens are re-encrypted
+    SECRET_KEY_VERSION: int = 1
+    # json object of key version -> secret key, version 0 defaults to SECRET_KEY while SECRET_KEY_VERSION is 1,
+    # after a rotation it is required as long as tokens written by flet.security are left
+    PREVIOUS_SECRET_KEYS: Dict[int, SecretStr] = {}
 
 
 settings = Settings()
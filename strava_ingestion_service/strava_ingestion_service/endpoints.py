@@ -1,13 +1,33 @@
 """Endpoints of the strava_ingestion_service for metriker."""
+import asyncio
+import logging
+from collections import defaultdict
+from http import HTTPStatus
+from typing import Dict, List, Tuple
 
-from database_utils.activity_handler import StravaActivityHandler, parse_activity
+import httpx
+from database_utils.activity_handler import StravaActivity, StravaActivityHandler, parse_activity
+from database_utils.job_handler import IngestionJobHandler, StravaIngestionJob
+from database_utils.rate_limit_handler import RateLimitHandler
 from database_utils.user_handler import StravaUserHandler
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
 
+from .async_strava_handler import AsyncStravaHandler, create_async_http_client
 from .config import settings
-from .strava_handler import StravaHandler
+from .rate_limiter import DailyRateLimitExceeded, RateLimitScheduler
+from .schemas import ActivityBatch, ActivityBatchResult, ActivityReference
+from .strava_handler import StravaHandler, create_http_session
+from .token_cache import TokenCache
+from .workers import IngestionWorkerPool
 
-# initiate database wrappers
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+# strava answers activities that were deleted or turned private with these, retrying them does not help
+PERMANENT_STATUS_CODES = (HTTPStatus.NOT_FOUND, HTTPStatus.FORBIDDEN)
+
+# initiate database wrappers, both share one engine and connection pool
 user_handler = StravaUserHandler(
     secret_key=settings.SECRET_KEY.get_secret_value(),
     user=settings.DB_USER,
@@ -15,6 +35,12 @@ user_handler = StravaUserHandler(
     host=settings.DB_HOST,
     port=settings.DB_PORT,
     database=settings.DB_NAME,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    cache_ttl=settings.USER_CACHE_TTL,
+    secret_key_version=settings.SECRET_KEY_VERSION,
+    previous_secret_keys={version: key.get_secret_value() for version, key in settings.PREVIOUS_SECRET_KEYS.items()},
 )
 activity_handler = StravaActivityHandler(
     user=settings.DB_USER,
@@ -22,20 +48,94 @@ activity_handler = StravaActivityHandler(
     host=settings.DB_HOST,
     port=settings.DB_PORT,
     database=settings.DB_NAME,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+)
+
+job_handler = IngestionJobHandler(
+    user=settings.DB_USER,
+    password=settings.DB_PASS.get_secret_value(),
+    host=settings.DB_HOST,
+    port=settings.DB_PORT,
+    database=settings.DB_NAME,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+)
+rate_limit_handler = RateLimitHandler(
+    user=settings.DB_USER,
+    password=settings.DB_PASS.get_secret_value(),
+    host=settings.DB_HOST,
+    port=settings.DB_PORT,
+    database=settings.DB_NAME,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_recycle=settings.DB_POOL_RECYCLE,
 )
 
+# the rate limit budget is shared with all other workers through the database
+rate_limiter = RateLimitScheduler(
+    rate_limit_handler=rate_limit_handler,
+    max_wait=settings.STRAVA_RATE_LIMIT_MAX_WAIT,
+    poll_interval=settings.STRAVA_RATE_LIMIT_POLL_INTERVAL,
+)
+
+# access tokens are shared by the endpoints and the workers, so the token of a user is refreshed once
+token_cache = TokenCache(refresh_margin=settings.STRAVA_TOKEN_REFRESH_MARGIN)
+
 # initiate strava api wrapper
-strava_handler = StravaHandler(
+# endpoints await strava without blocking a threadpool worker, blocking database calls run in the threadpool
+strava_handler = AsyncStravaHandler(
     client_id=settings.STRAVA_CLIENT_ID,
     client_secret=settings.STRAVA_CLIENT_SECRET.get_secret_value(),
     user_handler=user_handler,
+    rate_limiter=rate_limiter,
+    token_cache=token_cache,
+    http_client=create_async_http_client(
+        pool_size=settings.STRAVA_HTTP_POOL_SIZE,
+        max_retries=settings.STRAVA_HTTP_MAX_RETRIES,
+    ),
+    max_retries=settings.STRAVA_HTTP_MAX_RETRIES,
+    backoff_factor=settings.STRAVA_HTTP_BACKOFF_FACTOR,
+    api_url=settings.STRAVA_API_URL,
+    token_url=settings.STRAVA_TOKEN_URL,
+)
+
+# background workers process history syncs with the blocking api wrapper, outside of any request
+worker_pool = IngestionWorkerPool(
+    job_handler=job_handler,
+    activity_handler=activity_handler,
+    strava_handler=StravaHandler(
+        client_id=settings.STRAVA_CLIENT_ID,
+        client_secret=settings.STRAVA_CLIENT_SECRET.get_secret_value(),
+        user_handler=user_handler,
+        rate_limiter=rate_limiter,
+        token_cache=token_cache,
+        http_session=create_http_session(
+            pool_size=settings.INGESTION_WORKERS,
+            max_retries=settings.STRAVA_HTTP_MAX_RETRIES,
+            backoff_factor=settings.STRAVA_HTTP_BACKOFF_FACTOR,
+        ),
+        max_retries=settings.STRAVA_HTTP_MAX_RETRIES,
+        backoff_factor=settings.STRAVA_HTTP_BACKOFF_FACTOR,
+        api_url=settings.STRAVA_API_URL,
+        token_url=settings.STRAVA_TOKEN_URL,
+    ),
+    workers=settings.INGESTION_WORKERS,
+    poll_interval=settings.INGESTION_POLL_INTERVAL,
+    lease_seconds=settings.INGESTION_LEASE_SECONDS,
+    max_attempts=settings.INGESTION_MAX_ATTEMPTS,
+    reconcile_interval=settings.INGESTION_RECONCILE_INTERVAL,
+    reconcile_batch_size=settings.INGESTION_RECONCILE_BATCH_SIZE,
+    sweep_interval=settings.INGESTION_SWEEP_INTERVAL,
 )
 
 router = APIRouter()
 
 
 @router.post("/updateUserById")
-def update_user_by_id(user_id: str) -> None:
+async def update_user_by_id(user_id: str) -> None:
     """Request information about a user from the strava api.
 
     Args:
@@ -44,14 +144,14 @@ def update_user_by_id(user_id: str) -> None:
     Returns:
         200, None
     """
-    old_user = user_handler.get(user_id)
-    new_user = strava_handler.get_logged_in_athlete(user_id=user_id)
+    old_user = await run_in_threadpool(user_handler.get, user_id)
+    new_user = await strava_handler.get_logged_in_athlete(user_id=user_id)
     old_user.name = new_user["firstname"]
-    user_handler.update(old_user)
+    await run_in_threadpool(user_handler.update, old_user)
 
 
 @router.post("/updateUserActivityById")
-def update_user_activity_by_id(activity_id: str, user_id: str) -> None:
+async def update_user_activity_by_id(activity_id: str, user_id: str) -> None:
     """Request a single activity from the strava api.
 
     The activity is defined by activity_id and belongs to user_id.
@@ -63,23 +163,158 @@ def update_user_activity_by_id(activity_id: str, user_id: str) -> None:
     Returns:
         200, None
     """
-    activity = strava_handler.get_activity_by_id(user_id=user_id, activity_id=activity_id)
-    activity_handler.add(parse_activity(activity))
+    activity = await strava_handler.get_activity_by_id(user_id=user_id, activity_id=activity_id)
+    await run_in_threadpool(activity_handler.upsert, parse_activity(activity))
 
 
-@router.post("/updateUserActivities")
-def update_user_activities(user_id: str) -> None:
-    """Request all activities of a user from the strava api.
+async def _fetch_user_activities(
+    user_id: str,
+    activity_ids: List[str],
+    exhausted: asyncio.Event,
+) -> Tuple[List[StravaActivity], List[ActivityReference], List[ActivityReference]]:
+    """Request activities of one user concurrently, all requests share the access token of the user.
+
+    Only activities strava answers with 404 or 403 are failed for good, other errors are worth a retry.
+    Once the daily rate limit is exhausted for one request, exhausted is set and all pending requests of the batch
+    are cancelled, their activities are retried later.
 
     Args:
         user_id: id of the user on strava
+        activity_ids: ids of activities of the user on strava
+        exhausted: event shared by all users of a batch, set once the daily rate limit is exhausted
 
     Returns:
-        200, None
+        list of fetched StravaActivity, list of ActivityReference strava will not return,
+        list of ActivityReference failed because of transient errors
+    """
+    activities: List[StravaActivity] = []
+    failed: List[ActivityReference] = []
+    retry: List[ActivityReference] = []
+
+    async def fetch(activity_id: str) -> None:
+        """Request one activity and sort it into activities, failed or retry."""
+        reference = ActivityReference(user_id=user_id, activity_id=activity_id)
+        if exhausted.is_set():
+            retry.append(reference)
+            return
+
+        request = asyncio.ensure_future(strava_handler.get_activity_by_id(user_id=user_id, activity_id=activity_id))
+        exhausted_wait = asyncio.ensure_future(exhausted.wait())
+        try:
+            await asyncio.wait((request, exhausted_wait), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            exhausted_wait.cancel()
+            # False once the request is done, cancels the request as well if the whole batch is cancelled
+            cancelled = request.cancel()
+        if cancelled:
+            retry.append(reference)
+            return
+
+        try:
+            activities.append(parse_activity(request.result()))
+        except DailyRateLimitExceeded:
+            logger.warning("Daily rate limit exhausted, retrying activity %s of user %s later", activity_id, user_id)
+            exhausted.set()
+            retry.append(reference)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in PERMANENT_STATUS_CODES:
+                logger.warning("Strava refused activity %s of user %s: %s", activity_id, user_id, e)
+                failed.append(reference)
+            else:
+                logger.exception("Requesting activity %s of user %s failed", activity_id, user_id)
+                retry.append(reference)
+        except Exception:
+            logger.exception("Requesting activity %s of user %s failed", activity_id, user_id)
+            retry.append(reference)
+
+    await asyncio.gather(*(fetch(activity_id) for activity_id in activity_ids))
+    return activities, failed, retry
+
+
+def _write_activity_batch(activities: List[StravaActivity], deletes: List[str]) -> Tuple[int, int]:
+    """Store fetched activities and delete activities in one transaction.
+
+    Args:
+        activities: list of StravaActivity to add or update
+        deletes: ids of activities to delete
+
+    Returns:
+        number of written activities, number of deleted activities
+    """
+    with activity_handler.session_scope():
+        updated = activity_handler.bulk_upsert(activities)
+        deleted = activity_handler.delete_many(deletes)
+    return updated, deleted
+
+
+@router.post("/updateActivities")
+async def update_activities(batch: ActivityBatch) -> ActivityBatchResult:
+    """Request many activities from the strava api and delete activities in one call.
+
+    Activities are grouped by user, so every user needs at most one access token.
+    All changes are written in one transaction, including the activities fetched before
+    the daily rate limit was exhausted. Activities that were not fetched are returned in retry.
+
+    Args:
+        batch: ActivityBatch
+
+    Returns:
+        200, ActivityBatchResult
     """
-    activities = strava_handler.get_logged_in_athlete_activities(user_id)
-    for activity in activities:
-        activity_handler.add(parse_activity(activity))
+    activity_ids_by_user: Dict[str, List[str]] = defaultdict(list)
+    for reference in batch.updates:
+        if reference.activity_id not in activity_ids_by_user[reference.user_id]:
+            activity_ids_by_user[reference.user_id].append(reference.activity_id)
+
+    exhausted = asyncio.Event()
+    results = await asyncio.gather(
+        *(
+            _fetch_user_activities(user_id, activity_ids, exhausted)
+            for user_id, activity_ids in activity_ids_by_user.items()
+        ),
+    )
+    activities = [activity for user_activities, _, _ in results for activity in user_activities]
+    failed = [reference for _, user_failed, _ in results for reference in user_failed]
+    retry = [reference for _, _, user_retry in results for reference in user_retry]
+
+    updated, deleted = await run_in_threadpool(_write_activity_batch, activities, batch.deletes)
+    return ActivityBatchResult(updated=updated, deleted=deleted, failed=failed, retry=retry)
+
+
+# the lease token is only passed between the job handler and the worker holding the lease
+@router.post("/updateUserActivities", status_code=HTTPStatus.ACCEPTED, response_model_exclude={"lease_token"})
+def update_user_activities(user_id: str, full: bool = False) -> StravaIngestionJob:
+    """Queue a job requesting the activities of a user from the strava api.
+
+    By default only activities newer than the latest activity seen by the last sync are requested.
+    The job is processed by the background workers, its progress can be polled with getIngestionJobById.
+
+    Args:
+        user_id: id of the user on strava
+        full: request the whole history of the user instead
+
+    Returns:
+        202, StravaIngestionJob
+    """
+    job = job_handler.enqueue(user_id, incremental=not full)
+    worker_pool.notify()
+    return job
+
+
+@router.get("/getIngestionJobById", response_model_exclude={"lease_token"})
+def get_ingestion_job_by_id(job_id: str) -> StravaIngestionJob:
+    """Get the status and progress of an ingestion job.
+
+    Args:
+        job_id: id of the job
+
+    Returns:
+        200, StravaIngestionJob
+    """
+    job = job_handler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Job not found")
+    return job
 
 
 @router.delete("/deleteUserActivityById")
@@ -97,7 +332,9 @@ def delete_user_activity_by_id(activity_id: str) -> None:
 
 @router.delete("/deleteUserById")
 def delete_user_by_id(user_id: str) -> None:
-    """Request all activities of a user from the strava api.
+    """Delete a user, their activities and their ingestion jobs.
+
+    Everything is deleted in one transaction.
 
     Args:
         user_id: id of the user on strava
@@ -105,5 +342,8 @@ def delete_user_by_id(user_id: str) -> None:
     Returns:
         200, None
     """
-    activity_handler.delete_user_activities(user_id)
-    user_handler.delete(user_id)
+    with activity_handler.session_scope():
+        job_handler.delete_user_jobs(user_id)
+        activity_handler.delete_user_activities(user_id)
+        user_handler.delete(user_id)
+    strava_handler.invalidate_access_token(user_id)
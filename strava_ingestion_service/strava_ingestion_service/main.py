@@ -1,7 +1,9 @@
 """Main Api of the strava_ingestion_service for metriker."""
 import logging.config
+import threading
 
 import sentry_sdk
+from database_utils.database_connector import dispose_engines
 from fastapi import FastAPI
 
 from . import endpoints
@@ -20,6 +22,25 @@ app_config = {}
 if settings.ENVIRONMENT not in SHOW_DOCS_ENVIRONMENT:
     app_config["openapi_url"] = None
 
+
+def reencrypt_tokens() -> None:
+    """Re-encrypt refresh tokens of older key versions in a background thread.
+
+    Returns:
+        None
+    """
+    threading.Thread(target=endpoints.user_handler.reencrypt_tokens, name="token-reencryption", daemon=True).start()
+
+
 # create app
 app = FastAPI(**app_config)
 app.include_router(endpoints.router)
+# process queued ingestion jobs in the background
+app.add_event_handler("startup", endpoints.worker_pool.start)
+app.add_event_handler("shutdown", endpoints.worker_pool.stop)
+# migrate refresh tokens to the current key version while serving requests
+app.add_event_handler("startup", reencrypt_tokens)
+# close pooled connections to strava
+app.add_event_handler("shutdown", endpoints.strava_handler.aclose)
+# close pooled database connections after the workers stopped
+app.add_event_handler("shutdown", dispose_engines)
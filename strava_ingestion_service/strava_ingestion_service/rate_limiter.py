@@ -0,0 +1,210 @@
+"""This module provides a scheduler releasing requests to the strava api as rate limit budget is available.
+
+The budget of the 15 minute and daily windows is shared by all workers through the database.
+Requests that find the budget exhausted wait until the window resets, without blocking other requests,
+and are released by priority: webhook triggered requests go ahead of bulk backfills.
+"""
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from enum import IntEnum
+from typing import Dict, Mapping, Optional, Tuple
+
+import requests
+from database_utils.rate_limit_handler import WINDOW_15_MIN, WINDOW_DAILY, RateLimitHandler
+from fastapi.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+
+class DailyRateLimitExceeded(requests.RequestException):
+    """The rate limit was exceeded."""
+
+    def __init__(self) -> None:
+        """Init of DailyRateLimitExceeded Exception."""
+        super().__init__("Daily Rate Limit Exceeded")
+
+
+class Priority(IntEnum):
+    """Priority of a request to the strava api, lower values are released first."""
+
+    # single activities and athletes requested because of webhook events
+    INTERACTIVE = 0
+    # full or incremental history syncs
+    BACKFILL = 1
+
+
+def parse_rate_limit_headers(headers: Mapping[str, str]) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """Read rate limits and usage from the headers of a strava api response.
+
+    Args:
+        headers: headers of a response from strava REST Api
+
+    Returns:
+        dict of window name -> limit, dict of window name -> usage
+    """
+    limits, usages = {}, {}
+    limit = headers.get("X-RateLimit-Limit")
+    if limit:
+        limit_15_min, limit_daily = limit.split(",")
+        limits = {WINDOW_15_MIN: int(limit_15_min), WINDOW_DAILY: int(limit_daily)}
+    else:
+        logger.info("No Rate Limit Information In Headers")
+
+    usage = headers.get("X-RateLimit-Usage")
+    if usage:
+        usage_15_min, usage_daily = usage.split(",")
+        usages = {WINDOW_15_MIN: int(usage_15_min), WINDOW_DAILY: int(usage_daily)}
+    else:
+        logger.info("No Usage Information In Headers")
+    return limits, usages
+
+
+class RateLimitScheduler:
+    """Scheduler releasing requests to the strava api as budget in all rate limit windows is available."""
+
+    def __init__(self, rate_limit_handler: RateLimitHandler, max_wait: int = 960, poll_interval: float = 1.0) -> None:
+        """Scheduler releasing requests to the strava api as budget in all rate limit windows is available.
+
+        Args:
+            rate_limit_handler: wrapper for the rate limit usage shared through the database
+            max_wait: seconds a request waits at most for budget, DailyRateLimitExceeded is raised beyond
+            poll_interval: seconds a request yields to waiting requests of higher priority
+        """
+        self.rate_limit_handler = rate_limit_handler
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+
+        # requests of this process waiting for budget, ticket -> priority
+        self._waiting: Dict[int, Priority] = {}
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+
+    def _enqueue(self, priority: Priority) -> int:
+        """Register a request as waiting for budget.
+
+        Args:
+            priority: Priority of the request
+
+        Returns:
+            ticket identifying the request
+        """
+        with self._lock:
+            ticket = next(self._tickets)
+            self._waiting[ticket] = priority
+            return ticket
+
+    def _dequeue(self, ticket: int) -> None:
+        """Remove a request from the waiting requests.
+
+        Args:
+            ticket: ticket identifying the request
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._waiting.pop(ticket, None)
+
+    def _try_acquire(self, priority: Priority, ticket: Optional[int] = None) -> float:
+        """Try to reserve budget for a request.
+
+        Args:
+            priority: Priority of the request
+            ticket: ticket identifying the request, None if the request is not waiting yet
+
+        Returns:
+            0 if budget was reserved, otherwise seconds to wait before trying again
+        """
+        with self._lock:
+            higher_priority_waiting = any(
+                other_priority < priority
+                for other_ticket, other_priority in self._waiting.items()
+                if other_ticket != ticket
+            )
+        if higher_priority_waiting:
+            return self.poll_interval
+
+        release_at = self.rate_limit_handler.reserve()
+        if release_at is None:
+            return 0
+
+        wait = (release_at.replace(tzinfo=timezone.utc) - datetime.now(tz=timezone.utc)).total_seconds()
+        if wait > self.max_wait:
+            logger.error("Daily Rate Limit Exceeded")
+            raise DailyRateLimitExceeded
+        logger.warning("Rate Limit Exceeded, waiting %.0f seconds", wait)
+        # add a safety second
+        return max(wait + 1, self.poll_interval)
+
+    def acquire(self, priority: Priority = Priority.BACKFILL) -> None:
+        """Block the calling thread until budget for one request is reserved.
+
+        Args:
+            priority: Priority of the request
+
+        Returns:
+            None
+        """
+        wait = self._try_acquire(priority)
+        if not wait:
+            return
+
+        # only requests that found the budget exhausted queue up
+        ticket = self._enqueue(priority)
+        try:
+            while wait:
+                time.sleep(wait)
+                wait = self._try_acquire(priority, ticket)
+        finally:
+            self._dequeue(ticket)
+
+    async def acquire_async(self, priority: Priority = Priority.BACKFILL) -> None:
+        """Wait without blocking the event loop until budget for one request is reserved.
+
+        Args:
+            priority: Priority of the request
+
+        Returns:
+            None
+        """
+        wait = await run_in_threadpool(self._try_acquire, priority)
+        if not wait:
+            return
+
+        # only requests that found the budget exhausted queue up
+        ticket = self._enqueue(priority)
+        try:
+            while wait:
+                await asyncio.sleep(wait)
+                wait = await run_in_threadpool(self._try_acquire, priority, ticket)
+        finally:
+            self._dequeue(ticket)
+
+    def track(self, headers: Mapping[str, str]) -> None:
+        """Store limits and usage reported in the headers of a strava api response.
+
+        Args:
+            headers: headers of a response from strava REST Api
+
+        Returns:
+            None
+        """
+        limits, usages = parse_rate_limit_headers(headers)
+        if limits or usages:
+            self.rate_limit_handler.track(limits, usages)
+
+    async def track_async(self, headers: Mapping[str, str]) -> None:
+        """Store limits and usage reported in the headers of a strava api response without blocking the event loop.
+
+        Args:
+            headers: headers of a response from strava REST Api
+
+        Returns:
+            None
+        """
+        await run_in_threadpool(self.track, headers)
@@ -0,0 +1,30 @@
+"""Schemas for the objects expected and returned by the batch endpoints of the ingestion service."""
+from typing import List
+
+from pydantic import BaseModel
+
+
+class ActivityReference(BaseModel):
+    """Activity on strava identified by the user it belongs to and its id."""
+
+    user_id: str
+    activity_id: str
+
+
+class ActivityBatch(BaseModel):
+    """Activities to request from strava and activities to delete, processed in one call."""
+
+    updates: List[ActivityReference] = []
+    # ids of activities on strava
+    deletes: List[str] = []
+
+
+class ActivityBatchResult(BaseModel):
+    """Outcome of processing an ActivityBatch."""
+
+    updated: int
+    deleted: int
+    # activities strava will not return, because they are private or were deleted in the meantime
+    failed: List[ActivityReference] = []
+    # activities strava did not return because of transient errors, e.g. 5xx responses, worth another attempt
+    retry: List[ActivityReference] = []
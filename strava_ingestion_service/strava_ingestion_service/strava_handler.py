@@ -1,16 +1,36 @@
-"""This module provides a wrapper for the strava REST api."""
+"""This module provides a wrapper for the strava REST api.
+
+BaseStravaHandler holds the state shared by the blocking StravaHandler
+and the AsyncStravaHandler in async_strava_handler: the TokenCache and the rate limit scheduler.
+"""
 import logging
 import time
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from http import HTTPStatus
-from typing import Dict, List
+from typing import Dict, Iterator, List
 
 import requests
+from database_utils.activity_handler import decode_json
 from database_utils.user_handler import StravaUserHandler
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .rate_limiter import Priority, RateLimitScheduler
+from .token_cache import AccessToken, TokenCache
 
 logger = logging.getLogger(__name__)
 logger.info(__name__)
 
+# responses worth retrying, 429 is left to the rate limit handling
+RETRY_STATUS_CODES = (
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+)
+STRAVA_API_URL = "https://www.strava.com/api/v3"
+STRAVA_TOKEN_URL = "https://www.strava.com/oauth/token"  # noqa: S105 - Ignore: url, not a password
+
 
 class TokenRefreshFailed(requests.RequestException):
     """No Access Token was returned."""
@@ -24,121 +44,244 @@ class TokenRefreshFailed(requests.RequestException):
         super().__init__(f"Requesting Access Token Failed: {cause}")
 
 
-class DailyRateLimitExceeded(requests.RequestException):
-    """The rate limit was exceeded."""
-
-    def __init__(self) -> None:
-        """Init of DailyRateLimitExceeded Exception."""
-        super().__init__("Daily Rate Limit Exceeded")
+def create_http_session(pool_size: int = 10, max_retries: int = 3, backoff_factor: float = 0.5) -> requests.Session:
+    """Create a requests.Session keeping pooled connections alive and retrying failed connection attempts.
 
+    Only requests that never reached strava are retried here. Responses with a 5xx status are retried by
+    StravaHandler, which reserves rate limit budget for every attempt.
 
-def sleep_until_next_quarter() -> None:
-    """Get the time interval until the next quarter and sleep till then.
+    Args:
+        pool_size: number of connections kept alive per host
+        max_retries: number of retries of failed connection attempts
+        backoff_factor: factor for the exponential sleep between retries
 
     Returns:
-        None
+        requests.Session
     """
-    now = datetime.now(tz=timezone.utc)
-    # get timedelta to the next full 15 minutes
-    delta = timedelta(minutes=15 - now.minute % 15, seconds=-now.second)
-    logger.warning("Sleeping %s until next full quarter", delta.seconds)
-    # add a safety second and sleep
-    time.sleep(delta.seconds + 1)
+    retry = Retry(total=max_retries, read=False, status=False, backoff_factor=backoff_factor)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
-class StravaHandler:
-    """Wrapper for Strava REST Api."""
+class BaseStravaHandler:
+    """State and bookkeeping shared by the blocking and the async wrapper for the Strava REST Api."""
 
-    def __init__(
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
         self,
         client_id: str,
         client_secret: str,
         user_handler: StravaUserHandler,
+        rate_limiter: RateLimitScheduler,
+        token_cache: TokenCache = None,
+        api_url: str = STRAVA_API_URL,
+        token_url: str = STRAVA_TOKEN_URL,
     ) -> None:
-        """Wrapper for Strava REST Api.
+        """State and bookkeeping shared by the blocking and the async wrapper for the Strava REST Api.
 
         Args:
             client_id: client_id of application on strava
             client_secret: client_secret of application on strava
             user_handler: wrapper class to handle strava users.
+            rate_limiter: scheduler releasing requests within the rate limits shared by all workers
+            token_cache: access tokens shared with the other handlers of the process, a cache of its own if None
+            api_url: base url of the strava REST Api, e.g. of a local fake_strava_service
+            token_url: url of the strava OAuth token endpoint
         """
         self.client_id = client_id
         self.client_secret = client_secret
         self.user_handler: StravaUserHandler = user_handler
+        self.rate_limiter = rate_limiter
+
+        self.token_url = token_url.rstrip("/")
+        self.api_url = api_url.rstrip("/")
 
-        # these values will track the usage reported in the headers of api responses
-        self.limit_daily = 1000
-        self.limit_15_min = 100
-        self.usage_daily = 0
-        self.usage_15_min = 0
+        # access tokens are cached per user until shortly before they expire
+        self.token_cache = token_cache or TokenCache()
 
         self.timeout = 15
 
-    def _request_access_token(self, user_id: str) -> str:
-        """Exchange refresh token for access token and return it.
+    def invalidate_access_token(self, user_id: str) -> None:
+        """Drop the cached access token of a user.
 
         Args:
-            user_id: user_id on strava for user to get the token for
+            user_id: id of the user on strava
 
         Returns:
-            access_token
+            None
         """
-        auth_url = "https://www.strava.com/oauth/token"
-        data = {
+        self.token_cache.invalidate(user_id)
+
+    def _token_request_data(self, refresh_token: str) -> Dict:
+        """Build the form data to exchange a refresh token for an access token.
+
+        Args:
+            refresh_token: refresh token of the user
+
+        Returns:
+            form data
+        """
+        return {
             "client_id": self.client_id,
             "client_secret": self.client_secret,
-            "refresh_token": self.user_handler[user_id].refresh_token,
+            "refresh_token": refresh_token,
             "grant_type": "refresh_token",
         }
 
-        self._rate_limit()
-        response = requests.request(method="post", url=auth_url, data=data, timeout=self.timeout)
-        self._track_rate_limit(response)
+    def _log_failed_response(self, user_id: str, status_code: int) -> None:
+        """Log why a request to the strava REST Api failed.
 
-        if response.ok:
-            self.user_handler[user_id].refresh_token = response.json()["refresh_token"]
-            return response.json()["access_token"]
+        Args:
+            user_id: id of the user the request was made for
+            status_code: http status code of the response
 
-        logger.error("Requesting Access Token Failed: %s", response.json())
-        raise TokenRefreshFailed(response.content)
+        Returns:
+            None
+        """
+        if status_code == HTTPStatus.UNAUTHORIZED:
+            # 401 Unauthorized
+            # the cached access token might have been revoked, or this is a scope issue,
+            # or we don't know what is going on
+            logger.warning("Got response: 401 Unauthorized")
+            self.invalidate_access_token(user_id)
+        if status_code == HTTPStatus.FORBIDDEN:
+            # Forbidden; you cannot access
+            logger.warning("Got response: 403 Resource is forbidden")
+        if status_code == HTTPStatus.NOT_FOUND:
+            # Not found; the requested asset does not exist, or you are not authorized to see it
+            logger.warning("Got response: 404 Resource not found")
+        if status_code == HTTPStatus.TOO_MANY_REQUESTS:
+            # Too Many Requests; you have exceeded rate limits
+            logger.warning("Got response: 429 Requests Limit Exceeded")
+        if status_code == HTTPStatus.INTERNAL_SERVER_ERROR:
+            # Strava is having issues
+            logger.warning("Got response: 500 Strava is probably having issues")
+
+
+class StravaHandler(BaseStravaHandler):
+    """Wrapper for Strava REST Api."""
 
-    def _track_rate_limit(self, response: requests.Response) -> None:
-        """Read rate limits information from response header and track it in class values.
+    # maximum page size of list endpoints
+    activities_per_page = 200
+
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        client_id: str,
+        client_secret: str,
+        user_handler: StravaUserHandler,
+        rate_limiter: RateLimitScheduler,
+        token_cache: TokenCache = None,
+        http_session: requests.Session = None,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        api_url: str = STRAVA_API_URL,
+        token_url: str = STRAVA_TOKEN_URL,
+    ) -> None:
+        """Wrapper for Strava REST Api.
+
+        Args:
+            client_id: client_id of application on strava
+            client_secret: client_secret of application on strava
+            user_handler: wrapper class to handle strava users.
+            rate_limiter: scheduler releasing requests within the rate limits shared by all workers
+            token_cache: access tokens shared with the other handlers of the process, a cache of its own if None
+            http_session: session used for all requests, a pooled session with retries is created if None
+            max_retries: number of retries of requests answered with a 5xx status
+            backoff_factor: factor for the exponential sleep between retries
+            api_url: base url of the strava REST Api
+            token_url: url of the strava OAuth token endpoint
+        """
+        super().__init__(
+            client_id=client_id,
+            client_secret=client_secret,
+            user_handler=user_handler,
+            rate_limiter=rate_limiter,
+            token_cache=token_cache,
+            api_url=api_url,
+            token_url=token_url,
+        )
+        # long-lived session, so requests reuse pooled keep-alive connections to strava
+        self.http = http_session or create_http_session()
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+    def _send(self, method: str, url: str, priority: Priority, **kwargs) -> requests.Response:
+        """Send a request, retrying 5xx responses with exponential backoff.
+
+        Every attempt counts towards the rate limits of strava, so rate limit budget is reserved for every attempt.
 
         Args:
-            response: requests.Response object from strava REST Api
+            method: method of request to the api
+            url: target url
+            priority: Priority of the request when waiting for rate limit budget
+            **kwargs: additional arguments for requests.Session.request
 
         Returns:
-            None
+            requests.Response
         """
-        limit = response.headers.get("X-RateLimit-Limit")
-        if limit:
-            limit_15_min, limit_daily = limit.split(",")
-            self.limit_15_min, self.limit_daily = int(limit_15_min), int(limit_daily)
-        else:
-            logger.info("No Rate Limit Information In Headers")
-
-        usage = response.headers.get("X-RateLimit-Usage")
-        if usage:
-            usage_15_min, usage_daily = usage.split(",")
-            self.usage_15_min, self.usage_daily = int(usage_15_min), int(usage_daily)
-        else:
-            logger.info("No Usage Information In Headers")
-
-    def _rate_limit(self) -> None:
-        """Check if any rate limits are reached and throttle requests accordingly.
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(priority)
+            response = self.http.request(method=method, url=url, timeout=self.timeout, **kwargs)
+            self.rate_limiter.track(response.headers)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                break
+            time.sleep(self.backoff_factor * 2**attempt)
+        return response
+
+    def _get_access_token(self, user_id: str, priority: Priority) -> str:
+        """Return a cached access token of a user, refreshing it if it is about to expire.
+
+        Args:
+            user_id: id of the user on strava
+            priority: Priority of the request needing the token
 
         Returns:
-            None
+            access_token
         """
-        if self.usage_daily >= self.limit_daily:
-            logger.error("Daily Rate Limit Exceeded")
-            raise DailyRateLimitExceeded
+        access_token = self.token_cache.get(user_id)
+        if access_token:
+            return access_token
+
+        with self.token_cache.refreshing(user_id):
+            # another thread or task might have refreshed the token while we were waiting for the lock
+            access_token = self.token_cache.get(user_id)
+            if not access_token:
+                token = self._request_access_token(user_id, priority)
+                self.token_cache.put(user_id, token)
+                access_token = token.access_token
+            return access_token
+
+    def _request_access_token(self, user_id: str, priority: Priority) -> AccessToken:
+        """Exchange refresh token for access token and return it.
+
+        Strava may rotate the refresh token with every exchange, a new refresh token is stored in the user data.
+
+        Args:
+            user_id: user_id on strava for user to get the token for
+            priority: Priority of the request needing the token
+
+        Returns:
+            AccessToken
+        """
+        user = self.user_handler[user_id]
+        data = self._token_request_data(user.refresh_token)
+
+        response = self._send(method="post", url=self.token_url, priority=priority, data=data)
 
-        if self.usage_15_min >= self.limit_15_min:
-            logger.warning("15min Rate Limit Exceeded")
-            sleep_until_next_quarter()
-            self.usage_15_min = 0
+        if response.ok:
+            content = response.json()
+            if content["refresh_token"] != user.refresh_token:
+                user.refresh_token = content["refresh_token"]
+                self.user_handler.update(user)
+            return AccessToken(
+                access_token=content["access_token"],
+                expires_at=datetime.fromtimestamp(content["expires_at"], tz=timezone.utc),
+            )
+
+        logger.error("Requesting Access Token Failed: %s", response.json())
+        raise TokenRefreshFailed(response.content)
 
     def _request(  # noqa: PLR0913 - Ignore: Too many arguments to function call
         self,
@@ -147,6 +290,7 @@ class StravaHandler:
         url: str,
         data: Dict = None,
         params: Dict = None,
+        priority: Priority = Priority.BACKFILL,
     ) -> (None, requests.Response):
         """Wrap request to strava REST Api.
 
@@ -158,65 +302,40 @@ class StravaHandler:
             url: target url
             data: data to pass with request
             params: params to pass with request
+            priority: Priority of the request when waiting for rate limit budget
 
         Returns:
             requests.Response
         """
-        access_token = self._request_access_token(user_id)
+        access_token = self._get_access_token(user_id, priority)
 
-        self._rate_limit()
         headers = {"Authorization": f"Bearer {access_token}"}
-        response = requests.request(
-            method=method,
-            url=url,
-            headers=headers,
-            data=data,
-            params=params,
-            timeout=self.timeout,
-        )
-        self._track_rate_limit(response)
+        response = self._send(method=method, url=url, priority=priority, headers=headers, data=data, params=params)
 
         if response.ok:
             return response
 
-        if not response.ok:
-            if response.status_code == HTTPStatus.UNAUTHORIZED:
-                # 401 Unauthorized
-                # we already got the access token, so this should be a scope issue,
-                # or we don't know what is going on
-                logger.warning("Got response: 401 Unauthorized")
-            if response.status_code == HTTPStatus.FORBIDDEN:
-                # Forbidden; you cannot access
-                logger.warning("Got response: 403 Resource is forbidden")
-            if response.status_code == HTTPStatus.NOT_FOUND:
-                # Not found; the requested asset does not exist, or you are not authorized to see it
-                logger.warning("Got response: 404 Resource not found")
-            if response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
-                # Too Many Requests; you have exceeded rate limits
-                logger.warning("Got response: 429 Requests Limit Exceeded")
-            if response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR:
-                # Strava is having issues
-                logger.warning("Got response: 500 Strava is probably having issues")
-
+        self._log_failed_response(user_id, response.status_code)
         return None
 
-    def get_logged_in_athlete(self, user_id: str) -> Dict:
+    def get_logged_in_athlete(self, user_id: str, priority: Priority = Priority.INTERACTIVE) -> Dict:
         """Implements getLoggedInAthlete endpoint.
 
         https://developers.strava.com/docs/reference/#api-Athletes-getLoggedInAthlete
 
         Args:
             user_id: id of the user to get information for
+            priority: Priority of the request when waiting for rate limit budget
 
         Returns:
             detailed athlete object as defined by strava
             https://developers.strava.com/docs/reference/#api-models-DetailedAthlete
         """
-        endpoint_url = "https://www.strava.com/api/v3/athlete"
-        response = self._request(user_id=user_id, method="get", url=endpoint_url)
+        endpoint_url = f"{self.api_url}/athlete"
+        response = self._request(user_id=user_id, method="get", url=endpoint_url, priority=priority)
         return response.json()
 
-    def get_activity_by_id(self, user_id: str, activity_id: str) -> Dict:
+    def get_activity_by_id(self, user_id: str, activity_id: str, priority: Priority = Priority.INTERACTIVE) -> Dict:
         """Implements getActivityById endpoint.
 
         https://developers.strava.com/docs/reference/#api-Activities-getActivityById
@@ -224,58 +343,115 @@ class StravaHandler:
         Args:
             user_id: id of user the activity belongs to
             activity_id: id of the activity to request
+            priority: Priority of the request when waiting for rate limit budget
 
         Returns:
             detailed activity object as defined on strava
             https://developers.strava.com/docs/reference/#api-models-DetailedActivity
         """
-        activity_url = f"https://www.strava.com/api/v3/activities/{activity_id}"
+        activity_url = f"{self.api_url}/activities/{activity_id}"
         params = {"include_all_efforts": False}  # we don't use those
-        response = self._request(user_id=user_id, method="get", url=activity_url, params=params)
+        response = self._request(
+            user_id=user_id,
+            method="get",
+            url=activity_url,
+            params=params,
+            priority=priority,
+        )
         return response.json()
 
-    def get_logged_in_athlete_activities(
+    @staticmethod
+    def _activities_params(before: datetime = None, after: datetime = None) -> Dict:
+        """Build the query params for the first page of getLoggedInAthleteActivities.
+
+        Args:
+            before: end of time interval to return activities for
+            after: start of time interval to return activities for
+
+        Returns:
+            query params
+        """
+        return {
+            "per_page": str(StravaHandler.activities_per_page),  # defaults to 30
+            "page": 1,  # defaults to 1
+            "before": int(before.timestamp()) if before else None,
+            "after": int(after.timestamp()) if after else None,
+        }
+
+    def get_logged_in_athlete_activities_page(  # noqa: PLR0913 - Ignore: Too many arguments to function call
         self,
         user_id: str,
+        page: int,
         before: datetime = None,
         after: datetime = None,
+        priority: Priority = Priority.BACKFILL,
     ) -> List[Dict]:
-        """Implements getLoggedInAthleteActivities endpoint.
+        """Request a single page of getLoggedInAthleteActivities.
 
         https://developers.strava.com/docs/reference/#api-Activities-getLoggedInAthleteActivities
 
         Args:
             user_id: id of user the activity belongs to
+            page: number of the page, starting at 1
             before: end of time interval to return activities for
             after: start of time interval to return activities for
+            priority: Priority of the request when waiting for rate limit budget
 
         Returns:
-            list of detailed activity objects as defined on strava
+            list of detailed activity objects as defined on strava, shorter than per_page on the last page
             https://developers.strava.com/docs/reference/#api-models-DetailedActivity
         """
-        activities_url = "https://www.strava.com/api/v3/athlete/activities"
-        params = {
-            "per_page": "200",  # defaults to 30
-            "page": 1,  # defaults to 1
-            "before": int(before.timestamp()) if before else None,
-            "after": int(after.timestamp()) if after else None,
-        }
+        activities_url = f"{self.api_url}/athlete/activities"
+        params = self._activities_params(before=before, after=after)
+        params["page"] = page
+        response = self._request(
+            user_id=user_id,
+            method="get",
+            url=activities_url,
+            params=params,
+            priority=priority,
+        )
+        # pages of a backfill are large, orjson decodes them several times faster than response.json
+        return decode_json(response.content)
+
+    def iter_logged_in_athlete_activities(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        user_id: str,
+        before: datetime = None,
+        after: datetime = None,
+        start_page: int = 1,
+        priority: Priority = Priority.BACKFILL,
+    ) -> Iterator[List[Dict]]:
+        """Request getLoggedInAthleteActivities page by page, yielding every page as it arrives.
 
-        activities = []
-        current_page = 1
+        Only one page is held in memory at a time, so callers can persist pages while the next one is requested.
+
+        Args:
+            user_id: id of user the activity belongs to
+            before: end of time interval to return activities for
+            after: start of time interval to return activities for
+            start_page: number of the first page to request, starting at 1
+            priority: Priority of the requests when waiting for rate limit budget
+
+        Yields:
+            list of detailed activity objects as defined on strava per page
+            https://developers.strava.com/docs/reference/#api-models-DetailedActivity
+        """
+        current_page = start_page
         # run request new pages until we get less activities back than we requested
         while True:
-            params["page"] = current_page
-            response = self._request(user_id=user_id, method="get", url=activities_url, params=params)
-            content = response.json()
-            activities.extend(content)
+            content = self.get_logged_in_athlete_activities_page(
+                user_id=user_id,
+                page=current_page,
+                before=before,
+                after=after,
+                priority=priority,
+            )
+            yield content
 
             # if content len is smaller than the amount of activities we requested per
             # page we should have gotten everything available and can stop requesting
-            if len(content) < int(params["per_page"]):
-                break
+            if len(content) < self.activities_per_page:
+                return
             # increase page number
             current_page += 1
-            params["page"] = current_page
-
-        return activities
@@ -0,0 +1,134 @@
+"""This module provides the TokenCache holding the access tokens of users for the strava api.
+
+One TokenCache is shared by the blocking StravaHandler of the workers and the AsyncStravaHandler of the endpoints,
+so the token of a user is refreshed once per process. Strava may rotate the refresh token with every exchange,
+two concurrent refreshes would both store a refresh token and one of them could overwrite the other.
+"""
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+
+@dataclass
+class AccessToken:
+    """Dataclass holding a short-lived access token of a user for the strava api."""
+
+    access_token: str
+    expires_at: datetime
+
+    def is_valid(self, margin: timedelta) -> bool:
+        """Check if the token is still valid for at least margin.
+
+        Args:
+            margin: time span the token has to stay valid
+
+        Returns:
+            bool
+        """
+        return datetime.now(tz=timezone.utc) + margin < self.expires_at
+
+
+class TokenCache:
+    """Access tokens of users and one lock per user serializing their refreshes, for threads and tasks alike."""
+
+    def __init__(self, refresh_margin: int = 300, poll_interval: float = 0.05) -> None:
+        """Access tokens of users and one lock per user serializing their refreshes, for threads and tasks alike.
+
+        Args:
+            refresh_margin: seconds before expiry at which cached access tokens are refreshed
+            poll_interval: seconds a task waits before trying again to get the lock of a user held by someone else
+        """
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.poll_interval = poll_interval
+        self._tokens: Dict[str, AccessToken] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[str]:
+        """Return the cached access token of a user if it is valid for at least refresh_margin.
+
+        Args:
+            user_id: id of the user on strava
+
+        Returns:
+            access_token or None
+        """
+        token = self._tokens.get(user_id)
+        if token and token.is_valid(self.refresh_margin):
+            return token.access_token
+        return None
+
+    def put(self, user_id: str, token: AccessToken) -> None:
+        """Cache the access token of a user.
+
+        Args:
+            user_id: id of the user on strava
+            token: AccessToken
+
+        Returns:
+            None
+        """
+        self._tokens[user_id] = token
+
+    def invalidate(self, user_id: str) -> None:
+        """Drop the cached access token of a user.
+
+        Args:
+            user_id: id of the user on strava
+
+        Returns:
+            None
+        """
+        self._tokens.pop(user_id, None)
+
+    def _lock(self, user_id: str) -> threading.Lock:
+        """Get the lock guarding the access token of a user.
+
+        Args:
+            user_id: id of the user on strava
+
+        Returns:
+            threading.Lock
+        """
+        with self._locks_lock:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+    @contextmanager
+    def refreshing(self, user_id: str) -> Iterator[None]:
+        """Hold the lock of a user while refreshing their token, blocking the thread while it is held elsewhere.
+
+        Args:
+            user_id: id of the user on strava
+
+        Yields:
+            None
+        """
+        with self._lock(user_id):
+            yield
+
+    @asynccontextmanager
+    async def refreshing_async(self, user_id: str) -> AsyncIterator[None]:
+        """Hold the lock of a user while refreshing their token, without blocking the event loop.
+
+        The lock is polled instead of acquired in the threadpool, a cancelled task can never leave it acquired.
+
+        Args:
+            user_id: id of the user on strava
+
+        Yields:
+            None
+        """
+        lock = self._lock(user_id)
+        while not lock.acquire(blocking=False):
+            await asyncio.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            lock.release()
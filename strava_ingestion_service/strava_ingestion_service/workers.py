@@ -0,0 +1,231 @@
+"""This module provides the pool of background workers processing ingestion jobs.
+
+Every worker is a thread leasing jobs from the queue in the database.
+A job requests the activity history of a user page by page and checkpoints its progress after every page,
+so a job interrupted by a restart resumes at the last stored page.
+While a job is processed its lease is renewed in the background, waits for rate limit budget can outlast it.
+A sweeper thread periodically queues full syncs, reconciling what incremental syncs missed.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List
+
+from database_utils.activity_handler import ActivityRows, StravaActivityHandler
+from database_utils.job_handler import IngestionJobHandler, LeaseLostError, StravaIngestionJob
+
+from .rate_limiter import Priority
+from .strava_handler import StravaHandler
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+
+class IngestionWorkerPool:
+    """Pool of threads processing the ingestion jobs queued in the database."""
+
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        job_handler: IngestionJobHandler,
+        activity_handler: StravaActivityHandler,
+        strava_handler: StravaHandler,
+        workers: int = 2,
+        poll_interval: float = 5.0,
+        lease_seconds: int = 300,
+        max_attempts: int = 5,
+        reconcile_interval: int = 604800,
+        reconcile_batch_size: int = 10,
+        sweep_interval: float = 3600.0,
+    ) -> None:
+        """Pool of threads processing the ingestion jobs queued in the database.
+
+        Args:
+            job_handler: wrapper for the queue of ingestion jobs
+            activity_handler: wrapper for the activities in the database
+            strava_handler: blocking wrapper for the strava api, shared by all workers
+            workers: number of worker threads
+            poll_interval: seconds an idle worker waits before looking for new jobs
+            lease_seconds: seconds a job stays reserved for a worker without a checkpoint or renewal
+            max_attempts: number of failed attempts after which a job is given up
+            reconcile_interval: seconds after which the history of a user is synced in full again
+            reconcile_batch_size: maximum number of full syncs queued per sweep
+            sweep_interval: seconds between two sweeps looking for users to reconcile
+        """
+        self.job_handler = job_handler
+        self.activity_handler = activity_handler
+        self.strava_handler = strava_handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.reconcile_interval = timedelta(seconds=reconcile_interval)
+        self.reconcile_batch_size = reconcile_batch_size
+        self.sweep_interval = sweep_interval
+
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        """Start the worker threads.
+
+        Returns:
+            None
+        """
+        self._stop.clear()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"ingestion-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        sweeper = threading.Thread(target=self._sweep, name="ingestion-sweeper", daemon=True)
+        sweeper.start()
+        self._threads.append(sweeper)
+        logger.info("Started %s ingestion workers", self.workers)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Ask the worker threads to stop and wait for them.
+
+        Jobs still running are resumed from their last checkpoint once their lease expired.
+
+        Args:
+            timeout: seconds to wait for every thread
+
+        Returns:
+            None
+        """
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+        logger.info("Stopped ingestion workers")
+
+    def notify(self) -> None:
+        """Wake up idle workers, called after a job was queued.
+
+        Returns:
+            None
+        """
+        self._wakeup.set()
+
+    def _sweep(self) -> None:
+        """Queue full syncs for users who were not reconciled within reconcile_interval until the pool is stopped.
+
+        Returns:
+            None
+        """
+        while not self._stop.is_set():
+            reconciled_before = datetime.now(tz=timezone.utc).replace(tzinfo=None) - self.reconcile_interval
+            try:
+                queued = self.job_handler.enqueue_reconciliations(reconciled_before, limit=self.reconcile_batch_size)
+            except Exception:
+                logger.exception("Queueing reconciliations failed")
+                queued = 0
+            if queued:
+                logger.info("Queued %s reconciliations", queued)
+                self.notify()
+            self._stop.wait(self.sweep_interval)
+
+    def _run(self) -> None:
+        """Lease and process jobs until the pool is stopped.
+
+        Returns:
+            None
+        """
+        while not self._stop.is_set():
+            try:
+                job = self.job_handler.lease(self.lease_seconds)
+            except Exception:
+                logger.exception("Leasing ingestion job failed")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            try:
+                with self._renew_lease(job):
+                    self._process(job)
+            except LeaseLostError:
+                logger.warning("Lease of ingestion job %s was taken over, giving the job up", job.id)
+            except Exception as e:
+                logger.exception("Ingestion job %s failed", job.id)
+                self.job_handler.fail(job.id, job.lease_token, error=repr(e), max_attempts=self.max_attempts)
+
+    @contextmanager
+    def _renew_lease(self, job: StravaIngestionJob) -> Iterator[None]:
+        """Renew the lease of a job in a background thread while the job is processed.
+
+        Args:
+            job: leased StravaIngestionJob
+
+        Yields:
+            None
+        """
+        done = threading.Event()
+
+        def renew() -> None:
+            # renewed three times per lease, so a single failed renewal does not let the lease expire
+            while not done.wait(self.lease_seconds / 3):
+                try:
+                    if not self.job_handler.renew(job.id, job.lease_token, self.lease_seconds):
+                        logger.warning("Lease of ingestion job %s was lost", job.id)
+                        return
+                except Exception:
+                    logger.exception("Renewing lease of ingestion job %s failed", job.id)
+
+        thread = threading.Thread(target=renew, name=f"ingestion-lease-{job.id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def _process(self, job: StravaIngestionJob) -> None:
+        """Request the activity history of a user page by page, starting at the last checkpoint.
+
+        Args:
+            job: leased StravaIngestionJob
+
+        Returns:
+            None
+        """
+        logger.info("Processing ingestion job %s for user %s from page %s", job.id, job.user_id, job.next_page)
+        pages = self.strava_handler.iter_logged_in_athlete_activities(
+            user_id=job.user_id,
+            before=job.before.replace(tzinfo=timezone.utc),
+            after=job.after.replace(tzinfo=timezone.utc) if job.after else None,
+            start_page=job.next_page,
+            priority=Priority.BACKFILL,
+        )
+        activity_count = job.activity_count
+        latest_start_date = job.latest_start_date
+        # every page is stored before the next one is requested, so memory stays flat and progress is durable
+        for page, content in enumerate(pages, start=job.next_page):
+            # the page is parsed into rows and written as is, without an object per activity
+            rows = ActivityRows.from_api(content)
+            page_latest_start_date = rows.latest_start_date()
+            if page_latest_start_date and (latest_start_date is None or latest_start_date < page_latest_start_date):
+                latest_start_date = page_latest_start_date
+            # activities and checkpoint are stored in one transaction
+            with self.activity_handler.session_scope():
+                # challenge totals are recomputed once the job is done, not for every page
+                activity_count += self.activity_handler.bulk_upsert(rows, refresh_totals=False)
+                self.job_handler.checkpoint(
+                    job.id,
+                    job.lease_token,
+                    next_page=page + 1,
+                    activity_count=activity_count,
+                    latest_start_date=latest_start_date,
+                    lease_seconds=self.lease_seconds,
+                )
+            if self._stop.is_set():
+                # resumed from the checkpoint once the lease expired
+                pages.close()
+                return
+
+        self.job_handler.complete(job.id, job.lease_token)
+        logger.info("Ingestion job %s done with %s activities", job.id, activity_count)
@@ -18,6 +18,17 @@ class Settings(BaseSettings):
     ENVIRONMENT: str
     STRAVA_SERVICE_URL: AnyUrl
     STRAVA_SERVICE_TIMEOUT: int = 60
+    STRAVA_SERVICE_POOL_SIZE: int = 10
+    STRAVA_SERVICE_MAX_RETRIES: int = 3
+    STRAVA_SERVICE_BACKOFF_FACTOR: float = 0.5
+    EVENT_BUFFER_PATH: str = "./webhook_events.db"
+    # seconds a create or update waits for further events about the same object before it is forwarded
+    EVENT_SETTLE_WINDOW: float = 5.0
+    EVENT_DISPATCH_POLL_INTERVAL: float = 1.0
+    EVENT_DISPATCH_BATCH_SIZE: int = 50
+    EVENT_DISPATCH_MAX_ATTEMPTS: int = 10
+    EVENT_DISPATCH_MAX_BACKOFF: float = 300.0
+    EVENT_RETENTION: float = 86400.0
     LOGGING_CONFIG_PATH: str = "./logging.ini"
     SENTRY_DSN: AnyUrl = None
 
@@ -1,9 +1,63 @@
-"""Logic to execute the updates and changes to our data we get from webhook events."""
+"""Logic to execute the updates and changes to our data we get from webhook events.
+
+Every function forwarding a single event raises a requests.RequestException if the ingestion service
+did not accept the event, so the dispatcher can retry it.
+dispatch_batch handles the failures of its requests itself and returns only the events that failed.
+"""
+import logging
+from http import HTTPStatus
+from typing import Dict, List
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .config import settings
 from .schemas import WebhookEvent
 
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+
+def create_http_session(pool_size: int = 10, max_retries: int = 3, backoff_factor: float = 0.5) -> requests.Session:
+    """Create a requests.Session keeping pooled connections alive and retrying failed requests with backoff.
+
+    All endpoints of the ingestion service are idempotent, so POST and DELETE requests are retried as well.
+
+    Args:
+        pool_size: number of connections kept alive per host
+        max_retries: number of retries per request
+        backoff_factor: factor for the exponential sleep between retries
+
+    Returns:
+        requests.Session
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(
+            HTTPStatus.INTERNAL_SERVER_ERROR,
+            HTTPStatus.BAD_GATEWAY,
+            HTTPStatus.SERVICE_UNAVAILABLE,
+            HTTPStatus.GATEWAY_TIMEOUT,
+        ),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# long-lived session, so forwarded events reuse pooled keep-alive connections to the ingestion service
+http_session = create_http_session(
+    pool_size=settings.STRAVA_SERVICE_POOL_SIZE,
+    max_retries=settings.STRAVA_SERVICE_MAX_RETRIES,
+    backoff_factor=settings.STRAVA_SERVICE_BACKOFF_FACTOR,
+)
+
 
 def create(event: WebhookEvent) -> None:
     """Get newly created activity from strava after receiving create event.
@@ -17,10 +71,11 @@ def create(event: WebhookEvent) -> None:
     if event.object_type == "activity":
         user_id = str(event.owner_id)
         activity_id = str(event.object_id)
-        requests.post(
+        response = http_session.post(
             f"{settings.STRAVA_SERVICE_URL}/updateUserActivityById?user_id={user_id}&activity_id={activity_id}",
             timeout=settings.STRAVA_SERVICE_TIMEOUT,
         )
+        response.raise_for_status()
 
 
 def update(event: WebhookEvent) -> None:
@@ -35,17 +90,19 @@ def update(event: WebhookEvent) -> None:
     if event.object_type == "activity":
         user_id = str(event.owner_id)
         activity_id = str(event.object_id)
-        requests.post(
+        response = http_session.post(
             f"{settings.STRAVA_SERVICE_URL}/updateUserActivityById?user_id={user_id}&activity_id={activity_id}",
             timeout=settings.STRAVA_SERVICE_TIMEOUT,
         )
+        response.raise_for_status()
 
     if event.object_type == "athlete":
         user_id = str(event.object_id)
-        requests.post(
+        response = http_session.post(
             f"{settings.STRAVA_SERVICE_URL}/updateUserById?user_id={user_id}",
             timeout=settings.STRAVA_SERVICE_TIMEOUT,
         )
+        response.raise_for_status()
 
 
 def delete(event: WebhookEvent) -> None:
@@ -59,13 +116,126 @@ def delete(event: WebhookEvent) -> None:
     """
     if event.object_type == "activity":
         activity_id = event.object_id
-        requests.delete(
+        response = http_session.delete(
             f"{settings.STRAVA_SERVICE_URL}/deleteUserActivityById?activity_id={activity_id}",
             timeout=settings.STRAVA_SERVICE_TIMEOUT,
         )
+        response.raise_for_status()
     if event.object_type == "athlete":
         user_id = str(event.object_id)
-        requests.delete(
-            f"{settings.STRAVA_SERVICE_URL}/deleteUserById?activity_id={user_id}",
+        response = http_session.delete(
+            f"{settings.STRAVA_SERVICE_URL}/deleteUserById?user_id={user_id}",
             timeout=settings.STRAVA_SERVICE_TIMEOUT,
         )
+        response.raise_for_status()
+
+
+def dispatch(event: WebhookEvent) -> None:
+    """Forward a webhook event to the ingestion service depending on its aspect type.
+
+    Args:
+        event: WebhookEvent
+
+    Returns:
+        None
+    """
+    if event.aspect_type == "create":
+        create(event)
+    if event.aspect_type == "update":
+        update(event)
+    if event.aspect_type == "delete":
+        delete(event)
+
+
+def _rejected(error: requests.RequestException) -> bool:
+    """Check if the ingestion service rejected a request, retrying it will not change the outcome.
+
+    Args:
+        error: exception raised by a request to the ingestion service
+
+    Returns:
+        True for client errors, False for server errors and failed connections
+    """
+    return (
+        isinstance(error, requests.HTTPError)
+        and error.response is not None
+        and error.response.status_code < HTTPStatus.INTERNAL_SERVER_ERROR
+    )
+
+
+def _dispatch_activities(
+    updates: List[Dict[str, str]],
+    deletes: List[str],
+    events: List[WebhookEvent],
+) -> List[WebhookEvent]:
+    """Forward activity events in one request to the batch endpoint.
+
+    Args:
+        updates: user and activity ids of activities to fetch
+        deletes: ids of activities to delete
+        events: activity events the updates and deletes were built from
+
+    Returns:
+        list of WebhookEvent to retry
+    """
+    try:
+        response = http_session.post(
+            f"{settings.STRAVA_SERVICE_URL}/updateActivities",
+            json={"updates": updates, "deletes": deletes},
+            timeout=settings.STRAVA_SERVICE_TIMEOUT,
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if _rejected(e):
+            logger.exception("Ingestion service rejected activity events, dropping them")
+            return []
+        logger.warning("Forwarding activity events failed: %s", e)
+        return events
+
+    result = response.json()
+    if result.get("failed"):
+        logger.warning("Strava will not return activities: %s", result["failed"])
+    by_activity_id = {str(event.object_id): event for event in events if event.aspect_type != "delete"}
+    return [by_activity_id[reference["activity_id"]] for reference in result.get("retry", [])]
+
+
+def dispatch_batch(events: List[WebhookEvent]) -> List[WebhookEvent]:
+    """Forward many webhook events to the ingestion service.
+
+    All activity events are sent in one request to the batch endpoint, athlete events are forwarded one by one.
+    Only the events that failed are returned for a retry, events the ingestion service rejected are dropped.
+
+    Args:
+        events: list of WebhookEvent in the order they were received
+
+    Returns:
+        list of WebhookEvent the ingestion service could not process because of transient errors
+    """
+    updates: List[Dict[str, str]] = []
+    deletes: List[str] = []
+    activity_events: List[WebhookEvent] = []
+    athlete_events: List[WebhookEvent] = []
+    for event in events:
+        if event.object_type != "activity":
+            athlete_events.append(event)
+            continue
+        activity_events.append(event)
+        if event.aspect_type == "delete":
+            deletes.append(str(event.object_id))
+        else:
+            updates.append({"user_id": str(event.owner_id), "activity_id": str(event.object_id)})
+
+    retry: List[WebhookEvent] = []
+    if activity_events:
+        retry.extend(_dispatch_activities(updates, deletes, activity_events))
+
+    for event in athlete_events:
+        try:
+            dispatch(event)
+        except requests.RequestException as e:
+            if _rejected(e):
+                logger.exception("Ingestion service rejected athlete event %s, dropping it", event.object_id)
+            else:
+                logger.warning("Forwarding athlete event %s failed: %s", event.object_id, e)
+                retry.append(event)
+    return retry
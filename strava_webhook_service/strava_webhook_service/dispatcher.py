@@ -0,0 +1,163 @@
+"""Background dispatcher forwarding buffered webhook events to the ingestion service.
+
+Events are forwarded in batches in the order they were received, once their settle window passed.
+Failed deliveries are retried with exponential backoff, events rejected by the ingestion service are dropped.
+Events the ingestion service could not process because of transient errors are retried the same way.
+"""
+import logging
+import threading
+import time
+from http import HTTPStatus
+from typing import Callable, List, Optional, Union
+
+import requests
+
+from .event_buffer import BufferedEvent, EventBuffer
+from .schemas import WebhookEvent
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+
+class EventDispatcher:
+    """Thread draining the event buffer into the ingestion service."""
+
+    def __init__(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+        self,
+        buffer: EventBuffer,
+        handler: Callable[[List[WebhookEvent]], List[WebhookEvent]],
+        poll_interval: float = 1.0,
+        batch_size: int = 50,
+        max_attempts: int = 10,
+        max_backoff: float = 300.0,
+        retention: float = 86400.0,
+    ) -> None:
+        """Thread draining the event buffer into the ingestion service.
+
+        Args:
+            buffer: buffer of received webhook events
+            handler: function forwarding a batch of events, returning the events to retry,
+                raising a requests.RequestException if the whole batch failed
+            poll_interval: seconds the dispatcher waits for new events when the buffer is drained
+            batch_size: maximum number of events forwarded at once
+            max_attempts: number of failed deliveries after which an event is dropped
+            max_backoff: maximum seconds between two attempts to deliver an event
+            retention: seconds delivered events are kept to deduplicate retries of strava
+        """
+        self.buffer = buffer
+        self.handler = handler
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.retention = retention
+
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start the dispatcher thread.
+
+        Returns:
+            None
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="event-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Stop the dispatcher thread, undelivered events stay in the buffer.
+
+        Args:
+            timeout: seconds to wait for the thread
+
+        Returns:
+            None
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def notify(self) -> None:
+        """Wake up the dispatcher, called after an event was buffered.
+
+        Returns:
+            None
+        """
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        """Forward buffered events until the dispatcher is stopped.
+
+        Returns:
+            None
+        """
+        last_prune = 0.0
+        while not self._stop.is_set():
+            try:
+                events = self.buffer.pending(self.batch_size)
+                if events:
+                    self._deliver(events)
+                if time.time() - last_prune > self.retention / 24:
+                    self.buffer.prune(self.retention)
+                    last_prune = time.time()
+            except Exception:
+                logger.exception("Dispatching events failed")
+                events = []
+
+            if len(events) < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _deliver(self, batch: List[BufferedEvent]) -> None:
+        """Forward a batch of events and record the outcome in the buffer.
+
+        Args:
+            batch: list of BufferedEvent
+
+        Returns:
+            None
+        """
+        try:
+            retry = self.handler([buffered.event for buffered in batch])
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code < HTTPStatus.INTERNAL_SERVER_ERROR:
+                # retrying rejected events will not change the outcome
+                logger.exception("Ingestion service rejected events %s", [buffered.id for buffered in batch])
+                for buffered in batch:
+                    self.buffer.mark_delivered(buffered)
+                return
+            for buffered in batch:
+                self._retry(buffered, e)
+            return
+        except requests.RequestException as e:
+            for buffered in batch:
+                self._retry(buffered, e)
+            return
+        for buffered in batch:
+            if buffered.event in retry:
+                self._retry(buffered, "transient error of the ingestion service")
+            else:
+                self.buffer.mark_delivered(buffered)
+
+    def _retry(self, buffered: BufferedEvent, error: Union[Exception, str]) -> None:
+        """Schedule another attempt to deliver an event or drop it after max_attempts.
+
+        Args:
+            buffered: BufferedEvent
+            error: cause of the failed attempt
+
+        Returns:
+            None
+        """
+        attempts = buffered.attempts + 1
+        if attempts >= self.max_attempts:
+            logger.error("Dropping event %s after %s attempts: %s", buffered.id, attempts, error)
+            self.buffer.mark_delivered(buffered)
+            return
+        delay = min(self.poll_interval * 2**attempts, self.max_backoff)
+        logger.warning("Delivering event %s failed, retrying in %.0f seconds: %s", buffered.id, delay, error)
+        self.buffer.retry_later(buffered, delay)
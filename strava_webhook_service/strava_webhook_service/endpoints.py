@@ -3,9 +3,24 @@ from typing import Dict
 
 from fastapi import APIRouter
 
-from .dependencies import create, delete, update
+from .config import settings
+from .dependencies import dispatch_batch
+from .dispatcher import EventDispatcher
+from .event_buffer import EventBuffer
 from .schemas import WebhookEvent, WebhookValidation
 
+# events are persisted before they are acknowledged and forwarded in the background
+event_buffer = EventBuffer(settings.EVENT_BUFFER_PATH, settle_window=settings.EVENT_SETTLE_WINDOW)
+dispatcher = EventDispatcher(
+    buffer=event_buffer,
+    handler=dispatch_batch,
+    poll_interval=settings.EVENT_DISPATCH_POLL_INTERVAL,
+    batch_size=settings.EVENT_DISPATCH_BATCH_SIZE,
+    max_attempts=settings.EVENT_DISPATCH_MAX_ATTEMPTS,
+    max_backoff=settings.EVENT_DISPATCH_MAX_BACKOFF,
+    retention=settings.EVENT_RETENTION,
+)
+
 router = APIRouter()
 
 
@@ -26,15 +41,14 @@ def validation_webhook(webhook_validation: WebhookValidation) -> Dict[str, str]:
 def event_webhook(webhook_event: WebhookEvent) -> None:
     """Receive WebhookEvent from strava.
 
+    The event is stored in the buffer and acknowledged right away,
+    strava expects an acknowledgement within two seconds and retries otherwise.
+
     Args:
         webhook_event: WebhookEvent
 
     Returns:
         200,
     """
-    if webhook_event.aspect_type == "create":
-        create(webhook_event)
-    if webhook_event.aspect_type == "update":
-        update(webhook_event)
-    if webhook_event.aspect_type == "delete":
-        delete(webhook_event)
+    if event_buffer.push(webhook_event):
+        dispatcher.notify()
@@ -0,0 +1,272 @@
+"""Durable buffer for webhook events received from strava.
+
+Events are written to a local sqlite database before strava gets its acknowledgement,
+so no event is lost when the ingestion service is slow or unavailable.
+Strava retries events it did not get an acknowledgement for, retried deliveries are deduplicated by their content.
+
+Events are coalesced per object: strava often sends a create followed by several updates for one activity
+within seconds. Pending events wait for a settle window, creates and updates arriving meanwhile are merged
+into the pending event, so the burst results in one fetch. A delete cancels all pending fetches of the object,
+the delete of an athlete also those of their activities.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import List
+
+from .schemas import WebhookEvent
+
+logger = logging.getLogger(__name__)
+logger.info(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen_event (
+    dedup_key TEXT PRIMARY KEY,
+    received_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_seen_event_received_at ON seen_event (received_at);
+CREATE TABLE IF NOT EXISTS webhook_event (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    object_key TEXT NOT NULL,
+    owner_id INTEGER NOT NULL,
+    aspect_type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    delivered_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_webhook_event_pending ON webhook_event (delivered_at, next_attempt_at);
+CREATE INDEX IF NOT EXISTS ix_webhook_event_object_key ON webhook_event (object_key, delivered_at);
+CREATE INDEX IF NOT EXISTS ix_webhook_event_owner_id ON webhook_event (owner_id, delivered_at);
+"""
+
+
+@dataclass
+class BufferedEvent:
+    """Dataclass holding a buffered webhook event and its delivery state."""
+
+    # we are shadowing names from the db so this is okayish here
+    id: int  # noqa: A003
+    event: WebhookEvent
+    # incremented whenever another event is merged into this one
+    version: int
+    attempts: int
+
+
+def dedup_key(event: WebhookEvent) -> str:
+    """Build the key identifying a webhook event across retried deliveries.
+
+    Args:
+        event: WebhookEvent
+
+    Returns:
+        str
+    """
+    return f"{event.subscription_id}:{event.object_type}:{event.object_id}:{event.aspect_type}:{event.event_time}"
+
+
+def object_key(event: WebhookEvent) -> str:
+    """Build the key identifying the object an event is about.
+
+    Args:
+        event: WebhookEvent
+
+    Returns:
+        str
+    """
+    return f"{event.object_type}:{event.object_id}"
+
+
+class EventBuffer:
+    """Durable buffer of webhook events waiting to be forwarded to the ingestion service."""
+
+    def __init__(self, path: str, settle_window: float = 5.0) -> None:
+        """Durable buffer of webhook events waiting to be forwarded to the ingestion service.
+
+        Args:
+            path: path of the sqlite database file
+            settle_window: seconds a create or update waits for further events about the same object
+        """
+        self.path = path
+        self.settle_window = settle_window
+        # the webhook endpoint and the dispatcher share one connection, the lock serializes their access
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        """Close the connection to the database file.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._connection.close()
+
+    def push(self, event: WebhookEvent) -> bool:
+        """Store an event, ignoring events that were received before and coalescing events per object.
+
+        Args:
+            event: WebhookEvent
+
+        Returns:
+            True if the event was new, False if it is a duplicate
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO seen_event (dedup_key, received_at) VALUES (?, ?)",
+                (dedup_key(event), now),
+            )
+            if not cursor.rowcount:
+                logger.info("Ignoring duplicate event %s", dedup_key(event))
+                return False
+
+            if event.aspect_type == "delete":
+                self._cancel_pending(event, now)
+                self._insert(event, now, next_attempt_at=now)
+                return True
+
+            pending = self._connection.execute(
+                "SELECT id, payload FROM webhook_event "
+                "WHERE object_key = ? AND delivered_at IS NULL AND aspect_type != 'delete' ORDER BY id DESC LIMIT 1",
+                (object_key(event),),
+            ).fetchone()
+            if pending is None:
+                self._insert(event, now, next_attempt_at=now + self.settle_window)
+                return True
+
+            # merge into the pending event, a create stays a create
+            pending_id, pending_payload = pending
+            merged = WebhookEvent(**json.loads(pending_payload))
+            merged.updates = {**merged.updates, **event.updates}
+            merged.event_time = max(merged.event_time, event.event_time)
+            if merged.aspect_type != "create":
+                merged.aspect_type = event.aspect_type
+            self._connection.execute(
+                "UPDATE webhook_event SET payload = ?, aspect_type = ?, version = version + 1 WHERE id = ?",
+                (merged.json(), merged.aspect_type, pending_id),
+            )
+            logger.info("Coalesced event %s into pending event %s", dedup_key(event), pending_id)
+        return True
+
+    def _insert(self, event: WebhookEvent, now: float, next_attempt_at: float) -> None:
+        """Insert an event into the buffer, must be called holding the lock in a transaction.
+
+        Args:
+            event: WebhookEvent
+            now: time the event was received
+            next_attempt_at: time the event is due for delivery
+
+        Returns:
+            None
+        """
+        owner_id = event.object_id if event.object_type == "athlete" else event.owner_id
+        self._connection.execute(
+            "INSERT INTO webhook_event (object_key, owner_id, aspect_type, payload, received_at, next_attempt_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (object_key(event), owner_id, event.aspect_type, event.json(), now, next_attempt_at),
+        )
+
+    def _cancel_pending(self, event: WebhookEvent, now: float) -> None:
+        """Cancel pending creates and updates made obsolete by a delete event.
+
+        Must be called holding the lock in a transaction.
+
+        Args:
+            event: delete WebhookEvent
+            now: time the event was received
+
+        Returns:
+            None
+        """
+        if event.object_type == "athlete":
+            # the athlete and all their activities are deleted
+            cursor = self._connection.execute(
+                "UPDATE webhook_event SET delivered_at = ? "
+                "WHERE owner_id = ? AND delivered_at IS NULL AND aspect_type != 'delete'",
+                (now, event.object_id),
+            )
+        else:
+            cursor = self._connection.execute(
+                "UPDATE webhook_event SET delivered_at = ? "
+                "WHERE object_key = ? AND delivered_at IS NULL AND aspect_type != 'delete'",
+                (now, object_key(event)),
+            )
+        if cursor.rowcount:
+            logger.info("Delete event %s cancelled %s pending events", dedup_key(event), cursor.rowcount)
+
+    def pending(self, limit: int = 50) -> List[BufferedEvent]:
+        """Get events due for delivery in the order they were received.
+
+        Args:
+            limit: maximum number of events
+
+        Returns:
+            list of BufferedEvent
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, payload, version, attempts FROM webhook_event "
+                "WHERE delivered_at IS NULL AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+        return [
+            BufferedEvent(id=row_id, event=WebhookEvent(**json.loads(payload)), version=version, attempts=attempts)
+            for row_id, payload, version, attempts in rows
+        ]
+
+    def mark_delivered(self, buffered: BufferedEvent) -> bool:
+        """Mark an event as delivered.
+
+        An event that got another event merged in since it was read stays pending, so the merged event is delivered.
+
+        Args:
+            buffered: BufferedEvent as returned by pending
+
+        Returns:
+            True if the event was marked as delivered
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "UPDATE webhook_event SET delivered_at = ? WHERE id = ? AND version = ?",
+                (time.time(), buffered.id, buffered.version),
+            )
+        return bool(cursor.rowcount)
+
+    def retry_later(self, buffered: BufferedEvent, delay: float) -> None:
+        """Record a failed delivery and schedule the next attempt.
+
+        Args:
+            buffered: BufferedEvent as returned by pending
+            delay: seconds until the next attempt
+
+        Returns:
+            None
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE webhook_event SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                (time.time() + delay, buffered.id),
+            )
+
+    def prune(self, retention: float) -> int:
+        """Delete events delivered and keys of events received more than retention seconds ago.
+
+        Args:
+            retention: seconds the keys of received events are kept for deduplication
+
+        Returns:
+            number of deleted events
+        """
+        cutoff = time.time() - retention
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM seen_event WHERE received_at < ?", (cutoff,))
+            cursor = self._connection.execute("DELETE FROM webhook_event WHERE delivered_at < ?", (cutoff,))
+        return cursor.rowcount
@@ -25,3 +25,7 @@ if settings.ENVIRONMENT not in SHOW_DOCS_ENVIRONMENT:
 
 app = FastAPI(**app_config)
 app.include_router(endpoints.router)
+# forward buffered events to the ingestion service in the background
+app.add_event_handler("startup", endpoints.dispatcher.start)
+app.add_event_handler("shutdown", endpoints.dispatcher.stop)
+app.add_event_handler("shutdown", endpoints.event_buffer.close)
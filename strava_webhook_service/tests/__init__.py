@@ -0,0 +1 @@
+"""Tests of the strava_webhook_service, run against SQLite databases in temporary directories."""
@@ -0,0 +1,194 @@
+"""Tests coalescing webhook events in the EventBuffer."""
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, Iterator, List
+
+import pytest
+
+from strava_webhook_service import event_buffer
+from strava_webhook_service.event_buffer import EventBuffer
+from strava_webhook_service.schemas import WebhookEvent
+
+SETTLE_WINDOW = 5.0
+
+
+class Clock:
+    """Clock standing in for time.time, advanced by the tests."""
+
+    def __init__(self) -> None:
+        """Clock standing in for time.time, advanced by the tests."""
+        self.now = 1_700_000_000.0
+
+    def time(self) -> float:
+        """Get the current time.
+
+        Returns:
+            seconds since epoch
+        """
+        return self.now
+
+
+@pytest.fixture()
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    """Clock of the event buffer.
+
+    Args:
+        monkeypatch: pytest.MonkeyPatch
+
+    Returns:
+        Clock
+    """
+    clock = Clock()
+    monkeypatch.setattr(event_buffer, "time", SimpleNamespace(time=clock.time))
+    return clock
+
+
+@pytest.fixture()
+def buffer(tmp_path: Path) -> Iterator[EventBuffer]:
+    """EventBuffer in a temporary sqlite database.
+
+    Args:
+        tmp_path: temporary directory
+
+    Yields:
+        EventBuffer
+    """
+    buffer = EventBuffer(str(tmp_path / "events.db"), settle_window=SETTLE_WINDOW)
+    yield buffer
+    buffer.close()
+
+
+def _event(  # noqa: PLR0913 - Ignore: Too many arguments to function call
+    aspect_type: str,
+    object_id: int = 10,
+    object_type: str = "activity",
+    owner_id: int = 1,
+    event_time: int = 1,
+    updates: Dict = None,
+) -> WebhookEvent:
+    """Build a webhook event.
+
+    Args:
+        aspect_type: create, update or delete
+        object_id: id of the activity or athlete
+        object_type: activity or athlete
+        owner_id: id of the athlete owning the object
+        event_time: seconds since epoch
+        updates: changed fields
+
+    Returns:
+        WebhookEvent
+    """
+    return WebhookEvent(
+        object_type=object_type,
+        object_id=object_id,
+        aspect_type=aspect_type,
+        updates=updates or {},
+        owner_id=owner_id,
+        subscription_id=1,
+        event_time=event_time,
+    )
+
+
+def _pending(buffer: EventBuffer, clock: Clock) -> List[WebhookEvent]:
+    """Get the events due once the settle window passed.
+
+    Args:
+        buffer: EventBuffer
+        clock: Clock of the event buffer
+
+    Returns:
+        list of WebhookEvent
+    """
+    clock.now += SETTLE_WINDOW
+    return [buffered.event for buffered in buffer.pending()]
+
+
+def test_event_waits_for_settle_window(buffer: EventBuffer, clock: Clock) -> None:
+    """Creates and updates are due once the settle window passed."""
+    assert buffer.push(_event("create"))
+
+    clock.now += SETTLE_WINDOW - 1
+    assert buffer.pending() == []
+    clock.now += 1
+    assert [buffered.event for buffered in buffer.pending()] == [_event("create")]
+
+
+def test_duplicate_event_is_ignored(buffer: EventBuffer, clock: Clock) -> None:
+    """Strava retries events it got no acknowledgement for, the retry is dropped."""
+    assert buffer.push(_event("update"))
+    assert not buffer.push(_event("update"))
+
+    assert _pending(buffer, clock) == [_event("update")]
+
+
+def test_create_and_updates_merge_into_create(buffer: EventBuffer, clock: Clock) -> None:
+    """A create followed by updates results in one create carrying all updates."""
+    buffer.push(_event("create", event_time=1))
+    buffer.push(_event("update", event_time=3, updates={"title": "Morning Run"}))
+    buffer.push(_event("update", event_time=2, updates={"type": "Run"}))
+
+    assert _pending(buffer, clock) == [_event("create", event_time=3, updates={"title": "Morning Run", "type": "Run"})]
+
+
+def test_updates_merge_into_update(buffer: EventBuffer, clock: Clock) -> None:
+    """Updates of the same object merge, updates of other objects stay apart."""
+    buffer.push(_event("update", updates={"title": "Run"}))
+    buffer.push(_event("update", event_time=2, updates={"title": "Morning Run"}))
+    buffer.push(_event("update", object_id=11))
+
+    assert _pending(buffer, clock) == [
+        _event("update", event_time=2, updates={"title": "Morning Run"}),
+        _event("update", object_id=11),
+    ]
+
+
+def test_delete_cancels_pending_fetches(buffer: EventBuffer, clock: Clock) -> None:
+    """A delete is due at once and cancels the pending create of the activity."""
+    buffer.push(_event("create"))
+    buffer.push(_event("create", object_id=11))
+    buffer.push(_event("delete", event_time=2))
+
+    assert [buffered.event for buffered in buffer.pending()] == [_event("delete", event_time=2)]
+    assert _pending(buffer, clock) == [_event("create", object_id=11), _event("delete", event_time=2)]
+
+
+def test_athlete_delete_cancels_fetches_of_their_activities(buffer: EventBuffer, clock: Clock) -> None:
+    """Deleting an athlete cancels pending events of the athlete and of their activities, not those of others."""
+    buffer.push(_event("create", object_id=10, owner_id=1))
+    buffer.push(_event("update", object_id=1, object_type="athlete", owner_id=1))
+    buffer.push(_event("create", object_id=20, owner_id=2))
+    athlete_delete = _event("delete", object_id=1, object_type="athlete", owner_id=1, event_time=2)
+    buffer.push(athlete_delete)
+
+    assert _pending(buffer, clock) == [_event("create", object_id=20, owner_id=2), athlete_delete]
+
+
+def test_event_merged_during_delivery_stays_pending(buffer: EventBuffer, clock: Clock) -> None:
+    """An event getting an update merged in while it is delivered is delivered again with the update."""
+    buffer.push(_event("create"))
+    clock.now += SETTLE_WINDOW
+    (delivering,) = buffer.pending()
+
+    buffer.push(_event("update", event_time=2, updates={"title": "Morning Run"}))
+
+    assert not buffer.mark_delivered(delivering)
+    (merged,) = buffer.pending()
+    assert merged.id == delivering.id
+    assert merged.version == delivering.version + 1
+    assert merged.event == _event("create", event_time=2, updates={"title": "Morning Run"})
+    assert buffer.mark_delivered(merged)
+    assert buffer.pending() == []
+
+
+def test_update_after_delivery_is_a_new_event(buffer: EventBuffer, clock: Clock) -> None:
+    """Delivered events are not merged into."""
+    buffer.push(_event("create"))
+    clock.now += SETTLE_WINDOW
+    (delivered,) = buffer.pending()
+    assert buffer.mark_delivered(delivered)
+
+    buffer.push(_event("update", event_time=2))
+
+    assert buffer.pending() == []
+    assert _pending(buffer, clock) == [_event("update", event_time=2)]